@@ -0,0 +1,201 @@
+# The kernels being benchmarked, each wrapped so it can run on any square height window
+# trace_river and pygame are folders of scripts which both have an algorithms.py, so their modules are
+# loaded by file path under their own names instead of by import
+
+import importlib.util
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+root = Path(__file__).absolute().parent.parent
+sys.path.append(str(root))
+from riverflow.labels import label_equal_heights, region_members
+from riverflow.paths import lower_point_cost
+
+# trace_river works on segments of this size, windows are cut into as many as fit
+SEGMENT_SIZE = 100
+FLOW_CYCLES = 50
+
+
+def load_module(folder, name):
+    """Load folder/name.py as the module <folder>_<name>"""
+    module_name = f"{folder}_{name}"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, root.joinpath(folder, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+def graph_counts(graph):
+    # (nodes, edges) of a dict of key to neighbour set
+    return len(graph), sum(len(neighbours) for neighbours in graph.values()) // 2
+
+
+def region_graph_counts(graph):
+    compact = graph.compacted()
+    return len(compact.nodes), len(compact.indices) // 2
+
+
+class Unsupported(Exception):
+    """Raised by a kernel's setup when it can't run on the window it was given"""
+
+
+def _segments(heights):
+    count = heights.shape[0] // SEGMENT_SIZE
+    if not count:
+        raise Unsupported(f"needs a window of at least {SEGMENT_SIZE}px")
+    return [(row, col) for row in range(count) for col in range(count)]
+
+
+def _sparse_heights(heights, segments):
+    sparse_heights = load_module("trace_river", "sparse_heights")
+    output = sparse_heights.SparseHeights(heights.shape, SEGMENT_SIZE, dtype=heights.dtype)
+    for row, col in segments:
+        rows = slice(row * SEGMENT_SIZE, (row + 1) * SEGMENT_SIZE)
+        cols = slice(col * SEGMENT_SIZE, (col + 1) * SEGMENT_SIZE)
+        output[rows, cols] = heights[rows, cols]
+    return output
+
+
+def add_segment_to_graph(heights):
+    # Segments added one at a time the way the trace grows
+    algorithms = load_module("trace_river", "algorithms")
+    graph = load_module("trace_river", "graph").Graph()
+    segments = _segments(heights)
+    sparse_heights = _sparse_heights(heights, segments)
+
+    def run():
+        active_segments = []
+        for segment in segments:
+            active_segments.append(segment)
+            algorithms.add_segment_to_graph(graph, sparse_heights, SEGMENT_SIZE, segment, active_segments)
+
+    return run, lambda: graph_counts(graph)
+
+
+def add_segments_to_graph(heights):
+    # Every segment added as one block
+    algorithms = load_module("trace_river", "algorithms")
+    graph = load_module("trace_river", "graph").Graph()
+    segments = _segments(heights)
+    sparse_heights = _sparse_heights(heights, segments)
+
+    def run():
+        algorithms.add_segments_to_graph(graph, sparse_heights, SEGMENT_SIZE, segments, segments)
+
+    return run, lambda: graph_counts(graph)
+
+
+def flood_added_segment(heights):
+    algorithms = load_module("trace_river", "algorithms")
+    graph = load_module("trace_river", "graph").Graph()
+    segments = _segments(heights)
+    sparse_heights = _sparse_heights(heights, segments)
+    algorithms.add_segments_to_graph(graph, sparse_heights, SEGMENT_SIZE, segments, segments)
+
+    def run():
+        algorithms.flood_added_segments(graph, sparse_heights, SEGMENT_SIZE, segments, segments)
+
+    return run, lambda: graph_counts(graph)
+
+
+def _largest_region(heights):
+    # (row, col) points of the biggest equal height region, the node a track has to cross
+    labels, num_regions = label_equal_heights(heights)
+    order, starts = region_members(labels, num_regions)
+    largest = int(np.argmax(np.diff(starts)))
+    rows, cols = np.divmod(order[starts[largest] : starts[largest + 1]], heights.shape[1])
+    return tuple(sorted(zip(rows.tolist(), cols.tolist())))
+
+
+def find_deep_path(heights, weighted=False):
+    path_tracing = load_module("trace_river", "path_tracing")
+    points = _largest_region(heights)
+    # Enter from the point above the first point of the node and cross to its last point
+    entry_point = (points[0][0] - 1, points[0][1])
+    cost = lower_point_cost(heights) if weighted else None
+
+    path = []
+
+    def run():
+        path[:] = path_tracing.find_deep_path(points, entry_point, points[-1], heights, cost)
+
+    return run, lambda: (len(points), len(path))
+
+
+def pygame_state(heights):
+    # The parts of VisState and VisSettings the algorithms use, for a selection covering all of heights
+    state = SimpleNamespace(
+        points=[(0, 0)],
+        selection_pixel_size=(heights.shape[1], heights.shape[0]),
+        selected_area_height_map=heights,
+    )
+    return state, SimpleNamespace(height_map=heights)
+
+
+def equal_height_node_merge(heights):
+    algorithms = load_module("pygame", "algorithms")
+    state, settings = pygame_state(heights)
+
+    def run():
+        algorithms.equal_height_node_merge(state, settings)
+
+    return run, lambda: (int(state.node_labels.max()) + 1, None)
+
+
+def create_graph(heights):
+    algorithms = load_module("pygame", "algorithms")
+    state, settings = pygame_state(heights)
+    algorithms.equal_height_node_merge(state, settings, store_node_movements=False)
+
+    def run():
+        state.graph = algorithms.create_graph(state)
+
+    return run, lambda: region_graph_counts(state.graph.graph)
+
+
+def _pygame_graph_state(heights):
+    algorithms = load_module("pygame", "algorithms")
+    state, settings = pygame_state(heights)
+    algorithms.equal_height_node_merge(state, settings, store_node_movements=False)
+    state.graph = algorithms.create_graph(state)
+    return algorithms, state
+
+
+def calculate_watershed(heights):
+    algorithms, state = _pygame_graph_state(heights)
+
+    def run():
+        algorithms.calculate_watershed(state)
+
+    return run, lambda: region_graph_counts(state.graph.graph)
+
+
+def calculate_flow(heights):
+    algorithms, state = _pygame_graph_state(heights)
+
+    def run():
+        for _ in algorithms.calculate_flow(state, FLOW_CYCLES):
+            pass
+
+    return run, lambda: region_graph_counts(state.graph.graph)
+
+
+# Each kernel takes a height window, does its setup and returns (run, counts). run runs the kernel once
+# and counts gives (nodes, edges) afterwards. For the path kernels these are the points in the node and
+# the path length, edges is None when the kernel doesn't build links
+KERNELS = {
+    "add_segment_to_graph": add_segment_to_graph,
+    "add_segments_to_graph": add_segments_to_graph,
+    "flood_added_segment": flood_added_segment,
+    "find_deep_path": find_deep_path,
+    "find_deep_path_weighted": lambda heights: find_deep_path(heights, weighted=True),
+    "equal_height_node_merge": equal_height_node_merge,
+    "create_graph": create_graph,
+    "calculate_watershed": calculate_watershed,
+    "calculate_flow": calculate_flow,
+}
@@ -0,0 +1,249 @@
+# Peak memory of each stage of tracing a river and of the pygame visualisation
+#
+# python benchmarks/memory.py
+# python benchmarks/memory.py --segments 5 --window 1200 800 --terrain real_hills --output after.json
+# python benchmarks/memory.py --baseline before.json
+#
+# Every stage is measured with tracemalloc, for the peak and the memory still held afterwards, while a
+# thread samples the resident set size of the process. Results are also given per pixel and per node so
+# they can be scaled to bigger areas. With --baseline any stage whose peak grew by more than --tolerance
+# is reported and the exit code is 1. tracemalloc makes the stages many times slower, --rss-only skips it
+# and only samples the resident set size.
+#
+# Run this file as a script rather than with -m. Running from the repository root puts the pygame folder
+# ahead of the pygame library, and the export stage needs the library
+
+import argparse
+import contextlib
+import gc
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+root = Path(__file__).absolute().parent.parent
+sys.path.append(str(root))
+from benchmarks.kernels import load_module, pygame_state
+from benchmarks.terrain import TERRAINS, make_terrain
+
+# The segment size trace.py uses
+SEGMENT_SIZE = 200
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not linux, the peak for the whole process is the best there is
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Highest resident set size seen while running, sampled every interval seconds"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = rss_bytes()
+        self.peak = self.start
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def measure(scenario, stage, run):
+    """Run one stage and return its memory use
+
+    run returns a dict of unit counts, like {"pixels": ..., "nodes": ...}, which the peak and retained
+    memory are divided by. Any other values it returns are kept as they are.
+    """
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    # The algorithms print progress
+    with RssSampler() as rss, contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        values = run()
+    seconds = time.perf_counter() - start
+
+    result = {"scenario": scenario, "stage": stage, "seconds": seconds, "rss_peak_bytes": rss.peak - rss.start}
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        result["peak_bytes"] = peak - before
+        result["retained_bytes"] = current - before
+    else:
+        result["peak_bytes"] = result["rss_peak_bytes"]
+    result.update(values)
+    for unit in ("pixels", "nodes"):
+        if values.get(unit):
+            result[f"peak_bytes_per_{unit[:-1]}"] = result["peak_bytes"] / values[unit]
+            if tracing:
+                result[f"retained_bytes_per_{unit[:-1]}"] = result["retained_bytes"] / values[unit]
+    return result
+
+
+def trace_scenario(heights, num_segments):
+    """Stages of the trace: adding a block of segments one at a time, then flooding them"""
+    algorithms = load_module("trace_river", "algorithms")
+    graph = load_module("trace_river", "graph").Graph()
+    sparse_heights = load_module("trace_river", "sparse_heights").SparseHeights(
+        heights.shape, SEGMENT_SIZE, dtype=heights.dtype
+    )
+    segments = [(row, col) for row in range(num_segments) for col in range(num_segments)]
+    pixels = len(segments) * SEGMENT_SIZE**2
+
+    def add_segments():
+        active_segments = []
+        for segment in segments:
+            active_segments.append(segment)
+            rows = slice(segment[0] * SEGMENT_SIZE, (segment[0] + 1) * SEGMENT_SIZE)
+            cols = slice(segment[1] * SEGMENT_SIZE, (segment[1] + 1) * SEGMENT_SIZE)
+            sparse_heights[rows, cols] = heights[rows, cols]
+            algorithms.add_segment_to_graph(graph, sparse_heights, SEGMENT_SIZE, segment, active_segments)
+        return {"pixels": pixels, "nodes": len(graph)}
+
+    def flood():
+        algorithms.flood_added_segments(graph, sparse_heights, SEGMENT_SIZE, segments, segments)
+        return {"pixels": pixels, "nodes": len(graph)}
+
+    scenario = f"trace {num_segments}x{num_segments} segments"
+    yield measure(scenario, "add_segments", add_segments)
+    yield measure(scenario, "flood", flood)
+
+
+def _pygame_actions():
+    # actions.py uses flat imports from the pygame folder
+    sys.path.insert(0, str(root.joinpath("pygame")))
+    import actions
+
+    return actions
+
+
+def pygame_scenario(heights):
+    """Stages of the visualisation for a selected window: merging, the graph and exporting it"""
+    algorithms = load_module("pygame", "algorithms")
+    state, settings = pygame_state(heights)
+    pixels = heights.size
+
+    def merge():
+        algorithms.equal_height_node_merge(state, settings)
+        return {"pixels": pixels}
+
+    def build_graph():
+        state.graph = algorithms.create_graph(state)
+        return {"pixels": pixels, "nodes": len(state.graph)}
+
+    def export():
+        actions = _pygame_actions()
+        with tempfile.TemporaryDirectory() as folder:
+            working_folder = os.getcwd()
+            os.chdir(folder)
+            try:
+                actions.save_graph(state)
+                file_bytes = os.path.getsize("graph_data.bin")
+            finally:
+                os.chdir(working_folder)
+        return {"nodes": len(state.graph), "file_bytes": file_bytes}
+
+    scenario = f"pygame {heights.shape[1]}x{heights.shape[0]} window"
+    yield measure(scenario, "equal_height_node_merge", merge)
+    yield measure(scenario, "create_graph", build_graph)
+    yield measure(scenario, "save_graph", export)
+
+
+def format_result(result):
+    line = f"{result['scenario']:28} {result['stage']:24} {result['seconds']:>8.2f}s"
+    line += f" {result['peak_bytes'] / 2**20:>8.1f}MB peak"
+    if "retained_bytes" in result:
+        line += f" {result['retained_bytes'] / 2**20:>8.1f}MB held"
+    line += f" {result['rss_peak_bytes'] / 2**20:>8.1f}MB rss"
+    for unit in ("pixel", "node"):
+        if f"peak_bytes_per_{unit}" in result:
+            line += f" {result[f'peak_bytes_per_{unit}']:>8.1f}B/{unit}"
+    return line
+
+
+def compare(results, baseline, tolerance):
+    """Stages whose peak grew by more than tolerance since baseline, as (result, ratio)"""
+    previous = {(i["scenario"], i["stage"]): i for i in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["stage"]))
+        if before is None or not before["peak_bytes"]:
+            continue
+        ratio = result["peak_bytes"] / before["peak_bytes"]
+        print(f"{result['scenario']:28} {result['stage']:24} {ratio:>6.2f}x peak of baseline")
+        if ratio > 1 + tolerance:
+            regressions.append((result, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak memory of the trace and visualisation stages")
+    parser.add_argument("--segments", type=int, default=3, help="trace a square block of this many segments a side")
+    parser.add_argument("--window", type=int, nargs=2, default=(800, 450), help="pygame selection width and height")
+    parser.add_argument("--terrain", default="deep_pits", choices=list(TERRAINS))
+    parser.add_argument("--output", default="memory_results.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed growth in peak memory")
+    parser.add_argument("--rss-only", action="store_true", help="don't trace allocations, much faster")
+    arguments = parser.parse_args()
+
+    trace_heights = make_terrain(arguments.terrain, arguments.segments * SEGMENT_SIZE)
+    width, height = arguments.window
+    window_heights = make_terrain(arguments.terrain, max(width, height))
+    if trace_heights is None or window_heights is None:
+        sys.exit(f"No heights for {arguments.terrain}")
+
+    if not arguments.rss_only:
+        tracemalloc.start()
+    results = []
+    scenarios = (trace_scenario(trace_heights, arguments.segments), pygame_scenario(window_heights[:height, :width]))
+    for result in itertools.chain(*scenarios):
+        print(format_result(result))
+        results.append(result)
+    if not arguments.rss_only:
+        tracemalloc.stop()
+
+    with open(arguments.output, "w") as f:
+        json.dump({"terrain": arguments.terrain, "rss_only": arguments.rss_only, "results": results}, f, indent=2)
+    print(f"Wrote {arguments.output}")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("rss_only", False) != arguments.rss_only:
+            print("Warning: the baseline was measured with a different --rss-only setting")
+        regressions = compare(results, baseline, arguments.tolerance)
+        for result, ratio in regressions:
+            print(f"Regression: {result['scenario']} {result['stage']} peak is {ratio:.2f}x the baseline")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Run every kernel on every terrain and window size and write the results as JSON
+#
+# python -m benchmarks.run
+# python -m benchmarks.run --kernels create_graph calculate_flow --sizes 200 400 --output before.json
+#
+# Each case is set up fresh, timed repeats times without tracing memory, then run once more under
+# tracemalloc for the peak memory and node and edge counts. Cases without data, like real windows when
+# the DEM isn't available, or which a kernel can't run, like windows smaller than a trace segment, are
+# recorded as skipped. A case which raises is recorded as failed and the rest still run
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.kernels import KERNELS, Unsupported
+from benchmarks.terrain import TERRAINS, make_terrain
+
+DEFAULT_SIZES = (100, 200, 400)
+
+
+@contextlib.contextmanager
+def quiet():
+    # The kernels print progress, which would be timed along with them
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def run_case(kernel, heights, repeats):
+    times = []
+    for _ in range(repeats):
+        with quiet():
+            run, _ = KERNELS[kernel](heights.copy())
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+
+    with quiet():
+        run, counts = KERNELS[kernel](heights.copy())
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    nodes, edges = counts()
+    return {
+        "seconds": min(times),
+        "all_seconds": times,
+        "peak_bytes": peak,
+        "nodes": nodes,
+        "edges": edges,
+    }
+
+
+def run_all(kernels, terrains, sizes, repeats=3):
+    """Yield a result dict for every kernel, terrain and size"""
+    for terrain in terrains:
+        for size in sizes:
+            heights = make_terrain(terrain, size)
+            for kernel in kernels:
+                result = {"kernel": kernel, "terrain": terrain, "size": size}
+                if heights is None:
+                    yield {**result, "status": "skipped"}
+                    continue
+                try:
+                    yield {**result, "status": "ok", **run_case(kernel, heights, repeats)}
+                except Unsupported as error:
+                    yield {**result, "status": "skipped", "reason": str(error)}
+                except Exception as error:
+                    yield {**result, "status": "failed", "reason": f"{type(error).__name__}: {error}"}
+
+
+def format_result(result):
+    line = f"{result['kernel']:24} {result['terrain']:14} {result['size']:>5}"
+    if result["status"] != "ok":
+        reason = f" ({result['reason']})" if "reason" in result else ""
+        return f"{line}  {result['status']}{reason}"
+    return (
+        f"{line} {result['seconds'] * 1000:>10.1f}ms {result['peak_bytes'] / 2**20:>8.1f}MB"
+        f" {result['nodes']:>8} nodes {result['edges'] if result['edges'] is not None else '-':>8} edges"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hydrology kernels")
+    parser.add_argument("--kernels", nargs="+", default=list(KERNELS), choices=list(KERNELS))
+    parser.add_argument("--terrains", nargs="+", default=list(TERRAINS), choices=list(TERRAINS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="window sizes in pixels")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs of each case, the fastest is kept")
+    parser.add_argument("--output", default="benchmark_results.json")
+    arguments = parser.parse_args()
+
+    results = []
+    for result in run_all(arguments.kernels, arguments.terrains, arguments.sizes, arguments.repeats):
+        print(format_result(result))
+        results.append(result)
+
+    with open(arguments.output, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "numpy": np.__version__,
+                "machine": platform.platform(),
+                "repeats": arguments.repeats,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote {len(results)} results to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Height windows the kernels are benchmarked on
+# Synthetic terrains are seeded so every run sees the same heights, real windows are cropped from the
+# tasmania DEM when it is available
+
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+
+from riverflow import raster
+
+heights_tif_path = raster.optimized_path(Path(__file__).absolute().parent.parent.joinpath("tasmania", "heights.tif"))
+
+# Centres of real windows, (row, col) in heights.tif. Hilly forest with rivers and a flat coastal plain
+REAL_WINDOWS = {"real_hills": (8850, 20723), "real_plain": (5000, 24000)}
+
+
+def flat_plateaus(size, seed=0):
+    """Terraces of wide equal height plateaus, the worst case for merging equal height nodes"""
+    random = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size] / size
+    slope = 200 * rows + 100 * cols + random.normal(0, 2, (size, size))
+    return (slope // 25 * 25).astype(np.int16)
+
+
+def deep_pits(size, seed=0, num_pits=None):
+    """Rough slope covered in deep pits, the worst case for flooding"""
+    random = np.random.default_rng(seed)
+    if num_pits is None:
+        num_pits = max(size // 10, 1)
+    rows, cols = np.mgrid[0:size, 0:size]
+    heights = 500 + 0.2 * rows + random.integers(0, 8, (size, size))
+    for row, col, radius in zip(
+        random.integers(0, size, num_pits), random.integers(0, size, num_pits), random.integers(3, 15, num_pits)
+    ):
+        distance = np.hypot(rows - row, cols - col)
+        heights = np.where(distance < radius, heights - 10 * (radius - distance), heights)
+    return heights.astype(np.int16)
+
+
+def real_window(size, name):
+    """A size square window of heights.tif, or None when the DEM isn't available"""
+    if not heights_tif_path.exists():
+        return None
+    row, col = REAL_WINDOWS[name]
+    window = rio.windows.Window(col - size // 2, row - size // 2, size, size)
+    with rio.open(heights_tif_path) as dataset:
+        return dataset.read(1, window=window, boundless=True, fill_value=0).astype(np.int16)
+
+
+TERRAINS = {
+    "flat_plateaus": flat_plateaus,
+    "deep_pits": deep_pits,
+    "real_hills": lambda size: real_window(size, "real_hills"),
+    "real_plain": lambda size: real_window(size, "real_plain"),
+}
+
+
+def make_terrain(name, size):
+    return TERRAINS[name](size)
@@ -0,0 +1,130 @@
+# Convert the tasmania rasters into cloud optimized GeoTIFFs
+# The output is tiled in 512 pixel blocks (the block size riverflow.raster caches), deflate
+# compressed and has averaged overviews, so zoomed out reads don't decode full resolution data
+#
+# python cog.py                 writes heights.cog.tif and colour.cog.tif beside the originals
+# python cog.py --report-only   prints the read cost of the current files
+# python cog.py --in-place      replaces the originals with the converted files
+#
+# Everything which reads the rasters goes through riverflow.raster.optimized_path, so uses the .cog.tif
+# copy once it exists
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy
+import rasterio as rio
+from rasterio import shutil as rio_shutil
+from rasterio.enums import Resampling
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow.raster import COG_SUFFIX
+
+data_folder = Path(__file__).absolute().parent.parent.joinpath("tasmania")
+default_files = ("heights.tif", "colour.tif")
+block_size = 512
+
+
+def convert(source_path, output_path):
+    rio_shutil.copy(
+        str(source_path),
+        str(output_path),
+        driver="COG",
+        BLOCKSIZE=block_size,
+        COMPRESS="DEFLATE",
+        PREDICTOR="YES",
+        OVERVIEW_RESAMPLING="AVERAGE",
+        BIGTIFF="IF_SAFER",
+        NUM_THREADS="ALL_CPUS",
+    )
+
+
+def describe(path):
+    with rio.open(path) as dataset:
+        return {
+            "size": f"{dataset.width}x{dataset.height}",
+            "blocks": "x".join(str(i) for i in dataset.block_shapes[0]),
+            "overviews": dataset.overviews(1),
+            "compression": dataset.compression.value if dataset.compression else "none",
+            "file MB": round(os.path.getsize(path) / 2**20, 1),
+        }
+
+
+def read_cost(path, window_size, scale, repeats=5, seed=0):
+    # Median seconds to read a random window_size square window shrunk by scale, from a fresh handle each time
+    random = numpy.random.default_rng(seed)
+    times = []
+    for _ in range(repeats):
+        with rio.open(path) as dataset:
+            size = min(window_size, dataset.width, dataset.height)
+            left = int(random.integers(0, dataset.width - size + 1))
+            top = int(random.integers(0, dataset.height - size + 1))
+            window = rio.windows.Window(left, top, size, size)
+            out_shape = (dataset.count, max(size // scale, 1), max(size // scale, 1))
+            start = time.perf_counter()
+            dataset.read(window=window, out_shape=out_shape, resampling=Resampling.average)
+            times.append(time.perf_counter() - start)
+    return float(numpy.median(times))
+
+
+def report(path):
+    # Full resolution reads like the renderer's, then whole raster reads at zoomed out scales
+    with rio.open(path) as dataset:
+        full_size = max(dataset.width, dataset.height)
+    reads = [(1000, 1), (4000, 4), (full_size, 32), (full_size, 128)]
+    costs = {f"{size}px / {scale}": read_cost(path, size, scale) for size, scale in reads}
+    return describe(path), costs
+
+
+def print_comparison(name, before, after=None):
+    print(f"\n{name}")
+    for label, index in (("layout", 0), ("read ms", 1)):
+        for key, value in before[index].items():
+            if label == "read ms":
+                value = f"{value * 1000:.1f}"
+            line = f"  {label:8} {key:14} {str(value):>20}"
+            if after is not None:
+                after_value = after[index][key]
+                if label == "read ms":
+                    after_value = f"{after_value * 1000:.1f}"
+                line += f" -> {str(after_value):>20}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert rasters to tiled GeoTIFFs with overviews")
+    parser.add_argument("files", nargs="*", default=default_files, help="rasters in the tasmania folder")
+    parser.add_argument("--report-only", action="store_true", help="only print the read cost")
+    parser.add_argument(
+        "--in-place", action="store_true", help=f"replace the original instead of writing <name>{COG_SUFFIX}"
+    )
+    arguments = parser.parse_args()
+
+    for name in arguments.files:
+        path = data_folder.joinpath(name)
+        converted_path = path.with_suffix(COG_SUFFIX)
+        before = report(path)
+        if arguments.report_only:
+            print_comparison(name, before, report(converted_path) if converted_path.exists() else None)
+            continue
+
+        print(f"Converting {name}")
+        # Written under a temporary name so a failed conversion never leaves a partial copy for readers to use
+        temporary_path = path.with_suffix(".tmp" + COG_SUFFIX)
+        convert(path, temporary_path)
+        after = report(temporary_path)
+        if arguments.in_place:
+            os.replace(temporary_path, path)
+            if converted_path.exists():
+                # An older copy beside the original would be read instead of it
+                converted_path.unlink()
+        else:
+            os.replace(temporary_path, converted_path)
+        print_comparison(name, before, after)
+
+
+if __name__ == "__main__":
+    main()
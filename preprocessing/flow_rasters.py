@@ -0,0 +1,37 @@
+# Compute flow direction and flow accumulation rasters for the whole of heights.tif
+# Tiles are processed in parallel, see riverflow/hydrology.py for how they are joined up
+#
+# python flow_rasters.py --workers 8
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import raster
+from riverflow.hydrology import compute_flow_rasters
+
+data_folder = Path(__file__).absolute().parent.parent.joinpath("tasmania")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute flow direction and accumulation rasters")
+    parser.add_argument("--dem", default=str(raster.optimized_path(data_folder.joinpath("heights.tif"))))
+    parser.add_argument("--output", default=str(data_folder), help="folder to write the rasters to")
+    parser.add_argument("--tile-size", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument("--work-folder", default=None, help="where to keep intermediate tiles")
+    arguments = parser.parse_args()
+
+    start = time.time()
+    outputs = compute_flow_rasters(
+        arguments.dem, arguments.output, arguments.tile_size, arguments.workers, arguments.work_folder
+    )
+    for name, path in outputs.items():
+        print(f"{name}: {path}")
+    print(f"Took {time.time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
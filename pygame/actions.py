@@ -4,13 +4,18 @@
 
 import pygame
 from vis_dataclasses import VisState, VisSettings
-from animations import _compute_selection_pixel_size, _draw_line, get_node_centerpoint
+from animations import _compute_selection_pixel_size, _draw_line, _circle_stamps, get_node_centerpoint
+from node_renderer import FLOW_COLOURS, colour_indexes, pixel_centers
 from typing import Generator
 from PIL import Image
 from algorithms import calculate_watershed, calculate_flow
-from matplotlib import cm
 import numpy
 import math
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow.graph_export import export_graph
 
 
 def show_selection_polygon(event, screen, state: VisState, settings: VisSettings) -> Generator:
@@ -72,12 +77,19 @@ def show_selection_polygon(event, screen, state: VisState, settings: VisSettings
             screen.blit(settings.screen_size_height_image, (0, 0))
             yield
 
-def manhattan_dist(a, b):
-    return sum(abs(i-j) for i, j in zip(a, b))
+def _scale_position(position, state):
+    # Screen position in the (x, y) units of node centerpoints
+    return tuple((position[i] - state.center_offset[i]) / state.float_pixel_size[i] for i in (0, 1))
+
+def find_clicked_node(position, state, max_distance=None):
+    # Node closest to a screen position by manhattan distance between centerpoints
+    # With max_distance, in selection pixels, gives None when nothing is that close, which suits hovering
+    # Uses state.node_index, see node_index.py
+    return state.node_index.nearest(_scale_position(position, state), max_distance)
 
-def find_clicked_node(position, state):
-    scaled_location = list((position[i] - state.center_offset[i])/ state.float_pixel_size[i] for i in (0, 1))
-    return min(state.graph, key=lambda node: manhattan_dist(get_node_centerpoint(node), scaled_location))
+def find_selected_nodes(position_1, position_2, state):
+    # Nodes inside the box dragged between two screen positions
+    return state.node_index.in_box(_scale_position(position_1, state), _scale_position(position_2, state))
 
 def animate_watershed(event, screen, state: VisState, settings: VisSettings) -> Generator:
     if event.type == pygame.MOUSEBUTTONDOWN:
@@ -86,7 +98,7 @@ def animate_watershed(event, screen, state: VisState, settings: VisSettings) ->
         source = None
     else:
         return
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
+    stamps = _circle_stamps(state)
     screen.blit(state.pygame_img, (0, 0))
 
     state.node_flows, state.edge_flows = calculate_watershed(state, source=source)
@@ -106,8 +118,8 @@ def animate_watershed(event, screen, state: VisState, settings: VisSettings) ->
 
             j += 1
             circle_center = [int(new_location[i] * state.float_pixel_size[i] + state.center_offset[i]) for i in (0, 1)]
-            colour = [i * 255 for i in cm.gist_heat(flow)[:3]]
-            pygame.draw.circle(screen, colour, circle_center, circle_radius)
+            colour = FLOW_COLOURS[colour_indexes(flow)]
+            screen.blit(stamps.stamp(colour), stamps.position(circle_center))
             if j%20 == 0:
                 yield
     yield
@@ -120,7 +132,7 @@ def animate_flow(event, screen, state: VisState, settings: VisSettings) -> Gener
         source = None
     else:
         return
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
+    stamps = _circle_stamps(state)
     screen.blit(state.pygame_img, (0, 0))
     yield
 
@@ -135,16 +147,11 @@ def animate_flow(event, screen, state: VisState, settings: VisSettings) -> Gener
                     _draw_line(edges_surface, new_location, neighbour_location, state)
 
         circles_surface = pygame.Surface(settings.screen_size, pygame.SRCALPHA, 32).convert_alpha()
-        circle_drawn = False
-        for node, flow in flows.items():
-            if flow != 0:
-                new_location = get_node_centerpoint(node)
-                circle_center = [
-                    int(new_location[i] * state.float_pixel_size[i] + state.center_offset[i]) for i in (0, 1)
-                ]
-                colour = [i * 255 for i in cm.gist_heat(flow)[:3]]
-                pygame.draw.circle(circles_surface, colour, circle_center, circle_radius)
-                circle_drawn = True
+        flowing_nodes = [node for node, flow in flows.items() if flow != 0]
+        centers = pixel_centers([get_node_centerpoint(node) for node in flowing_nodes], state)
+        flow_colours = colour_indexes([flows[node] for node in flowing_nodes])
+        stamps.draw(circles_surface, centers, indexes=flow_colours, table=FLOW_COLOURS)
+        circle_drawn = bool(flowing_nodes)
 
         screen.blit(state.pygame_img, (0, 0))
         screen.blit(edges_surface, (0, 0))
@@ -156,22 +163,7 @@ def animate_flow(event, screen, state: VisState, settings: VisSettings) -> Gener
 
 
 def save_graph(state):
-    # Helper function which saves graph in JSON format
-    def to_list_of_list(tuple_of_tuples):
-        return str([list(i) for i in tuple_of_tuples])
-    
-    import json
-    from animations import get_height_by_key
-
-    data = []
-    for k, v in state.graph.items():
-        data.append({
-            'neighbours': [to_list_of_list(neighbour) for neighbour in v],
-            'key': to_list_of_list(k),
-            'height': int(get_height_by_key(k, state)),
-            'center': get_node_centerpoint(k),
-        })
-
-    assert len({i['key'] for i in data}) == len(data)
-    json.dump(data, open("graph_data.json", "w"), indent=2)
-    print("saved graph")
+    # Helper function which saves the graph as graph_data.npz and graph_data.bin, see riverflow/graph_export.py
+    # Copy graph_data.bin into the website folder for main2.js
+    paths = export_graph(state.graph.graph, "graph_data")
+    print(f"saved graph {', '.join(f'{path} {path.stat().st_size} bytes' for path in paths)}")
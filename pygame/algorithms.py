@@ -1,16 +1,32 @@
 # This file holds the base algorithms which manipulate the graph and do flow simulation
 # It avoids dealing with UI and other concerns
 
-from functools import partial
-from collections import defaultdict
+import sys
+from pathlib import Path
+import numpy
 import tqdm
 
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow.flood import priority_flood
+from riverflow.flow import accumulate, outflow_weights, simulate
+from riverflow.labels import label_equal_heights, region_members
+from riverflow.region_graph import RegionGraph
 
-def check_nodes_equal_height(node_a, node_b, state, settings):
-    return (
-        settings.height_map[state.points[0][1] + node_a[1], state.points[0][0] + node_a[0]]
-        == settings.height_map[state.points[0][1] + node_b[1], state.points[0][0] + node_b[0]]
-    )
+
+def selection_heights(state, settings):
+    # Heights of the selected area indexed by [x, y] to match node coordinates
+    return settings.height_map[
+        state.points[0][1] : state.points[0][1] + state.selection_pixel_size[1],
+        state.points[0][0] : state.points[0][0] + state.selection_pixel_size[0],
+    ].T
+
+
+def _region_keys(labels, num_regions):
+    # Node key for every region, a sorted tuple of (x, y) points
+    order, starts = region_members(labels, num_regions)
+    xs, ys = numpy.divmod(order, labels.shape[1])
+    xs, ys = xs.tolist(), ys.tolist()
+    return [tuple(zip(xs[starts[i] : starts[i + 1]], ys[starts[i] : starts[i + 1]])) for i in range(num_regions)]
 
 
 def equal_height_node_merge(state, settings, store_node_movements=True):
@@ -18,27 +34,13 @@ def equal_height_node_merge(state, settings, store_node_movements=True):
     # The reason for this is to allow flow to cross large flat sections
     # otherwise the water wouldn't know which wat to flow
 
-    from animations import _get_adjacent_nodes
-
-    node_merge_operations = []
-    skip_nodes = set()
-    node_check_func = partial(check_nodes_equal_height, state=state, settings=settings)
-    for x in tqdm.tqdm(range(state.selection_pixel_size[0]), desc='Processing rows for equal height merge'):
-        for y in range(state.selection_pixel_size[1]):
-            if (x, y) not in skip_nodes:
-                height = settings.height_map[state.points[0][1] + y, state.points[0][0] + x]
-
-                visited, queue = set(), [(x, y)]
-                while queue:
-                    vertex = queue.pop(0)
-                    if vertex not in visited:
-                        visited.add(vertex)
-                        queue.extend(set(_get_adjacent_nodes(vertex, state, node_check_func)) - visited - skip_nodes)
-
-                if visited != {(x, y)}:
-                    node_merge_operations.append(visited)
-                    for node in visited:
-                        skip_nodes.add(node)
+    state.node_labels, num_regions = label_equal_heights(selection_heights(state, settings))
+    node_merge_operations = [
+        set(key)
+        for key in tqdm.tqdm(_region_keys(state.node_labels, num_regions), desc="Collecting equal height regions")
+        if len(key) > 1
+    ]
+    skip_nodes = {node for merging_nodes in node_merge_operations for node in merging_nodes}
 
     if not store_node_movements:
         return None, skip_nodes, node_merge_operations
@@ -54,35 +56,14 @@ def equal_height_node_merge(state, settings, store_node_movements=True):
     return node_movements, skip_nodes, node_merge_operations
 
 
-def create_graph(node_merge_operations, skip_nodes, non_skip_nodes, state):
-    from animations import _get_adjacent_nodes
-
-    # For every original position
-    # Lookup the current positions new key
+def create_graph(state):
+    # Every region labelled by equal_height_node_merge becomes a node
+    # Regions which touch along an edge are linked in both directions
+    # The graph is held in arrays and shown as a dict of (x, y) tuple keys
 
-    # Loop through the adjacent nodes
-    # Find the new keys for those adjacent nodes
-
-    # Filter out all adjacent nodes which have the same key as the current node
-    # Add an edge to the adjacent new nodes
-
-    graph = defaultdict(list)
-    new_key = {}
-    for merging_nodes in tqdm.tqdm(node_merge_operations, desc='Creating new merged nodes'):
-        sorted_merging_nodes = tuple(sorted(merging_nodes))
-        for node in merging_nodes:
-            new_key[node] = sorted_merging_nodes
-
-    for node in tqdm.tqdm(sorted(list(skip_nodes) + non_skip_nodes), desc='Processing other nodes'):
-        node_key = new_key.get(node, (node,))
-
-        adjacent_nodes = _get_adjacent_nodes(node, state)
-        for adjacent_node in adjacent_nodes:
-            adjacent_node_key = new_key.get(adjacent_node, (adjacent_node,))
-            if adjacent_node_key != node_key:
-                graph[node_key].append(adjacent_node_key)
-
-    return dict(graph)
+    labels = numpy.ascontiguousarray(state.node_labels.T)
+    graph = RegionGraph.from_labels(labels, state.selected_area_height_map)
+    return graph.view(xy=True)
 
 
 def get_height_by_key(key, state):
@@ -115,66 +96,69 @@ def find_low_nodes(graph, state):
     return low_nodes
 
 
-def calculate_watershed(state, source=None):
-    if source:
-        node_flows = defaultdict(float)
-        node_flows[source] = 1
-    else:
-        node_flows = {key: len(key) for key in state.graph}
+def find_lakes(state):
+    # Fill the selected area with one priority flood
+    # Returns each lake with the equal height points around it as (lake_height, points), lowest first
+    filled, lake_ids = priority_flood(state.selected_area_height_map)
+    regions, num_regions = label_equal_heights(filled)
+    order, starts = region_members(regions, num_regions)
+    ys, xs = numpy.divmod(order, regions.shape[1])
+    xs, ys = xs.tolist(), ys.tolist()
 
-    for node in sorted(state.graph, key=lambda node: get_height_by_key(node, state), reverse=True):
-        if source is not None and node_flows[source] == 0:
-            continue
-        if node_flows[node] == 0:
-            continue
+    lakes = []
+    for region in numpy.unique(regions[lake_ids >= 0]).tolist():
+        points = list(zip(xs[starts[region] : starts[region + 1]], ys[starts[region] : starts[region + 1]]))
+        lakes.append((filled.ravel()[order[starts[region]]], points))
+    return sorted(lakes, key=lambda lake: lake[0])
 
-        node_height = get_height_by_key(node, state)
-        if not any(does_node_touch_border(i, state) for i in node):
 
-            outflows = []
-            for neighbour in state.graph[node]:
-                neighbour_height = get_height_by_key(neighbour, state)
-                if neighbour_height < node_height:
-                    outflows.append((neighbour, node_height - neighbour_height))
-            assert outflows, "Every node should have an outflow direction"
+def _compact_inflow(state, source_point=None):
+    # The compacted graph of state.graph and the water each node starts with
+    # With a source_point only the node holding that (x, y) point starts with water, otherwise every node
+    # starts with one unit per point
+    graph = state.graph.graph
+    compact = graph.compacted()
+    if source_point is None:
+        return compact, compact.sizes
+    inflow = numpy.zeros(len(compact.nodes))
+    inflow[numpy.searchsorted(compact.nodes, graph.node_of(source_point[::-1]))] = 1
+    return compact, inflow
 
-            # Only send flow in multiple directions if it's fairly even. Try to avoid tiny fractional flows
-            largest_outflow_height = max(i[1] for i in outflows)
-            outflow_height_threshold = largest_outflow_height / 2
-            total_outflow_height = sum(i[1] for i in outflows if i[1] > outflow_height_threshold)
-            for neighbour, outflow_height in outflows:
-                if outflow_height > outflow_height_threshold:
-                    node_flows[neighbour] += node_flows[node] * outflow_height / total_outflow_height
 
-    return node_flows, None
+def _flows_by_key(state, compact, flows):
+    # Nonzero flows as a dict keyed by node key
+    nonzero = numpy.flatnonzero(flows)
+    return {state.graph.key(node): flow for node, flow in zip(compact.nodes[nonzero].tolist(), flows[nonzero].tolist())}
 
-def calculate_flow(state, num_cycles, source=None):
+
+def watershed_flows(state, source_point=None):
+    # Flow through every node of state.graph, as arrays over the compacted graph
+    compact, inflow = _compact_inflow(state, source_point)
+
+    # Only send flow in multiple directions if it's fairly even. Try to avoid tiny fractional flows
+    outflows = outflow_weights(compact.heights, compact.indptr, compact.indices, compact.border, split_threshold=0.5)
+    return compact, accumulate(compact.heights, outflows, inflow)
+
+
+def calculate_watershed(state, source=None):
+    compact, flows = watershed_flows(state, source_point=source[0] if source else None)
     if source:
-        node_flows = {source: 1}
-    else:
-        node_flows = {key: len(key) for key in state.graph}
-
-    yield node_flows
-
-    for i in range(num_cycles):
-        sorted_nodes = sorted(node_flows, key=lambda node: get_height_by_key(node, state))
-        for node in sorted_nodes:
-            node_height = get_height_by_key(node, state)
-            if not any(does_node_touch_border(i, state) for i in node):
-                outflows = []
-                for neighbour in state.graph[node]:
-                    neighbour_height = get_height_by_key(neighbour, state)
-                    if neighbour_height < node_height:
-                        outflows.append((neighbour, node_height - neighbour_height))
-                assert outflows
-
-                total_outflow_height = sum(i[1] for i in outflows)
-                for neighbour, outflow_height in outflows:
-                    if neighbour in node_flows:
-                        node_flows[neighbour] += node_flows[node] * outflow_height / total_outflow_height
-                    else:
-                        node_flows[neighbour] = node_flows[node] * outflow_height / total_outflow_height
-            del node_flows[node]
-            if not node_flows:
-                break
-        yield node_flows
+        return _flows_by_key(state, compact, flows), None
+    return {state.graph.key(node): flow for node, flow in zip(compact.nodes.tolist(), flows.tolist())}, None
+
+
+def calculate_flow(state, num_cycles, source=None):
+    # Every cycle each node passes all its water to its lower neighbours in proportion to the height drop
+    # Water reaching the border leaves the area. Yields the nonzero flows by node key after each cycle
+    compact, inflow = _compact_inflow(state, source_point=source[0] if source else None)
+    outflows = outflow_weights(compact.heights, compact.indptr, compact.indices, compact.border)
+    for flows in simulate(outflows, inflow, num_cycles):
+        yield _flows_by_key(state, compact, flows)
+
+
+def steady_state_flow(state, source=None):
+    # Flow through each node when water is added at the same rate forever, which is the sum of every cycle
+    # calculate_flow would yield. Solved directly in one sweep from the highest node down
+    compact, inflow = _compact_inflow(state, source_point=source[0] if source else None)
+    outflows = outflow_weights(compact.heights, compact.indptr, compact.indices, compact.border)
+    return _flows_by_key(state, compact, accumulate(compact.heights, outflows, inflow))
@@ -7,11 +7,12 @@ from typing import Generator
 from random import randint
 import pygame
 from matplotlib import cm
-from algorithms import equal_height_node_merge, create_graph, find_low_nodes
-import heapq
+from algorithms import equal_height_node_merge, create_graph, find_low_nodes, find_lakes
 from functools import lru_cache
 import numpy
 from PIL import Image
+from node_renderer import CircleStamps, GraphLayer, HEIGHT_COLOURS, pixel_centers
+from node_index import NodeIndex
 
 
 @lru_cache(maxsize=10000)
@@ -19,9 +20,14 @@ def get_node_centerpoint(node):
     return (sum(x for x, _ in node) / len(node), sum(y for _, y in node) / len(node))
 
 
-@lru_cache(maxsize=4000)
-def get_colour_by_height(height):
-    return [i * 255 for i in cm.gist_earth(height / 255)[:3]]
+def _circle_stamps(state, scale=0.35):
+    return CircleStamps(int(max(*state.float_pixel_size) * scale))
+
+
+def _normalised_heights(state):
+    # Heights of the selected area scaled from 0 to 255, indexed [y, x]
+    height_array = state.selected_area_height_map - state.selected_area_height_map.min()
+    return (height_array // (height_array.max() / 255)).astype("int32")
 
 
 def starting_image(screen, state: VisState, settings: VisSettings) -> Generator:
@@ -126,31 +132,27 @@ def scale_up_selection(screen, state: VisState, settings: VisSettings) -> Genera
 
 
 def _draw_circles(surface, state, settings, skipped_coordinates=None, absolute_scale=True, set_colour=None):
-    skipped_coordinates = skipped_coordinates or []
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
+    skipped_coordinates = skipped_coordinates or set()
+    points = numpy.array(
+        [
+            (x, y)
+            for x in range(state.selection_pixel_size[0])
+            for y in range(state.selection_pixel_size[1])
+            if (x, y) not in skipped_coordinates
+        ],
+        dtype=numpy.int64,
+    ).reshape(-1, 2)
+    stamps = _circle_stamps(state)
+    if set_colour:
+        stamps.draw(surface, pixel_centers(points, state), set_colour)
+        return
+
     if absolute_scale:
         height_array = (settings.height_map // (settings.height_map.max() / 255)).astype("int32")
+        heights = height_array[state.points[0][1] + points[:, 1], state.points[0][0] + points[:, 0]]
     else:
-        height_array = state.selected_area_height_map - state.selected_area_height_map.min()
-        height_array = (height_array // (height_array.max() / 255)).astype("int32")
-
-    for x in range(state.selection_pixel_size[0]):
-        for y in range(state.selection_pixel_size[1]):
-            if (x, y) not in skipped_coordinates:
-                if absolute_scale:
-                    height = height_array[state.points[0][1] + y, state.points[0][0] + x]
-                else:
-                    height = height_array[y, x]
-                colour = set_colour or get_colour_by_height(height)
-                pygame.draw.circle(
-                    surface,
-                    colour,
-                    (
-                        int(x * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(y * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                )
+        heights = _normalised_heights(state)[points[:, 1], points[:, 0]]
+    stamps.draw(surface, pixel_centers(points, state), indexes=heights)
 
 
 def add_circles(screen, state: VisState, settings: VisSettings) -> Generator:
@@ -200,9 +202,9 @@ def _draw_line(surface, from_node, to_node, state):
 
 
 def add_edges(screen, state: VisState, settings: VisSettings) -> Generator:
-    height_array = state.selected_area_height_map - state.selected_area_height_map.min()
-    height_array = (height_array // (height_array.max() / 255)).astype("int32")
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
+    height_array = _normalised_heights(state)
+    stamps = _circle_stamps(state)
+    ys = numpy.arange(state.selection_pixel_size[1])
     for x in range(state.selection_pixel_size[0]):
         for y in range(state.selection_pixel_size[1]):
             if x > 0:
@@ -211,26 +213,10 @@ def add_edges(screen, state: VisState, settings: VisSettings) -> Generator:
                 _draw_line(screen, (x, y), (x, y - 1), state)
 
         if x > 0:
-            for y in range(state.selection_pixel_size[1]):
-                colour = get_colour_by_height(height_array[y, x])
-                pygame.draw.circle(
-                    screen,
-                    colour,
-                    (
-                        int((x - 1) * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(y * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                )
-                pygame.draw.circle(
-                    screen,
-                    colour,
-                    (
-                        int(x * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(y * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                )
+            # Redraw the circles the new lines were drawn over, each coloured by its own height
+            columns = numpy.repeat([x - 1, x], len(ys))
+            points = numpy.stack([columns, numpy.tile(ys, 2)], axis=1)
+            stamps.draw(screen, pixel_centers(points, state), indexes=height_array[points[:, 1], points[:, 0]])
         yield
 
 
@@ -250,7 +236,8 @@ def merge_equal_height_nodes(screen, state: VisState, settings: VisSettings) ->
         for y in range(state.selection_pixel_size[1])
         if (x, y) not in skip_nodes
     ]
-    state.graph = create_graph(node_merge_operations, skip_nodes, non_skip_nodes, state)
+    state.graph = create_graph(state)
+    state.node_index = NodeIndex.from_centers((node, get_node_centerpoint(node)) for node in state.graph)
 
     non_skip_nodes_set = set(non_skip_nodes)
     for from_node in non_skip_nodes_set:
@@ -262,47 +249,38 @@ def merge_equal_height_nodes(screen, state: VisState, settings: VisSettings) ->
     _draw_circles(state.circles_surface, state, settings, skip_nodes, absolute_scale=False)
 
     num_steps = 60
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
-    height_array = state.selected_area_height_map - state.selected_area_height_map.min()
-    height_array = (height_array // (height_array.max() / 255)).astype("int32")
-
-    def get_updated_node_position(node, new_position, progress):
-        x = node[0] + i / num_steps * (new_position[0] - node[0])
-        y = node[1] + i / num_steps * (new_position[1] - node[1])
-        return x, y
+    stamps = _circle_stamps(state)
+    height_array = _normalised_heights(state)
+
+    # Every line from a moving node to its neighbours, as start and end positions before and after moving
+    # Lines between two moving nodes are only drawn once
+    moving_nodes = list(node_movements)
+    line_nodes = [
+        (node, adjacent_node)
+        for node in moving_nodes
+        for adjacent_node in _get_adjacent_nodes(node, state, lambda x, y: x < y or y not in skip_nodes)
+    ]
+    line_starts = numpy.array([node for node, _ in line_nodes], dtype=numpy.float64).reshape(-1, 2)
+    line_ends = numpy.array([node for _, node in line_nodes], dtype=numpy.float64).reshape(-1, 2)
+    line_start_moves = numpy.array([node_movements[node] for node, _ in line_nodes]).reshape(-1, 2) - line_starts
+    line_end_moves = numpy.array(
+        [node_movements.get(node, node) for _, node in line_nodes], dtype=numpy.float64
+    ).reshape(-1, 2) - line_ends
+    node_starts = numpy.array(moving_nodes, dtype=numpy.float64).reshape(-1, 2)
+    node_moves = numpy.array([node_movements[node] for node in moving_nodes]).reshape(-1, 2) - node_starts
+    node_heights = height_array[node_starts[:, 1].astype(int), node_starts[:, 0].astype(int)]
 
     for i in range(1, num_steps + 1):
         screen.fill((0, 0, 0))
         moving_circles_surface = pygame.Surface(settings.screen_size, pygame.SRCALPHA, 32).convert_alpha()
 
-        for node, new_position in node_movements.items():
-            adjacent_nodes = _get_adjacent_nodes(node, state, lambda x, y: x < y or x in skip_nodes)
-            for adjacent_node in adjacent_nodes:
-                if adjacent_node in skip_nodes:
-                    adjacent_node_position = get_updated_node_position(
-                        adjacent_node, node_movements[adjacent_node], i / num_steps
-                    )
-                else:
-                    adjacent_node_position = adjacent_node
-                _draw_line(
-                    moving_circles_surface,
-                    get_updated_node_position(node, new_position, i / num_steps),
-                    adjacent_node_position,
-                    state,
-                )
-
-        for node, new_position in node_movements.items():
-            current_x, current_y = get_updated_node_position(node, new_position, i / num_steps)
-            colour = get_colour_by_height(height_array[node[1], node[0]])
-            pygame.draw.circle(
-                moving_circles_surface,
-                colour,
-                (
-                    int(current_x * state.float_pixel_size[0] + state.center_offset[0]),
-                    int(current_y * state.float_pixel_size[1] + state.center_offset[1]),
-                ),
-                circle_radius,
-            )
+        starts = pixel_centers(line_starts + i / num_steps * line_start_moves, state).T.tolist()
+        ends = pixel_centers(line_ends + i / num_steps * line_end_moves, state).T.tolist()
+        for start_x, start_y, end_x, end_y in zip(*starts, *ends):
+            pygame.draw.line(moving_circles_surface, (255, 255, 255), (start_x, start_y), (end_x, end_y), 1)
+
+        centers = pixel_centers(node_starts + i / num_steps * node_moves, state)
+        stamps.draw(moving_circles_surface, centers, indexes=node_heights)
 
         screen.blit(moving_circles_surface, (0, 0))
         screen.blit(state.circles_surface, (0, 0))
@@ -314,272 +292,124 @@ def get_height_by_key(key, state):
 
 
 def highlight_low_nodes(screen, state: VisState, settings: VisSettings) -> Generator:
-    circle_radius = int(max(*state.float_pixel_size) * 0.37)
-    print(f"circle_radius = {circle_radius}")
+    stamps = _circle_stamps(state, 0.37)
+    print(f"circle_radius = {stamps.radius}")
 
     state.low_nodes = find_low_nodes(state.graph, state)
     print(f"Found {len(state.low_nodes)} low nodes")
 
-    for low_node in state.low_nodes:
-        new_location = get_node_centerpoint(low_node)
-        pygame.draw.circle(
-            screen,
-            (255, 0, 0),
-            (
-                int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-            ),
-            circle_radius,
-            min(circle_radius, 3),
-        )
+    centers = pixel_centers([get_node_centerpoint(low_node) for low_node in state.low_nodes], state)
+    stamps.draw(screen, centers, (255, 0, 0), width=min(stamps.radius, 3))
     state.low_nodes = sorted(state.low_nodes, key=lambda key: get_height_by_key(key, state))
     yield
 
 
 def flood_points(screen, state: VisState, settings: VisSettings) -> Generator:
     """
-    Highlight all the neighbours (and add them to a priority queue).
+    Fill every lake with one priority flood of the selected area.
+
+    Loop through the lakes from lowest to highest;
+        Highlight the nodes which merge into the lake
+        Highlight the neighbours, green if the lake spills into them
+        Merge the nodes into one node
 
-    Loop through the priority queue;
-        Check if the node is lower than the lake
-        Merge the node with the lake
-        Add the other neighbours to the priority queue
+    The graph stays drawn on a GraphLayer and only the area around each lake is redrawn, so frames yield the
+    rectangles of the screen which changed. Colours keep the height scale of the selection before flooding.
     """
 
-    def does_node_touch_border(node):
-        if node[0] == 0:
-            return True
-        if node[1] == 0:
-            return True
-        if node[0] == state.selection_pixel_size[0] - 1:
-            return True
-        if node[1] == state.selection_pixel_size[1] - 1:
-            return True
-        return False
-
-    circle_radius = int(max(*state.float_pixel_size) * 0.35)
+    stamps = _circle_stamps(state)
+    low_nodes = set(state.low_nodes)
+    lowest_height = int(state.selected_area_height_map.min())
+    height_step = (int(state.selected_area_height_map.max()) - lowest_height) / 255 or 1
+
+    def node_colour(height):
+        return HEIGHT_COLOURS[int((int(height) - lowest_height) // height_step)]
+
+    layer = GraphLayer(settings.screen_size, stamps)
+    nodes = list(state.graph.keys())
+    centers = pixel_centers([get_node_centerpoint(node) for node in nodes], state).tolist()
+    for node, center in zip(nodes, centers):
+        ring_colour = (255, 0, 0) if node in low_nodes else None
+        layer.add_node(node, center, node_colour(get_height_by_key(node, state)), ring_colour)
+    for node in nodes:
+        for neighbour in state.graph[node]:
+            if neighbour < node:
+                layer.add_edge(node, neighbour)
+    layer.redraw()
+    screen.blit(layer.surface, (0, 0))
     if not state.low_nodes:
         yield
 
-    for low_node in state.low_nodes:
-        if low_node not in state.graph:
-            continue
-
-        lake_height = get_height_by_key(low_node, state)
-        for neighbour in state.graph[low_node]:
-            if get_height_by_key(neighbour, state) < lake_height:
-                continue
-
-        queue = [(lake_height, low_node)]
-        nodes_in_queue = {low_node}
-        merging_nodes = {low_node}
-
-        while True:
-            try:
-                node_height, node = heapq.heappop(queue)
-            except IndexError:
-                print("heap ran out of items but it shouldn't")
-                break
-
-            new_location = get_node_centerpoint(node)
-            if node_height < lake_height:
-                pygame.draw.circle(
-                    screen,
-                    (0, 255, 0),
-                    (
-                        int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                    min(circle_radius, 3),
-                )
-                break
-            lake_height = node_height
-            merging_nodes.add(node)
-
-            # If node is a border then this means the flow can go off the edge. merging should stop after this node
-            if any(does_node_touch_border(i) for i in node):
-                pygame.draw.circle(
-                    screen,
-                    (0, 255, 0),
-                    (
-                        int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                    min(circle_radius, 3),
-                )
-                break
-
-            pygame.draw.circle(
-                screen,
-                (255, 0, 0),
-                (
-                    int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                    int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                ),
-                circle_radius,
-                min(circle_radius, 3),
-            )
-
-            for adjacent_node in state.graph[node]:
-                if adjacent_node not in nodes_in_queue:
-                    new_location = get_node_centerpoint(adjacent_node)
-                    pygame.draw.circle(
-                        screen,
-                        (255, 165, 0),
-                        (
-                            int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                            int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                        ),
-                        circle_radius,
-                        min(circle_radius, 3),
-                    )
-                    nodes_in_queue.add(adjacent_node)
-                    heapq.heappush(queue, (get_height_by_key(adjacent_node, state), adjacent_node))
-            yield
-
-        # Add all equal height nodes
-        while True:
-            try:
-                node_height, node = heapq.heappop(queue)
-            except IndexError:
-                break
-
-            # Don't merge the outflow points to the lake
-            if node_height < lake_height:
-                continue
-            elif node_height == lake_height:
-                # Merge this
-                merging_nodes.add(node)
-                new_location = get_node_centerpoint(node)
-                pygame.draw.circle(
-                    screen,
-                    (255, 0, 0),
-                    (
-                        int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                    min(circle_radius, 3),
-                )
-
-                for adjacent_node in state.graph[node]:
-                    if adjacent_node not in nodes_in_queue:
-                        new_location = get_node_centerpoint(adjacent_node)
-                        pygame.draw.circle(
-                            screen,
-                            (255, 165, 0),
-                            (
-                                int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                                int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                            ),
-                            circle_radius,
-                            min(circle_radius, 3),
-                        )
-                        nodes_in_queue.add(adjacent_node)
-                        heapq.heappush(queue, (get_height_by_key(adjacent_node, state), adjacent_node))
-                yield
+    changed_rects = []
+    for lake_height, lake_points in find_lakes(state):
+        merging_nodes = {state.graph.node_of(point) for point in lake_points}
+        lake_neighbours = {
+            neighbour for node in merging_nodes for neighbour in state.graph[node] if neighbour not in merging_nodes
+        }
+
+        highlighted_nodes = list(merging_nodes | lake_neighbours)
+        colours = []
+        for node in highlighted_nodes:
+            if node in merging_nodes:
+                colours.append((255, 0, 0))
+            elif get_height_by_key(node, state) < lake_height:
+                colours.append((0, 255, 0))
             else:
-                break
+                colours.append((255, 165, 0))
+        centers = [layer.nodes[node][0] for node in highlighted_nodes]
+        stamps.draw(screen, centers, colours, width=layer.ring_width)
+        yield changed_rects + [layer.node_rect(node) for node in highlighted_nodes]
 
-        merged_node_key = tuple(sorted({node for node_key in merging_nodes for node in node_key}))
-        neighbours = {node for merging_node in merging_nodes for node in state.graph[merging_node]} - set(
+        merging_neighbours = {merging_node: set(state.graph[merging_node]) for merging_node in merging_nodes}
+        neighbours = {node for merging_node in merging_nodes for node in merging_neighbours[merging_node]} - set(
             merging_nodes
         )
-        for neighbour in neighbours:
-            updated_neighbours = set(state.graph[neighbour]) - merging_nodes
-            updated_neighbours.add(merged_node_key)
-            state.graph[neighbour] = tuple(sorted(updated_neighbours))
-        state.graph[merged_node_key] = tuple(sorted(neighbours))
+        merged_node_key = state.graph.merge(merging_nodes)
         state.selected_area_height_map[merged_node_key[0][1], merged_node_key[0][0]] = lake_height
 
-        # Find all the nodes don't touch the merged area
-        untouched_nodes = state.graph.keys() - {merged_node_key} - set(merging_nodes)
-        untouched_surface = pygame.Surface(settings.screen_size, pygame.SRCALPHA, 32).convert_alpha()
-
-        height_array = state.selected_area_height_map - state.selected_area_height_map.min()
-        height_array = (height_array // (height_array.max() / 255)).astype("int32")
-
-        for node in untouched_nodes:
-            new_location = get_node_centerpoint(node)
-            for neighbour in state.graph[node]:
-                if neighbour < node:
-                    neighbour_location = get_node_centerpoint(neighbour)
-                    _draw_line(untouched_surface, new_location, neighbour_location, state)
-
-        for node in untouched_nodes:
-            new_location = get_node_centerpoint(node)
-            height = height_array[node[0][1], node[0][0]]
-            colour = get_colour_by_height(height)
-            pygame.draw.circle(
-                untouched_surface,
-                colour,
-                (
-                    int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                    int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                ),
-                circle_radius,
-            )
-            if node in state.low_nodes:
-                pygame.draw.circle(
-                    untouched_surface,
-                    (255, 0, 0),
-                    (
-                        int(new_location[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(new_location[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                    min(circle_radius, 3),
-                )
+        # Take the merging nodes and their edges off the layer, everything else stays drawn
+        moving_nodes = list(merging_nodes)
+        moving_colours = [layer.nodes[node][1] for node in moving_nodes]
+        dirty_rects = [layer.remove_node(node) for node in moving_nodes]
+        dirty_rects += [layer.node_rect(node) for node in neighbours]
+        lake_rect = layer.redraw(dirty_rects[0].unionall(dirty_rects[1:]))
 
         num_steps = 60
         new_location = get_node_centerpoint(merged_node_key)
+        moving_starts = numpy.array([get_node_centerpoint(node) for node in moving_nodes]).reshape(-1, 2)
+        edge_neighbours = [
+            (i, neighbour)
+            for i, node in enumerate(moving_nodes)
+            for neighbour in merging_neighbours[node]
+            if neighbour not in merging_nodes
+        ]
+        neighbour_centers = [layer.nodes[neighbour][0] for _, neighbour in edge_neighbours]
+        neighbour_colours = [layer.nodes[neighbour][1] for _, neighbour in edge_neighbours]
         for i in range(1, num_steps + 1):
-            screen.fill((0, 0, 0))
-            screen.blit(untouched_surface, (0, 0))
-            for original_node in merging_nodes:
-                original_node_position = (
-                    sum(x for x, y in original_node) / len(original_node),
-                    sum(y for x, y in original_node) / len(original_node),
-                )
-                actual_node_position = (
-                    (new_location[0] - original_node_position[0]) * i / num_steps + original_node_position[0],
-                    (new_location[1] - original_node_position[1]) * i / num_steps + original_node_position[1],
-                )
-                for neighbour in state.graph[original_node]:
-                    if neighbour not in merging_nodes:
-                        neighbour_position = get_node_centerpoint(neighbour)
-                        # Move edge from to position
-                        _draw_line(screen, neighbour_position, actual_node_position, state)
-
-                        height = height_array[neighbour[0][1], neighbour[0][0]]
-                        colour = get_colour_by_height(height)
-                        pygame.draw.circle(
-                            screen,
-                            colour,
-                            (
-                                int(neighbour_position[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                                int(neighbour_position[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                            ),
-                            circle_radius,
-                        )
-
-                height = height_array[original_node[0][1], original_node[0][0]]
-                colour = get_colour_by_height(height)
-                pygame.draw.circle(
-                    screen,
-                    colour,
-                    (
-                        int(actual_node_position[0] * state.float_pixel_size[0] + state.center_offset[0]),
-                        int(actual_node_position[1] * state.float_pixel_size[1] + state.center_offset[1]),
-                    ),
-                    circle_radius,
-                )
-            yield
-
-        for merging_node in merging_nodes:
-            del state.graph[merging_node]
+            # Everything which moves stays between the lake's nodes and their neighbours
+            screen.blit(layer.surface, lake_rect, lake_rect)
+            moving_centers = pixel_centers((new_location - moving_starts) * i / num_steps + moving_starts, state)
+            # Move edge from to position
+            for (node_index, _), neighbour_center in zip(edge_neighbours, neighbour_centers):
+                pygame.draw.line(screen, (255, 255, 255), neighbour_center, moving_centers[node_index].tolist(), 1)
+            stamps.draw(screen, neighbour_centers, neighbour_colours)
+            stamps.draw(screen, moving_centers, moving_colours)
+            yield [lake_rect]
+
+        state.node_index.merge(merging_nodes, merged_node_key, new_location)
+
+        merged_center = pixel_centers(new_location, state)[0].tolist()
+        merged_rect = layer.add_node(merged_node_key, merged_center, node_colour(lake_height))
+        for neighbour in neighbours:
+            merged_rect.union_ip(layer.add_edge(merged_node_key, neighbour))
+        merged_rect = layer.redraw(merged_rect)
+        screen.blit(layer.surface, merged_rect, merged_rect)
+        # Shown with the next frame
+        changed_rects = [merged_rect]
+
+    if changed_rects:
+        yield changed_rects
+
 
 def show_only_true_colour(screen, state: VisState, settings: VisSettings) -> Generator:
     state.pygame_img = settings.image_loader_func(
@@ -1,9 +1,8 @@
 import pygame
 import numpy
 from matplotlib import cm
-from algorithms import calculate_watershed
+from algorithms import watershed_flows
 from flow_dataclasses import write_colour_to_screen
-from tqdm import tqdm
 
 
 def show_selection_polygon(event, screen, state, settings):
@@ -67,32 +66,19 @@ def show_selection_polygon(event, screen, state, settings):
 
 def animate_watershed(event, screen, state, settings):
     if event.type == pygame.MOUSEBUTTONDOWN:
-        source = (pygame.mouse.get_pos(),)
+        source_point = pygame.mouse.get_pos()
     elif event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
-        source = None
+        source_point = None
     else:
         return
 
     screen.fill((0,0,0))
 
-    state.node_flows, _ = calculate_watershed(state, source=source)
-    state.node_flow_items = list(state.node_flows.items())
-    numpy_image = numpy.zeros((settings.screen_size[1], settings.screen_size[0], 3), dtype=numpy.uint8)
-
-    print(f"Num pixels to process {len(state.node_flow_items)}")
-
-    for i in tqdm(range(len(state.node_flow_items)), desc="processing pixels"):
-        node, flow = state.node_flow_items[i]
-        colour = [int(i * 255) for i in cm.gist_heat(flow)[:3]]
-        # print(node)
-        # print(flow)
-        # print(colour)
-        for point in node:
-            numpy_image[point[1], point[0]] = colour
-        if i%20 == 0:
-            # print("Updating screen")
-            write_colour_to_screen(screen, numpy_image)
-            yield
+    state.compact_graph, state.node_flows = watershed_flows(state, source_point=source_point)
+
+    # Colour each node by its flow, then paint every point with the colour of its node
+    colours = (cm.gist_heat(state.node_flows)[:, :3] * 255).astype(numpy.uint8)
+    numpy_image = colours[state.compact_graph.labels]
 
     write_colour_to_screen(screen, numpy_image)
     yield
@@ -3,10 +3,17 @@ from pathlib import Path
 from typing import Tuple
 from dataclasses import dataclass
 from PIL import Image
+import sys
 import pygame
 import numpy as np
 import rasterio as rio
 
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import raster
+
+colour_tif_path = str(raster.optimized_path(Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour.tif")))
+heights_tif_path = str(raster.optimized_path(Path(__name__).absolute().parent.parent.joinpath("tasmania", "heights.tif")))
+
 
 def pil_image_to_surface(im):
     return pygame.image.fromstring(im.tobytes(), im.size, im.mode)
@@ -32,6 +39,15 @@ def calculate_scale_ratio(screen_size, image):
     )
 
 
+def load_small_colour_image(screen_size):
+    # The whole colour image shrunk to about screen size, read from the overviews of colour.tif
+    path = colour_tif_path
+    dataset = raster.open_dataset(path)
+    scale = max(1, min(dataset.width // screen_size[0], dataset.height // screen_size[1]))
+    w = rio.windows.Window(0, 0, dataset.width, dataset.height)
+    return Image.fromarray(raster.read_scaled(path, w, scale, bands=(1, 2, 3)).astype(np.uint8))
+
+
 class VisSettings:
     def __init__(
         self,
@@ -42,8 +58,8 @@ class VisSettings:
     ):
         print("Loading data...")
         self.screen_size = screen_size
-        self.pil_colour_image = load_image_file_zipped(str(Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour.tif")))
-        self.pil_small_colour_image = load_image_file_zipped(str(Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour_small.png")))
+        self.pil_colour_image = load_image_file_zipped(colour_tif_path)
+        self.pil_small_colour_image = load_small_colour_image(self.screen_size)
 
         self.full_size_dimensions = self.pil_colour_image.size
         self.scale_ratio = calculate_scale_ratio(self.screen_size, self.pil_colour_image)
@@ -61,25 +77,21 @@ class VisSettings:
 
     def get_image_window(self, left, top, mode="colour"):
         if mode=="colour":
-            path = str(Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour.tif"))
+            path = colour_tif_path
+        else:
+            path = heights_tif_path
+
+        w = rio.windows.Window(left, top, self.screen_size[0], self.screen_size[1])
+        if mode=="colour":
+            loaded_data = raster.read_bands(path, w)
+            im = Image.fromarray(loaded_data)
         else:
-            path = str(Path(__name__).absolute().parent.parent.joinpath("tasmania", "heights.tif"))
-
-        with rio.open(path) as rio_src:
-            w = rio.windows.Window(left, top, self.screen_size[0], self.screen_size[1])
-            if mode=="colour":
-                loaded_data = np.zeros((self.screen_size[1], self.screen_size[0], 3), "uint8")
-                loaded_data[..., 0] = rio_src.read(1, window=w)
-                loaded_data[..., 1] = rio_src.read(2, window=w)
-                loaded_data[..., 2] = rio_src.read(3, window=w)
-                im = Image.fromarray(loaded_data)
-            else:
-                loaded_data = rio_src.read(1, window=w)
-                if mode=="numpy":
-                    return loaded_data
-                loaded_data = loaded_data - loaded_data.min()
-                loaded_data = loaded_data // (loaded_data.max()/255)
-                im = Image.fromarray(loaded_data).convert('RGB')
+            loaded_data = raster.read(path, w)
+            if mode=="numpy":
+                return loaded_data
+            loaded_data = loaded_data - loaded_data.min()
+            loaded_data = loaded_data // (loaded_data.max()/255)
+            im = Image.fromarray(loaded_data).convert('RGB')
         return pil_image_to_surface(im)
 
 @dataclass
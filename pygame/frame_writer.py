@@ -0,0 +1,71 @@
+# Writes rendered frames to disk on a background thread so encoding doesn't hold up rendering
+# png writes one numbered image per frame, raw appends every frame as packed RGB bytes to one frames.rgb file
+# which ffmpeg can read with -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT
+
+import queue
+import threading
+from pathlib import Path
+
+import pygame
+from PIL import Image
+
+FRAME_FORMATS = ("png", "raw")
+
+
+class FrameWriter:
+    def __init__(self, folder, frame_format="png", max_queued=32):
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(f"Unknown frame format {frame_format}, use one of {FRAME_FORMATS}")
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.frame_format = frame_format
+        self.num_frames = 0
+        self.frame_size = None
+        self._raw_file = open(self.folder.joinpath("frames.rgb"), "wb") if frame_format == "raw" else None
+        # Rendering blocks once max_queued frames are waiting, which bounds the memory held by queued frames
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._encode_frames, name="frame-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, surface):
+        # Copy the frame now, the surface is drawn over as soon as this returns
+        if self._error is not None:
+            raise self._error
+        size = surface.get_size()
+        if self.frame_size is None:
+            self.frame_size = size
+        elif size != self.frame_size:
+            raise ValueError(f"Frame size changed from {self.frame_size} to {size}")
+        self._queue.put((self.num_frames, pygame.image.tostring(surface, "RGB")))
+        self.num_frames += 1
+
+    def _encode_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            index, data = item
+            try:
+                if self._raw_file is not None:
+                    self._raw_file.write(data)
+                else:
+                    image = Image.frombytes("RGB", self.frame_size, data)
+                    image.save(self.folder.joinpath(f"frame_{index:06d}.png"), compress_level=1)
+            except Exception as error:
+                self._error = error
+
+    def close(self):
+        # Wait for every queued frame to be written
+        self._queue.put(None)
+        self._thread.join()
+        if self._raw_file is not None:
+            self._raw_file.close()
+        if self._error is not None:
+            raise self._error
+        print(f"Wrote {self.num_frames} frames to {self.folder}")
+        if self._raw_file is not None and self.frame_size is not None:
+            width, height = self.frame_size
+            print(f"ffmpeg -f rawvideo -pix_fmt rgb24 -s {width}x{height} -i {self.folder.joinpath('frames.rgb')} out.mp4")
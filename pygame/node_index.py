@@ -0,0 +1,120 @@
+# Finds nodes by position without looking at every node of the graph
+# Node centerpoints are bucketed into a uniform grid of cell_size squares, in the same (x, y) units as
+# get_node_centerpoint. Queries only look at the cells around the query, and merging nodes moves a few keys
+# between buckets instead of rebuilding the index
+
+import math
+
+
+class NodeIndex:
+    def __init__(self, cell_size=4):
+        self.cell_size = cell_size
+        self.centers = {}
+        self._cells = {}
+        # Range of cells which have ever held a node, bounds how far a nearest node search goes
+        self._lowest_cell = None
+        self._highest_cell = None
+
+    @classmethod
+    def from_centers(cls, centers, cell_size=4):
+        # centers is an iterable of (key, (x, y))
+        index = cls(cell_size)
+        for key, center in centers:
+            index.add(key, center)
+        return index
+
+    def __len__(self):
+        return len(self.centers)
+
+    def __contains__(self, key):
+        return key in self.centers
+
+    def _cell(self, point):
+        return math.floor(point[0] / self.cell_size), math.floor(point[1] / self.cell_size)
+
+    def add(self, key, center):
+        if key in self.centers:
+            self.remove(key)
+        center = (float(center[0]), float(center[1]))
+        self.centers[key] = center
+        cell = self._cell(center)
+        self._cells.setdefault(cell, set()).add(key)
+        if self._lowest_cell is None:
+            self._lowest_cell, self._highest_cell = cell, cell
+        else:
+            self._lowest_cell = tuple(map(min, self._lowest_cell, cell))
+            self._highest_cell = tuple(map(max, self._highest_cell, cell))
+
+    def remove(self, key):
+        cell = self._cell(self.centers.pop(key))
+        self._cells[cell].discard(key)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def merge(self, keys, merged_key, center):
+        # Replace the nodes of keys with one node, like a lake being flooded
+        for key in keys:
+            self.remove(key)
+        self.add(merged_key, center)
+
+    def _ring(self, cell, radius):
+        # Cells at exactly radius cells from cell, going round the square
+        cx, cy = cell
+        if radius == 0:
+            yield cell
+            return
+        for x in range(cx - radius, cx + radius + 1):
+            yield x, cy - radius
+            yield x, cy + radius
+        for y in range(cy - radius + 1, cy + radius):
+            yield cx - radius, y
+            yield cx + radius, y
+
+    def nearest(self, point, max_distance=None):
+        """Key of the node whose center is the shortest manhattan distance from point
+
+        Returns None when there are no nodes, or none within max_distance. Ties go to the smallest key.
+        """
+        if not self.centers:
+            return None
+        cell = self._cell(point)
+        # Past this many rings there are no more cells with nodes
+        last_ring = max(
+            abs(cell[0] - self._lowest_cell[0]),
+            abs(cell[0] - self._highest_cell[0]),
+            abs(cell[1] - self._lowest_cell[1]),
+            abs(cell[1] - self._highest_cell[1]),
+        )
+        if max_distance is not None:
+            last_ring = min(last_ring, math.ceil(max_distance / self.cell_size) + 1)
+        best = None
+        for radius in range(last_ring + 1):
+            for ring_cell in self._ring(cell, radius):
+                for key in self._cells.get(ring_cell, ()):
+                    x, y = self.centers[key]
+                    candidate = (abs(x - point[0]) + abs(y - point[1]), key)
+                    if best is None or candidate < best:
+                        best = candidate
+            # Every node in a further ring is at least radius whole cells away
+            if best is not None and best[0] < radius * self.cell_size:
+                break
+        if best is None or (max_distance is not None and best[0] > max_distance):
+            return None
+        return best[1]
+
+    def in_box(self, corner_1, corner_2):
+        # Keys of every node with a center inside the box between two opposite corners
+        (x1, x2), (y1, y2) = sorted((corner_1[0], corner_2[0])), sorted((corner_1[1], corner_2[1]))
+        if not self.centers:
+            return []
+        # Only the cells which have held nodes, a box much larger than the graph costs no more than the graph
+        lowest_x, lowest_y = map(max, self._cell((x1, y1)), self._lowest_cell)
+        highest_x, highest_y = map(min, self._cell((x2, y2)), self._highest_cell)
+        found = []
+        for cell_x in range(lowest_x, highest_x + 1):
+            for cell_y in range(lowest_y, highest_y + 1):
+                for key in self._cells.get((cell_x, cell_y), ()):
+                    x, y = self.centers[key]
+                    if x1 <= x <= x2 and y1 <= y <= y2:
+                        found.append(key)
+        return found
@@ -0,0 +1,158 @@
+# Draws many same sized circles quickly
+# Each colour of circle is drawn once onto a small sprite, then every node of a frame is stamped with one
+# Surface.blits call. Stamped circles are pixel for pixel the same as pygame.draw.circle
+
+import numpy
+import pygame
+from matplotlib import cm
+
+
+def colour_table(colour_map):
+    # The 256 colours of a matplotlib colour map as pygame colours
+    return [tuple(int(i * 255) for i in colour[:3]) for colour in colour_map(numpy.arange(256))]
+
+
+HEIGHT_COLOURS = colour_table(cm.gist_earth)
+FLOW_COLOURS = colour_table(cm.gist_heat)
+
+
+def colour_indexes(values):
+    # Index into a colour table of values from 0 to 1, picking the same colour as the colour map would
+    return numpy.clip((numpy.asarray(values, dtype=numpy.float64) * 256).astype(numpy.int64), 0, 255)
+
+
+def pixel_centers(points, state):
+    # Screen position of the center of every (x, y) point of the selection, as an (n, 2) int array
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    return (points * state.float_pixel_size + state.center_offset).astype(numpy.int64)
+
+
+class CircleStamps:
+    def __init__(self, radius):
+        self.radius = radius
+        self._stamps = {}
+
+    def stamp(self, colour, width=0):
+        # Sprite of one circle, width draws a ring like pygame.draw.circle
+        key = (tuple(colour), width)
+        if key not in self._stamps:
+            size = 2 * self.radius + 1
+            surface = pygame.Surface((size, size), pygame.SRCALPHA, 32).convert_alpha()
+            pygame.draw.circle(surface, key[0], (self.radius, self.radius), self.radius, width)
+            self._stamps[key] = surface
+        return self._stamps[key]
+
+    def position(self, center):
+        # Where to blit a stamp so the circle is centered on center
+        return int(center[0]) - self.radius, int(center[1]) - self.radius
+
+    def draw(self, surface, centers, colours=(255, 255, 255), width=0, indexes=None, table=HEIGHT_COLOURS):
+        """Stamp a circle at every (x, y) pixel center
+
+        With indexes each circle is coloured by its index into table, like heights from 0 to 255 into
+        HEIGHT_COLOURS. Otherwise colours is one colour for every circle or a list with a colour for each.
+        """
+        if not len(centers):
+            return
+        centers = numpy.asarray(centers, dtype=numpy.int64).reshape(-1, 2) - self.radius
+        positions = list(map(tuple, centers.tolist()))
+        if indexes is not None:
+            indexes = numpy.asarray(indexes).tolist()
+            stamps = {index: self.stamp(table[index], width) for index in set(indexes)}
+            sprites = [stamps[index] for index in indexes]
+        elif numpy.ndim(colours) == 1:
+            sprites = [self.stamp(colours, width)] * len(positions)
+        else:
+            sprites = [self.stamp(colour, width) for colour in colours]
+        surface.blits(list(zip(sprites, positions)), doreturn=False)
+
+
+class GraphLayer:
+    """Lines and circles of a graph kept drawn on a surface, for animations which change a few nodes at a time
+
+    Nodes and edges are bucketed into a grid of cell_size squares by the rectangles they are drawn in. When nodes
+    are added or removed only the rectangles they covered are cleared and redrawn, from the nodes and edges
+    which overlap them. Nodes are keyed by any hashable key and have a center in pixels, a colour and optionally
+    the colour of a ring drawn over them.
+    """
+
+    def __init__(self, size, stamps, ring_width=3, cell_size=32):
+        self.surface = pygame.Surface(size)
+        self.stamps = stamps
+        self.ring_width = min(stamps.radius, ring_width)
+        self.cell_size = cell_size
+        self.nodes = {}
+        self.neighbours = {}
+        self._node_cells = {}
+        self._edge_cells = {}
+
+    def _cells(self, rect):
+        for x in range(rect.left // self.cell_size, (rect.right - 1) // self.cell_size + 1):
+            for y in range(rect.top // self.cell_size, (rect.bottom - 1) // self.cell_size + 1):
+                yield x, y
+
+    def node_rect(self, key):
+        center = self.nodes[key][0]
+        return pygame.Rect(self.stamps.position(center), (2 * self.stamps.radius + 1,) * 2)
+
+    def edge_rect(self, a, b):
+        (ax, ay), (bx, by) = self.nodes[a][0], self.nodes[b][0]
+        return pygame.Rect(min(ax, bx), min(ay, by), abs(ax - bx) + 1, abs(ay - by) + 1)
+
+    def add_node(self, key, center, colour, ring_colour=None):
+        # Returns the rectangle which needs redrawing
+        self.nodes[key] = (tuple(center), tuple(colour), ring_colour)
+        self.neighbours[key] = set()
+        rect = self.node_rect(key)
+        for cell in self._cells(rect):
+            self._node_cells.setdefault(cell, set()).add(key)
+        return rect
+
+    def add_edge(self, a, b):
+        self.neighbours[a].add(b)
+        self.neighbours[b].add(a)
+        rect = self.edge_rect(a, b)
+        edge = (a, b) if a < b else (b, a)
+        for cell in self._cells(rect):
+            self._edge_cells.setdefault(cell, set()).add(edge)
+        return rect
+
+    def remove_node(self, key):
+        # Remove a node and its edges, returning the rectangle which needs redrawing
+        rect = self.node_rect(key)
+        for cell in self._cells(rect):
+            self._node_cells[cell].discard(key)
+        for neighbour in self.neighbours.pop(key):
+            edge_rect = self.edge_rect(key, neighbour)
+            edge = (key, neighbour) if key < neighbour else (neighbour, key)
+            for cell in self._cells(edge_rect):
+                self._edge_cells[cell].discard(edge)
+            self.neighbours[neighbour].discard(key)
+            rect.union_ip(edge_rect)
+        del self.nodes[key]
+        return rect
+
+    def redraw(self, rect=None):
+        # Draw everything overlapping rect again, lines first then circles then rings
+        # Clipping a line changes which pixels it covers, so everything is drawn whole onto a scratch surface and
+        # only rect is copied back
+        rect = self.surface.get_rect() if rect is None else pygame.Rect(rect).clip(self.surface.get_rect())
+        nodes, edges = set(), set()
+        for cell in self._cells(rect):
+            nodes.update(self._node_cells.get(cell, ()))
+            edges.update(self._edge_cells.get(cell, ()))
+        nodes = [key for key in nodes if self.node_rect(key).colliderect(rect)]
+        edges = [edge for edge in edges if self.edge_rect(*edge).colliderect(rect)]
+        area = rect.unionall([self.node_rect(key) for key in nodes] + [self.edge_rect(*edge) for edge in edges])
+
+        scratch = pygame.Surface(area.size)
+        for a, b in edges:
+            (ax, ay), (bx, by) = self.nodes[a][0], self.nodes[b][0]
+            pygame.draw.line(scratch, (255, 255, 255), (ax - area.x, ay - area.y), (bx - area.x, by - area.y), 1)
+        nodes = [self.nodes[key] for key in nodes]
+        centers = [(x - area.x, y - area.y) for (x, y), _, _ in nodes]
+        self.stamps.draw(scratch, centers, [colour for _, colour, _ in nodes])
+        rings = [(center, ring_colour) for center, (_, _, ring_colour) in zip(centers, nodes) if ring_colour]
+        self.stamps.draw(scratch, [center for center, _ in rings], [colour for _, colour in rings], self.ring_width)
+        self.surface.blit(scratch, rect, rect.move(-area.x, -area.y))
+        return rect
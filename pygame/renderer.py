@@ -1,7 +1,13 @@
 # Controls the flow through the program
 # Responsible for managing control flow and data flow, and rendering frames
 # Defines which animations will run, and the order they run in
+#
+# Headless mode renders offscreen with SDL's dummy video driver, for servers without a display. It plays every
+# animation in order as fast as possible, pressing return for any which wait for input, and writes the frames
+# to output_folder as png images or raw RGB:
+# python renderer.py --headless --output frames --format raw
 
+import argparse
 import os
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide"
 import pygame
@@ -11,16 +17,24 @@ import actions
 import flow_actions
 import vis_dataclasses
 import flow_dataclasses
+from frame_writer import FrameWriter, FRAME_FORMATS
+
+HEADLESS_SCREEN_SIZE = (1280, 720)
+
 
 class VisRenderer:
-    def __init__(self):
+    def __init__(self, animation="algorithm", headless=False, output_folder=None, frame_format="png", screen_size=None):
+        self.headless = headless
+        if headless:
+            # Must be set before the display is initialised
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            screen_size = screen_size or HEADLESS_SCREEN_SIZE
         pygame.init()
         infoObject = pygame.display.Info()
         self.current_animation_index = -1
+        self.frame_writer = FrameWriter(output_folder, frame_format) if output_folder else None
 
         fullscreen_mode = False
-        animation = "scale"
-        animation = "algorithm"
 
         if animation == "algorithm":
             dataclass_module = vis_dataclasses
@@ -47,7 +61,10 @@ class VisRenderer:
                 (flow_animations.show_only_heights, flow_actions.animate_watershed, "Watershed", None),
             ]
 
-        if fullscreen_mode:
+        if screen_size:
+            self.settings = dataclass_module.VisSettings(screen_size=tuple(screen_size))
+            self.render_surface = pygame.display.set_mode(self.settings.screen_size)
+        elif fullscreen_mode:
             self.settings = dataclass_module.VisSettings(screen_size=(infoObject.current_w, infoObject.current_h))
             self.render_surface = pygame.display.set_mode(self.settings.screen_size, pygame.FULLSCREEN)
         else:
@@ -67,17 +84,41 @@ class VisRenderer:
         self.subtitle_font = pygame.font.SysFont('tahoma', 32)
         self.title_text = None
         self.subtitle_text = None
-        self.main_loop()
+        try:
+            if headless:
+                self.headless_loop()
+            else:
+                self.main_loop()
+        finally:
+            if self.frame_writer:
+                self.frame_writer.close()
+
+    def draw_frame(self, rects=None):
+        # Animations can yield the list of rectangles of the screen they changed, then only those are copied and
+        # updated on the display. The first frame after the text changes is always drawn whole
+        if rects is None or self.full_frame:
+            self.render_surface.blit(self.screen, (0, 0))
+            self.render_surface.blit(self.text_surface, (0, 0))
+        else:
+            for rect in rects:
+                self.render_surface.blit(self.screen, rect, rect)
+                self.render_surface.blit(self.text_surface, rect, rect)
+        if self.frame_writer:
+            self.frame_writer.write(self.render_surface)
+        if not self.headless:
+            if rects is None or self.full_frame:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
+        self.full_frame = False
 
     def main_loop(self):
         frame_generator, action_processor = self.next_animation()
         while self.state.running:
             if self.state.within_transition:
                 try:
-                    next(frame_generator)
-                    self.render_surface.blit(self.screen, (0, 0))
-                    self.render_surface.blit(self.text_surface, (0, 0))
-                    pygame.display.flip()
+                    rects = next(frame_generator)
+                    self.draw_frame(rects)
                     self.clock.tick(self.settings.framerate)
                     self.handle_events()
                 except StopIteration:
@@ -87,6 +128,18 @@ class VisRenderer:
                 if frame_generator:
                     self.state.within_transition = True
 
+    def headless_loop(self):
+        # Play every animation unattended without waiting between frames
+        # Actions are given a return key press, which they treat as a selection of the whole area
+        for _ in self.animations:
+            frame_generator, action_processor = self.next_animation()
+            for rects in frame_generator:
+                self.draw_frame(rects)
+            if action_processor is not None:
+                event = pygame.event.Event(pygame.KEYDOWN, key=pygame.K_RETURN)
+                for _ in action_processor(event, self.screen, self.state, self.settings) or ():
+                    self.draw_frame()
+
     def update_text(self):
         title_string = self.animations[self.current_animation_index][2] 
         subtitle_string = self.animations[self.current_animation_index][3]
@@ -101,6 +154,7 @@ class VisRenderer:
         self.text_surface.blit(self.title_text, (0,0))
         if self.subtitle_text:
             self.text_surface.blit(self.subtitle_text, (0,60))
+        self.full_frame = True
 
     def next_animation(self):
         self.current_animation_index += 1
@@ -133,4 +187,11 @@ class VisRenderer:
         return None, action_processor
 
 if __name__ == "__main__":
-    VisRenderer()
+    parser = argparse.ArgumentParser(description="Animate how river flow is calculated")
+    parser.add_argument("--animation", default="algorithm", choices=["algorithm", "flow"])
+    parser.add_argument("--headless", action="store_true", help="render offscreen and play every animation")
+    parser.add_argument("--output", help="write every frame to this folder")
+    parser.add_argument("--format", default="png", choices=FRAME_FORMATS)
+    parser.add_argument("--size", type=int, nargs=2, help="screen width and height")
+    arguments = parser.parse_args()
+    VisRenderer(arguments.animation, arguments.headless, arguments.output, arguments.format, arguments.size)
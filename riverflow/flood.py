@@ -0,0 +1,130 @@
+# Fills depressions in a height array so that water can flow out of every point
+# One priority flood sweep from the border replaces flooding lakes one at a time
+
+import heapq
+from collections import deque
+
+import numpy as np
+
+from riverflow.labels import label_equal_heights
+
+
+def border_mask(mask):
+    """Points of mask which touch the edge of the array or a point outside mask"""
+    padded = np.pad(mask, 1, constant_values=False)
+    inside = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return mask & ~inside
+
+
+def priority_flood(heights, mask=None, outlets=None):
+    """Raise every depression in heights to the level it spills over at.
+
+    Water leaves through the border of the array, or through the border of mask when it
+    is given, and through every point of outlets. Returns the filled heights and an int32 raster of lake ids, where every
+    point that was raised belongs to a lake and every other point is -1. Points in a
+    lake and the equal height points around it make up one flat region of the filled
+    heights.
+    """
+    heights = np.asarray(heights)
+    if mask is None:
+        mask = np.ones(heights.shape, dtype=bool)
+    else:
+        mask = np.asarray(mask, dtype=bool)
+
+    # Work on flat indexes of an array padded by one point so neighbours never need
+    # bounds checks. Points outside mask start closed so they are never visited.
+    width = heights.shape[1] + 2
+    filled = np.pad(heights, 1).ravel().tolist()
+    closed = bytearray((~np.pad(mask, 1, constant_values=False)).ravel().tobytes())
+    offsets = (-1, 1, -width, width)
+
+    seeds = border_mask(mask)
+    if outlets is not None:
+        seeds |= mask & np.asarray(outlets, dtype=bool)
+    seeds = np.flatnonzero(np.pad(seeds, 1, constant_values=False))
+    queue = [(filled[i], i) for i in seeds.tolist()]
+    heapq.heapify(queue)
+    for i in seeds.tolist():
+        closed[i] = 1
+
+    # Points at or below the level they are reached from are part of a depression or
+    # flat, so they go on a plain FIFO queue instead of the heap
+    pit = deque()
+    while queue or pit:
+        if pit:
+            point = pit.popleft()
+            level = filled[point]
+        else:
+            level, point = heapq.heappop(queue)
+        for offset in offsets:
+            neighbour = point + offset
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = 1
+            if filled[neighbour] <= level:
+                filled[neighbour] = level
+                pit.append(neighbour)
+            else:
+                heapq.heappush(queue, (filled[neighbour], neighbour))
+
+    filled = np.array(filled, dtype=heights.dtype).reshape(heights.shape[0] + 2, width)[1:-1, 1:-1]
+    lake_ids, _ = label_equal_heights(filled, mask & (filled > heights))
+    return filled, lake_ids
+
+
+def flood_from_border(heights):
+    """Priority flood of heights where every border point is a separate outlet
+
+    Returns the filled heights, an int32 raster of which border point each point was
+    flooded from (an index into the border points in raster order) and the spill
+    heights between those regions as an (n, 3) array of (label, label, height) rows,
+    where height is the lowest level at which the two regions join. This is the first
+    pass of filling a raster a tile at a time, the level each region really fills to
+    comes from flooding the graph of spills of every tile.
+    """
+    heights = np.asarray(heights)
+    width = heights.shape[1] + 2
+    filled = np.pad(heights, 1).ravel().tolist()
+    closed = bytearray(np.pad(np.zeros(heights.shape, dtype=bool), 1, constant_values=True).ravel().tobytes())
+    labels = [-1] * len(filled)
+    offsets = (-1, 1, -width, width)
+
+    seeds = np.flatnonzero(np.pad(border_mask(np.ones(heights.shape, dtype=bool)), 1, constant_values=False))
+    for label, i in enumerate(seeds.tolist()):
+        labels[i] = label
+        closed[i] = 1
+    queue = [(filled[i], i) for i in seeds.tolist()]
+    heapq.heapify(queue)
+
+    spills = {}
+    pit = deque()
+    while queue or pit:
+        if pit:
+            point = pit.popleft()
+            level = filled[point]
+        else:
+            level, point = heapq.heappop(queue)
+        label = labels[point]
+        for offset in offsets:
+            neighbour = point + offset
+            if closed[neighbour]:
+                other = labels[neighbour]
+                if other != label and other >= 0:
+                    pair = (label, other) if label < other else (other, label)
+                    spill = max(level, filled[neighbour])
+                    if spill < spills.get(pair, spill + 1):
+                        spills[pair] = spill
+                continue
+            closed[neighbour] = 1
+            labels[neighbour] = label
+            if filled[neighbour] <= level:
+                filled[neighbour] = level
+                pit.append(neighbour)
+            else:
+                heapq.heappush(queue, (filled[neighbour], neighbour))
+
+    shape = (heights.shape[0] + 2, width)
+    filled = np.array(filled, dtype=heights.dtype).reshape(shape)[1:-1, 1:-1]
+    labels = np.array(labels, dtype=np.int32).reshape(shape)[1:-1, 1:-1]
+    spills = np.array([pair + (spill,) for pair, spill in spills.items()], dtype=np.int64).reshape(-1, 3)
+    return filled, labels, spills
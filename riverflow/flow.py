@@ -0,0 +1,79 @@
+# Moves water down a graph of nodes with NumPy
+# The graph is given as per node heights plus CSR neighbour arrays, water only flows from
+# a node to lower neighbours and leaves the graph at sink nodes
+
+from collections import namedtuple
+
+import numpy as np
+
+Outflows = namedtuple("Outflows", ["sources", "targets", "weights"])
+
+
+def outflow_weights(heights, indptr, indices, sinks, split_threshold=0.0):
+    """Sparse matrix of the share of each node's water which flows to each neighbour
+
+    Returned in COO form as parallel sources/targets/weights arrays. Water is split
+    between lower neighbours in proportion to the height drop. Neighbours with a drop
+    less than or equal to split_threshold times the largest drop get nothing, which
+    avoids tiny fractional flows. Sinks have no outflows.
+    """
+    heights = np.asarray(heights, dtype=np.float64)
+    sources = np.repeat(np.arange(len(heights)), np.diff(indptr))
+    targets = np.asarray(indices, dtype=np.int64)
+    drops = heights[sources] - heights[targets]
+
+    downhill = (drops > 0) & ~sinks[sources]
+    sources, targets, drops = sources[downhill], targets[downhill], drops[downhill]
+
+    largest_drop = np.zeros(len(heights))
+    np.maximum.at(largest_drop, sources, drops)
+    kept = drops > largest_drop[sources] * split_threshold
+    sources, targets, drops = sources[kept], targets[kept], drops[kept]
+
+    total_drop = np.bincount(sources, weights=drops, minlength=len(heights))
+    return Outflows(sources, targets, drops / total_drop[sources])
+
+
+def accumulate(heights, outflows, inflow):
+    """Total water passing through every node when inflow is added to each node
+
+    Every outflow goes to a strictly lower node, so processing nodes from the highest
+    height down is a topological order. All nodes at one height are independent and are
+    moved together in one batch.
+    """
+    heights = np.asarray(heights)
+    flow = np.array(inflow, dtype=np.float64)
+
+    order = np.argsort(-heights[outflows.sources], kind="stable")
+    sources = outflows.sources[order]
+    targets = outflows.targets[order]
+    weights = outflows.weights[order]
+    source_heights = heights[sources]
+    level_starts = np.flatnonzero(np.concatenate([[True], source_heights[1:] != source_heights[:-1]]))
+    level_ends = np.append(level_starts[1:], len(sources))
+
+    for start, end in zip(level_starts.tolist(), level_ends.tolist()):
+        np.add.at(flow, targets[start:end], flow[sources[start:end]] * weights[start:end])
+    return flow
+
+
+def transfer(outflows, flow):
+    """Flow after one step where every node passes all of its water on to its outflows
+
+    Water at nodes without outflows, such as sinks, leaves the graph.
+    """
+    return np.bincount(outflows.targets, weights=flow[outflows.sources] * outflows.weights, minlength=len(flow))
+
+
+def simulate(outflows, inflow, num_steps):
+    """Yield the flow at the start and after each step, stopping early once all water has left
+
+    Summing every yielded flow gives the same result as accumulate with the same outflows.
+    """
+    flow = np.array(inflow, dtype=np.float64)
+    yield flow
+    for _ in range(num_steps):
+        flow = transfer(outflows, flow)
+        yield flow
+        if not flow.any():
+            return
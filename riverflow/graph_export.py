@@ -0,0 +1,105 @@
+# Compact binary export of a region graph for other programs and the website
+# Nodes are numbered 0..n-1 and every array is indexed by that number. Links are CSR adjacency, the
+# neighbours of node i are indices[indptr[i]:indptr[i + 1]], and are stored in both directions.
+#
+# The .npz holds every array for python. The .bin holds what the website draws with in one little endian
+# buffer the browser can view as typed arrays without parsing:
+#
+#   header    5 x uint32        magic "RFG1", version, number of nodes n, number of links m, flags
+#   centers   2n float32        x, y of the center of each node
+#   heights   n int16           int32 when flags has HEIGHTS_32
+#   indptr    n + 1 uint32
+#   indices   m uint16          uint32 when flags has INDICES_32
+#
+# Every section is padded with zeros to a multiple of 4 bytes so each typed array starts aligned
+
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"RFG1"
+VERSION = 1
+HEIGHTS_32 = 1
+INDICES_32 = 2
+HEADER_DTYPE = np.dtype("<u4")
+
+
+def _sections(num_nodes, num_links, flags):
+    # (name, dtype, length) of each array in the buffer after the header
+    return (
+        ("centers", "<f4", 2 * num_nodes),
+        ("heights", "<i4" if flags & HEIGHTS_32 else "<i2", num_nodes),
+        ("indptr", "<u4", num_nodes + 1),
+        ("indices", "<u4" if flags & INDICES_32 else "<u2", num_links),
+    )
+
+
+def graph_arrays(graph, xy=True):
+    """The exported arrays of a RegionGraph
+
+    Centers are (x, y), column then row, when xy is set, otherwise (row, col). nodes holds the
+    RegionGraph node id of each exported node.
+    """
+    compact = graph.compacted()
+    inside = compact.labels >= 0
+    labels = compact.labels[inside]
+    rows, cols = np.nonzero(inside)
+    rows, cols = rows + graph.offset[0], cols + graph.offset[1]
+    sizes = compact.sizes
+    first, second = (cols, rows) if xy else (rows, cols)
+    centers = np.stack([np.bincount(labels, first, len(sizes)), np.bincount(labels, second, len(sizes))], axis=1)
+    centers /= np.maximum(sizes, 1)[:, None]
+    return {
+        "nodes": compact.nodes.astype(np.int32),
+        "centers": centers.astype(np.float32),
+        "heights": compact.heights.astype(np.int32),
+        "sizes": sizes.astype(np.uint32),
+        "indptr": compact.indptr.astype(np.uint32),
+        "indices": compact.indices.astype(np.uint32),
+    }
+
+
+def write_buffer(path, centers, heights, indptr, indices):
+    heights = np.asarray(heights)
+    flags = 0
+    if len(heights) and not np.iinfo(np.int16).min <= heights.min() <= heights.max() <= np.iinfo(np.int16).max:
+        flags |= HEIGHTS_32
+    if len(heights) > np.iinfo(np.uint16).max + 1:
+        flags |= INDICES_32
+    header = [int.from_bytes(MAGIC, "little"), VERSION, len(heights), len(indices), flags]
+    arrays = dict(centers=centers, heights=heights, indptr=indptr, indices=indices)
+    with open(path, "wb") as f:
+        f.write(np.array(header, dtype=HEADER_DTYPE).tobytes())
+        for name, dtype, _ in _sections(len(heights), len(indices), flags):
+            data = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+            f.write(data + bytes(-len(data) % 4))
+
+
+def read_buffer(data):
+    """Arrays of a .bin export from its bytes, the same way the website reads it"""
+    magic, version, num_nodes, num_links, flags = np.frombuffer(data, HEADER_DTYPE, 5).tolist()
+    if magic != int.from_bytes(MAGIC, "little") or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} graph buffer")
+    arrays = {}
+    offset = 5 * HEADER_DTYPE.itemsize
+    for name, dtype, length in _sections(num_nodes, num_links, flags):
+        arrays[name] = np.frombuffer(data, dtype, length, offset)
+        offset += arrays[name].nbytes + (-arrays[name].nbytes % 4)
+    arrays["centers"] = arrays["centers"].reshape(-1, 2)
+    return arrays
+
+
+def export_graph(graph, path, xy=True):
+    """Write graph as path.npz and path.bin and return the two paths"""
+    path = Path(path)
+    arrays = graph_arrays(graph, xy)
+    npz_path, bin_path = path.with_suffix(".npz"), path.with_suffix(".bin")
+    np.savez_compressed(npz_path, **arrays)
+    write_buffer(bin_path, arrays["centers"], arrays["heights"], arrays["indptr"], arrays["indices"])
+    return npz_path, bin_path
+
+
+def load_graph(path):
+    """Arrays of a .npz export"""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
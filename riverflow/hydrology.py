@@ -0,0 +1,487 @@
+# Flow direction and flow accumulation rasters for a whole DEM, computed a tile at a time
+# Tiles are processed on a process pool and only small summaries of their borders come back to the
+# main process, which reconciles flow across the tile seams between the stages:
+#
+#   1. fill each tile as if its border were the sea, recording where its border regions spill together
+#   2. flood the spill graph of every tile border to find the real level of each border region
+#   3. point every point downhill on the filled heights. Flats drain towards their nearest outlet,
+#      flats which cross a seam take a few rounds of swapping tile edges to settle
+#   4. accumulate flow inside each tile, pass the flow leaving each tile on to the tiles it enters,
+#      then accumulate again with that inflow added
+#
+# Intermediate tiles live in a work directory as .npy files so memory use is bounded by the tile size.
+# Directions use the same four neighbours as the graphs, 0 means water leaves the DEM at that point.
+
+import heapq
+import os
+import tempfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+
+from riverflow import raster
+from riverflow.flood import border_mask, flood_from_border
+from riverflow.flow import Outflows, accumulate
+
+Tile = namedtuple("Tile", ["index", "row", "col", "top", "left", "height", "width"])
+
+# (row, col) step of each direction code, code 0 doesn't move
+OFFSETS = {1: (-1, 0), 2: (1, 0), 3: (0, -1), 4: (0, 1)}
+ROW_STEP = np.array([0, -1, 1, 0, 0])
+COL_STEP = np.array([0, 0, 0, -1, 1])
+NO_DISTANCE = np.iinfo(np.int32).max
+
+# The side of a neighbouring tile which faces each side of a tile
+FACING = {"top": "bottom", "bottom": "top", "left": "right", "right": "left"}
+SIDE_SLICES = {
+    "top": (0, slice(None)),
+    "bottom": (-1, slice(None)),
+    "left": (slice(None), 0),
+    "right": (slice(None), -1),
+}
+
+OUTPUT_NAMES = {
+    "filled": "filled_heights.tif",
+    "directions": "flow_direction.tif",
+    "accumulation": "flow_accumulation.tif",
+}
+
+
+def make_tiles(shape, tile_size):
+    tiles = []
+    for row, top in enumerate(range(0, shape[0], tile_size)):
+        for col, left in enumerate(range(0, shape[1], tile_size)):
+            height, width = min(tile_size, shape[0] - top), min(tile_size, shape[1] - left)
+            tiles.append(Tile(len(tiles), row, col, top, left, height, width))
+    return tiles
+
+
+def tile_neighbours(tiles):
+    """{tile index: {side: neighbouring tile or None}}"""
+    by_position = {(tile.row, tile.col): tile for tile in tiles}
+    steps = {"top": (-1, 0), "bottom": (1, 0), "left": (0, -1), "right": (0, 1)}
+    return {
+        tile.index: {side: by_position.get((tile.row + dr, tile.col + dc)) for side, (dr, dc) in steps.items()}
+        for tile in tiles
+    }
+
+
+def tile_border(tile):
+    """Flat indexes of the border points of a tile in raster order"""
+    return np.flatnonzero(border_mask(np.ones((tile.height, tile.width), dtype=bool)))
+
+
+def _path(workdir, name, tile):
+    return os.path.join(workdir, f"{name}_{tile.index}.npy")
+
+
+def _fill_tile(job):
+    # Stage 1, returns the heights of the tile border points and the spills between their regions
+    dem_path, tile, workdir = job
+    window = rio.windows.Window(tile.left, tile.top, tile.width, tile.height)
+    heights = raster.read(dem_path, window, cache=raster.BlockCache(0))
+    filled, labels, spills = flood_from_border(heights)
+    np.save(_path(workdir, "local_filled", tile), filled)
+    np.save(_path(workdir, "labels", tile), labels)
+    return tile.index, heights.ravel()[tile_border(tile)], spills
+
+
+def _seam_edges(tile, neighbour, side, offsets, border_heights):
+    # Edges between the border points facing each other across the seam of two tiles
+    if side == "right":
+        points = np.arange(tile.height) * tile.width + tile.width - 1
+        neighbour_points = np.arange(neighbour.height) * neighbour.width
+    else:
+        points = (tile.height - 1) * tile.width + np.arange(tile.width)
+        neighbour_points = np.arange(neighbour.width)
+    nodes = np.searchsorted(tile_border(tile), points)
+    neighbour_nodes = np.searchsorted(tile_border(neighbour), neighbour_points)
+    heights = np.maximum(border_heights[tile.index][nodes], border_heights[neighbour.index][neighbour_nodes])
+    return np.column_stack([nodes + offsets[tile.index], neighbour_nodes + offsets[neighbour.index], heights])
+
+
+def solve_levels(tiles, shape, border_heights, spills):
+    """Stage 2, the level every tile border point fills to
+
+    The border points of all tiles are the nodes of one graph, joined by the spills inside
+    each tile and by the seams between tiles. Water leaves at the edge of the DEM, so the
+    level of a node is the lowest height at which it can reach the edge. Returns the levels
+    and the offset of each tile's first border point.
+    """
+    offsets = np.cumsum([0] + [len(border_heights[tile.index]) for tile in tiles])
+    heights = np.concatenate([border_heights[tile.index] for tile in tiles]).astype(np.int64)
+    edges = [
+        np.column_stack([spills[tile.index][:, :2] + offsets[tile.index], spills[tile.index][:, 2]]) for tile in tiles
+    ]
+    for tile in tiles:
+        for side, neighbour in tile_neighbours(tiles)[tile.index].items():
+            if neighbour is not None and side in ("right", "bottom"):
+                edges.append(_seam_edges(tile, neighbour, side, offsets, border_heights))
+    edges = np.concatenate(edges).astype(np.int64)
+
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    targets = np.concatenate([edges[:, 1], edges[:, 0]])
+    weights = np.concatenate([edges[:, 2], edges[:, 2]])
+    order = np.argsort(sources, kind="stable")
+    indptr = np.searchsorted(sources[order], np.arange(len(heights) + 1)).tolist()
+    targets, weights = targets[order].tolist(), weights[order].tolist()
+
+    on_edge = []
+    for tile in tiles:
+        rows, cols = np.divmod(tile_border(tile), tile.width)
+        rows, cols = rows + tile.top, cols + tile.left
+        on_edge.append((rows == 0) | (cols == 0) | (rows == shape[0] - 1) | (cols == shape[1] - 1))
+    on_edge = np.concatenate(on_edge)
+
+    levels = [None] * len(heights)
+    queue = list(zip(heights[on_edge].tolist(), np.flatnonzero(on_edge).tolist()))
+    heapq.heapify(queue)
+    while queue:
+        level, node = heapq.heappop(queue)
+        if levels[node] is not None:
+            continue
+        levels[node] = level
+        for k in range(indptr[node], indptr[node + 1]):
+            if levels[targets[k]] is None:
+                heapq.heappush(queue, (max(level, weights[k]), targets[k]))
+    return np.array(levels, dtype=np.int64), offsets
+
+
+def _filled(tile, workdir, part=(slice(None), slice(None))):
+    # Final filled heights of part of a tile, from its stage 1 fill and the levels of stage 2
+    levels = np.load(os.path.join(workdir, "levels.npy"), mmap_mode="r")
+    offset = np.load(os.path.join(workdir, "offsets.npy"))[tile.index]
+    local_filled = np.load(_path(workdir, "local_filled", tile), mmap_mode="r")[part]
+    labels = np.load(_path(workdir, "labels", tile), mmap_mode="r")[part]
+    return np.maximum(local_filled, levels[labels + offset]).astype(local_filled.dtype)
+
+
+def _with_halo(tile, neighbours, centre, strip, fill_value):
+    # centre surrounded by a one point ring taken from the facing edges of the neighbouring tiles
+    output = np.full((tile.height + 2, tile.width + 2), fill_value, dtype=centre.dtype)
+    output[1:-1, 1:-1] = centre
+    halo = {
+        "top": (0, slice(1, -1)),
+        "bottom": (-1, slice(1, -1)),
+        "left": (slice(1, -1), 0),
+        "right": (slice(1, -1), -1),
+    }
+    for side, neighbour in neighbours.items():
+        if neighbour is not None:
+            output[halo[side]] = strip(neighbour, FACING[side])
+    return output
+
+
+def _direction_tile(job):
+    # Stage 3, one round of directions for a tile. Returns the distances along each side and which
+    # sides have a flat crossing the seam, so the main process can tell which tiles need another round
+    tile, neighbours, shape, workdir, round_number, neighbour_rounds = job
+
+    def neighbour_distance(neighbour, side):
+        if neighbour_rounds.get(neighbour.index) is None:
+            return NO_DISTANCE
+        return np.load(os.path.join(workdir, f"edges_{neighbour_rounds[neighbour.index]}_{neighbour.index}.npz"))[side]
+
+    centre = _filled(tile, workdir)
+    np.save(_path(workdir, "filled", tile), centre)
+    filled = _with_halo(
+        tile,
+        neighbours,
+        centre.astype(np.float64),
+        lambda neighbour, side: _filled(neighbour, workdir, SIDE_SLICES[side]),
+        np.inf,
+    )
+    distance = _with_halo(tile, neighbours, np.zeros(centre.shape, dtype=np.int32), neighbour_distance, 0)
+    directions = np.zeros(centre.shape, dtype=np.uint8)
+    shifted = {
+        code: (slice(1 + dr, filled.shape[0] - 1 + dr), slice(1 + dc, filled.shape[1] - 1 + dc))
+        for code, (dr, dc) in OFFSETS.items()
+    }
+
+    # Steepest way down for points with a lower neighbour
+    steepest = np.zeros(centre.shape)
+    for code in OFFSETS:
+        drop = filled[1:-1, 1:-1] - filled[shifted[code]]
+        steeper = drop > steepest
+        directions[steeper] = code
+        steepest[steeper] = drop[steeper]
+
+    # Points on the edge of the DEM without a lower neighbour are where water leaves, every other point
+    # without a lower neighbour is on a flat
+    rows = np.arange(tile.top, tile.top + tile.height)[:, None]
+    cols = np.arange(tile.left, tile.left + tile.width)[None, :]
+    on_edge = (rows == 0) | (cols == 0) | (rows == shape[0] - 1) | (cols == shape[1] - 1)
+    flat = (directions == 0) & ~on_edge
+    distance[1:-1, 1:-1][flat] = NO_DISTANCE
+    _drain_flats(filled, distance, flat)
+
+    # Flat points point to the neighbour of equal height which is closest to an outlet
+    closest = np.full(centre.shape, NO_DISTANCE, dtype=np.int64)
+    for code in OFFSETS:
+        closer = flat & (filled[shifted[code]] == filled[1:-1, 1:-1]) & (distance[shifted[code]] < closest)
+        directions[closer] = code
+        closest[closer] = distance[shifted[code]][closer]
+
+    np.save(_path(workdir, "directions", tile), directions)
+    np.save(_path(workdir, "distance", tile), distance[1:-1, 1:-1])
+    edges = {side: distance[1:-1, 1:-1][part] for side, part in SIDE_SLICES.items()}
+    np.savez(os.path.join(workdir, f"edges_{round_number}_{tile.index}.npz"), **edges)
+
+    # A flat crosses the seam where a flat point has a neighbour of equal height in the halo
+    seam_flats = {}
+    for side, code in (("top", 1), ("bottom", 2), ("left", 3), ("right", 4)):
+        part = SIDE_SLICES[side]
+        same_height = filled[shifted[code]][part] == filled[1:-1, 1:-1][part]
+        seam_flats[side] = bool((flat[part] & same_height).any())
+    return tile.index, edges, seam_flats
+
+
+def _local_flow(tile, shape, workdir):
+    # Directions of a tile as outflows between its points, plus the points whose water leaves the tile
+    directions = np.load(_path(workdir, "directions", tile)).ravel()
+    filled = np.load(_path(workdir, "filled", tile)).astype(np.int64).ravel()
+    distance = np.load(_path(workdir, "distance", tile)).astype(np.int64).ravel()
+
+    sources = np.flatnonzero(directions)
+    rows, cols = np.divmod(sources, tile.width)
+    rows, cols = rows + ROW_STEP[directions[sources]], cols + COL_STEP[directions[sources]]
+    inside = (rows >= 0) & (rows < tile.height) & (cols >= 0) & (cols < tile.width)
+    targets = rows[inside] * tile.width + cols[inside]
+    outflows = Outflows(sources[inside], targets, np.ones(len(targets)))
+    exits = sources[~inside]
+    exit_targets = (rows[~inside] + tile.top) * shape[1] + cols[~inside] + tile.left
+
+    # Water only moves to lower points, or along a flat to a point closer to its outlet, so this key
+    # orders the points from upstream to downstream
+    order_key = filled * (int(distance.max()) + 1) + distance
+    return order_key, outflows, exits, exit_targets
+
+
+def _accumulate_tile(job):
+    # Stage 4, flow through each point of a tile from rain on the tile plus the given inflow.
+    # Without inflow it also returns where the water leaving the tile goes, for the main process
+    # to pass between tiles
+    tile, shape, workdir, inflow_points, inflow = job
+    order_key, outflows, exits, exit_targets = _local_flow(tile, shape, workdir)
+    rain = np.ones(tile.height * tile.width)
+    if inflow_points is not None:
+        np.add.at(rain, inflow_points, inflow)
+    flow = accumulate(order_key, outflows, rain)
+    if inflow_points is not None:
+        return tile.index, flow.reshape(tile.height, tile.width).astype(np.float32)
+
+    # Follow the directions from each border point to the point where its water leaves the tile
+    downstream = np.arange(len(rain))
+    downstream[outflows.sources] = outflows.targets
+    while True:
+        jumped = downstream[downstream]
+        if np.array_equal(jumped, downstream):
+            break
+        downstream = jumped
+    border = tile_border(tile)
+    is_exit = np.zeros(len(rain), dtype=bool)
+    is_exit[exits] = True
+    ends = downstream[border]
+    ends = np.where(is_exit[ends], _to_global(tile, shape, ends), -1)
+    return (
+        tile.index,
+        _to_global(tile, shape, exits),
+        exit_targets,
+        flow[exits],
+        _to_global(tile, shape, border),
+        ends,
+    )
+
+
+def _to_global(tile, shape, points):
+    rows, cols = np.divmod(points, tile.width)
+    return (rows + tile.top) * shape[1] + cols + tile.left
+
+
+def pass_flow_between_tiles(exit_results):
+    """Total inflow to every point which receives water from another tile
+
+    exit_results are the stage 4 summaries of each tile: the points water leaves from, the
+    point in the next tile it goes to and how much leaves, plus for each border point the
+    exit its water reaches. Water entering a tile leaves at the exit its entry point
+    reaches, so exits are processed upstream first.
+    """
+    exit_target, exit_flow, border_end = {}, {}, {}
+    for _, exits, targets, flows, border, ends in exit_results:
+        exit_target.update(zip(exits.tolist(), targets.tolist()))
+        exit_flow.update(zip(exits.tolist(), flows.tolist()))
+        border_end.update(zip(border.tolist(), ends.tolist()))
+
+    downstream_exit = {point: border_end.get(target, -1) for point, target in exit_target.items()}
+    upstream_count = dict.fromkeys(exit_target, 0)
+    for point in downstream_exit.values():
+        if point >= 0:
+            upstream_count[point] += 1
+    ready = deque(point for point, count in upstream_count.items() if count == 0)
+    inflow = {}
+    while ready:
+        point = ready.popleft()
+        target = exit_target[point]
+        inflow[target] = inflow.get(target, 0) + exit_flow[point]
+        next_exit = downstream_exit[point]
+        if next_exit >= 0:
+            exit_flow[next_exit] += exit_flow[point]
+            upstream_count[next_exit] -= 1
+            if upstream_count[next_exit] == 0:
+                ready.append(next_exit)
+    return inflow
+
+
+def _output_profile(dem_path, dtype):
+    with rio.open(dem_path) as dem:
+        profile = dem.profile
+    profile.update(
+        driver="GTiff",
+        dtype=dtype,
+        count=1,
+        nodata=None,
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    )
+    return profile
+
+
+def compute_flow_rasters(dem_path, output_folder, tile_size=2048, max_workers=None, work_folder=None):
+    """Write filled heights, flow direction and flow accumulation rasters for a whole DEM
+
+    Accumulation is the number of points whose water passes through each point. Returns
+    the paths of the written rasters keyed like OUTPUT_NAMES.
+    """
+    dem_path = str(dem_path)
+    with rio.open(dem_path) as dem:
+        shape = (dem.height, dem.width)
+        dem_dtype = dem.dtypes[0]
+    tiles = make_tiles(shape, tile_size)
+    neighbours = tile_neighbours(tiles)
+    outputs = {name: str(Path(output_folder).joinpath(filename)) for name, filename in OUTPUT_NAMES.items()}
+
+    with tempfile.TemporaryDirectory(dir=work_folder) as workdir, ProcessPoolExecutor(max_workers) as pool:
+        border_heights, spills = {}, {}
+        for index, heights, tile_spills in pool.map(_fill_tile, [(dem_path, tile, workdir) for tile in tiles]):
+            border_heights[index], spills[index] = heights, tile_spills
+        print(f"Filled {len(tiles)} tiles")
+        levels, offsets = solve_levels(tiles, shape, border_heights, spills)
+        np.save(os.path.join(workdir, "levels.npy"), levels)
+        np.save(os.path.join(workdir, "offsets.npy"), offsets)
+
+        # Flats which cross a seam settle one tile further each round
+        latest_round, latest_edges, seam_flats = {}, {}, {}
+        pending = {tile.index for tile in tiles}
+        round_number = 0
+        while pending:
+            jobs = [
+                (tiles[i], neighbours[i], shape, workdir, round_number, dict(latest_round)) for i in sorted(pending)
+            ]
+            changed = set()
+            for index, edges, tile_seam_flats in pool.map(_direction_tile, jobs):
+                previous = latest_edges.get(index)
+                if previous is None or any(not np.array_equal(edges[side], previous[side]) for side in edges):
+                    changed.add(index)
+                latest_round[index], latest_edges[index], seam_flats[index] = round_number, edges, tile_seam_flats
+            pending = {
+                tile.index
+                for tile in tiles
+                if any(
+                    seam_flats[tile.index][side] and neighbour is not None and neighbour.index in changed
+                    for side, neighbour in neighbours[tile.index].items()
+                )
+            }
+            round_number += 1
+            print(f"Direction round {round_number}, {len(changed)} tiles changed")
+
+        for tile in tiles:
+            os.remove(_path(workdir, "local_filled", tile))
+            os.remove(_path(workdir, "labels", tile))
+
+        exit_results = list(pool.map(_accumulate_tile, [(tile, shape, workdir, None, None) for tile in tiles]))
+        inflow = pass_flow_between_tiles(exit_results)
+        tile_inflow = {tile.index: ([], []) for tile in tiles}
+        for point, amount in inflow.items():
+            row, col = divmod(point, shape[1])
+            tile = tiles[(row // tile_size) * -(-shape[1] // tile_size) + col // tile_size]
+            tile_inflow[tile.index][0].append((row - tile.top) * tile.width + col - tile.left)
+            tile_inflow[tile.index][1].append(amount)
+
+        jobs = [
+            (tile, shape, workdir, np.array(tile_inflow[tile.index][0], dtype=np.int64), tile_inflow[tile.index][1])
+            for tile in tiles
+        ]
+        with rio.open(outputs["filled"], "w", **_output_profile(dem_path, dem_dtype)) as filled_raster, rio.open(
+            outputs["directions"], "w", **_output_profile(dem_path, "uint8")
+        ) as directions_raster, rio.open(
+            outputs["accumulation"], "w", **_output_profile(dem_path, "float32")
+        ) as accumulation_raster:
+            for index, flow in pool.map(_accumulate_tile, jobs):
+                tile = tiles[index]
+                window = rio.windows.Window(tile.left, tile.top, tile.width, tile.height)
+                filled_raster.write(np.load(_path(workdir, "filled", tile)), 1, window=window)
+                directions_raster.write(np.load(_path(workdir, "directions", tile)), 1, window=window)
+                accumulation_raster.write(flow, 1, window=window)
+        print("Wrote flow rasters")
+    return outputs
+
+
+def downstream_path(directions_path, point, max_length=100000):
+    """(row, col) points water flows through from point until it leaves the DEM"""
+    path = [tuple(point)]
+    for _ in range(max_length):
+        row, col = path[-1]
+        code = int(raster.read(directions_path, rio.windows.Window(col, row, 1, 1))[0, 0])
+        if code == 0:
+            break
+        path.append((row + int(ROW_STEP[code]), col + int(COL_STEP[code])))
+    return path
+
+
+def catchment_size(accumulation_path, point):
+    """Number of points which drain through point"""
+    row, col = point
+    return float(raster.read(accumulation_path, rio.windows.Window(col, row, 1, 1))[0, 0])
+
+
+def _drain_flats(filled, distance, flat):
+    # Breadth first search out from the outlets of each flat through points of equal height,
+    # updating distance in place. Points of the halo keep the distance their own tile gave them
+    width = filled.shape[1]
+    padded_flat = np.pad(flat, 1)
+    next_to_flat = np.zeros(padded_flat.shape, dtype=bool)
+    next_to_flat[1:, :] |= padded_flat[:-1, :]
+    next_to_flat[:-1, :] |= padded_flat[1:, :]
+    next_to_flat[:, 1:] |= padded_flat[:, :-1]
+    next_to_flat[:, :-1] |= padded_flat[:, 1:]
+
+    padded_flat = padded_flat.ravel().tolist()
+    heights = filled.ravel().tolist()
+    distances = distance.ravel()
+    seeds = np.flatnonzero((next_to_flat & ~np.pad(flat, 1)).ravel() & (distances < NO_DISTANCE))
+    seeds = deque(seeds[np.argsort(distances[seeds], kind="stable")].tolist())
+    distances = distances.tolist()
+
+    # Seeds from the halo start at different distances, so take whichever of the sorted seeds
+    # and the found points is closest to keep the search in distance order
+    found = deque()
+    offsets = (-width, width, -1, 1)
+    while seeds or found:
+        if found and (not seeds or distances[found[0]] <= distances[seeds[0]]):
+            point = found.popleft()
+        else:
+            point = seeds.popleft()
+        next_distance = distances[point] + 1
+        for offset in offsets:
+            neighbour = point + offset
+            if 0 <= neighbour < len(padded_flat) and padded_flat[neighbour]:
+                if heights[neighbour] == heights[point] and distances[neighbour] > next_distance:
+                    distances[neighbour] = next_distance
+                    found.append(neighbour)
+    distance[...] = np.array(distances, dtype=distance.dtype).reshape(distance.shape)
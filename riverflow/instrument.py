@@ -0,0 +1,109 @@
+# Opt-in timers and counters for finding where a long job like a river trace spends its time
+# Nothing is recorded until enable() is called, so the timer and count calls can stay in the code.
+# Hot loops should count into a local and call count once at the end
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+_current = None
+
+
+class Instruments:
+    """Named timers, counters and events recorded while instrumentation is enabled
+
+    Timers add up the seconds and number of calls of every block timed with the same
+    name, so nested timers overlap. Events are a list of dicts for values which change
+    as a job runs, like the cost of each segment added to a trace.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.events = []
+        # Segments are read on prefetch threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def event(self, name, **values):
+        with self._lock:
+            self.events.append({"event": name, **values})
+
+    def as_dict(self):
+        return {
+            "timers": {name: {"seconds": self.seconds[name], "calls": self.calls[name]} for name in self.seconds},
+            "counters": dict(self.counters),
+            "events": list(self.events),
+        }
+
+    def summary(self, total=None):
+        return summary(self.as_dict(), total)
+
+
+def summary(data, total=None):
+    """Table of the timers in data from Instruments.as_dict, slowest first, then counters
+
+    Percentages are of the timer called total, or of the slowest timer.
+    """
+    timers = data["timers"]
+    names = sorted(timers, key=lambda name: timers[name]["seconds"], reverse=True)
+    total_seconds = timers[total]["seconds"] if total in timers else timers[names[0]]["seconds"] if names else 0
+    lines = [f"{'timer':24} {'seconds':>10} {'calls':>8} {'ms/call':>10} {'%':>6}"]
+    for name in names:
+        seconds, calls = timers[name]["seconds"], timers[name]["calls"]
+        percent = 100 * seconds / total_seconds if total_seconds else 0
+        lines.append(f"{name:24} {seconds:>10.3f} {calls:>8} {1000 * seconds / calls:>10.2f} {percent:>6.1f}")
+    if data["counters"]:
+        lines.append(f"{'counter':24} {'count':>10}")
+        lines += [f"{name:24} {count:>10}" for name, count in sorted(data["counters"].items())]
+    return "\n".join(lines)
+
+
+def enable():
+    """Start recording into a new Instruments and return it"""
+    global _current
+    _current = Instruments()
+    return _current
+
+
+def disable():
+    """Stop recording and return what was recorded"""
+    global _current
+    instruments, _current = _current, None
+    return instruments
+
+
+def current():
+    return _current
+
+
+def timer(name):
+    if _current is None:
+        return nullcontext()
+    return _current.timer(name)
+
+
+def count(name, amount=1):
+    if _current is not None:
+        _current.count(name, amount)
+
+
+def event(name, **values):
+    if _current is not None:
+        _current.event(name, **values)
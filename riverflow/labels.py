@@ -0,0 +1,109 @@
+# Labels connected regions of equal height in a height array
+# Replaces the per pixel BFS used to merge flat areas into single graph nodes
+
+import numpy as np
+
+
+def _compress(parent):
+    # Pointer jumping until every entry points directly at its root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def _index_dtype(size):
+    # Flat indexes fit in int32 for anything smaller than a 46000 pixel square
+    return np.int32 if size < 2**31 else np.int64
+
+
+def _equal_height_edges(heights, mask):
+    index = np.arange(heights.size, dtype=np.int64).reshape(heights.shape)
+    same_right = heights[:, :-1] == heights[:, 1:]
+    same_down = heights[:-1, :] == heights[1:, :]
+    if mask is not None:
+        same_right &= mask[:, :-1] & mask[:, 1:]
+        same_down &= mask[:-1, :] & mask[1:, :]
+    from_index = np.concatenate([index[:, :-1][same_right], index[:-1, :][same_down]])
+    to_index = np.concatenate([index[:, 1:][same_right], index[1:, :][same_down]])
+    return from_index, to_index
+
+
+def label_equal_heights(heights, mask=None):
+    """Label 4-connected regions of equal height.
+
+    Returns an int32 array the same shape as heights holding the region id of every
+    pixel, and the number of regions. Regions are numbered in raster order of their
+    first pixel. Pixels outside mask are labelled -1 and never join a region.
+    """
+    heights = np.asarray(heights)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    from_index, to_index = _equal_height_edges(heights, mask)
+
+    # Union find over all the equal height edges at once. Each round hooks the larger
+    # root of every edge onto the smaller one, then flattens the trees.
+    parent = np.arange(heights.size, dtype=np.int64)
+    while from_index.size:
+        from_root = parent[from_index]
+        to_root = parent[to_index]
+        unmerged = from_root != to_root
+        if not unmerged.any():
+            break
+        from_index, to_index = from_index[unmerged], to_index[unmerged]
+        from_root, to_root = from_root[unmerged], to_root[unmerged]
+        np.minimum.at(parent, np.maximum(from_root, to_root), np.minimum(from_root, to_root))
+        parent = _compress(parent)
+
+    is_root = parent == np.arange(heights.size)
+    if mask is not None:
+        is_root &= mask.ravel()
+    root_ids = np.cumsum(is_root, dtype=np.int64) - 1
+    labels = root_ids[parent].astype(np.int32)
+    if mask is not None:
+        labels[~mask.ravel()] = -1
+    return labels.reshape(heights.shape), int(is_root.sum())
+
+
+def region_members(labels, num_regions):
+    """Group pixels by region.
+
+    Returns (order, starts) where order[starts[i]:starts[i + 1]] are the flat indexes of
+    the pixels in region i, in raster order.
+    """
+    flat_labels = labels.ravel()
+    order = np.argsort(flat_labels, kind="stable")
+    sizes = np.bincount(flat_labels[flat_labels >= 0], minlength=num_regions)
+    order = order[flat_labels[order] >= 0].astype(_index_dtype(flat_labels.size))
+    starts = np.zeros(num_regions + 1, dtype=np.int64)
+    np.cumsum(sizes, out=starts[1:])
+    return order, starts
+
+
+def region_adjacency(labels):
+    """Unique pairs of different regions which touch along a 4-connected edge.
+
+    Returns an (n, 2) int32 array with the smaller region id first. Masked pixels
+    (label -1) are ignored.
+    """
+    pairs = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1, :], labels[1:, :])):
+        touching = (a != b) & (a >= 0) & (b >= 0)
+        pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    pairs = np.concatenate(pairs).astype(np.int64)
+    pairs.sort(axis=1)
+    stride = int(labels.max()) + 1 if labels.size else 1
+    keys = np.sort(pairs[:, 0] * stride + pairs[:, 1])
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if keys.size else keys
+    return np.stack([keys // stride, keys % stride], axis=1).astype(np.int32)
+
+
+def adjacency_lists(pairs, num_regions):
+    """Convert region pairs into CSR neighbour arrays (indptr, indices)"""
+    sources = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    targets = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(num_regions + 1, dtype=_index_dtype(len(sources)))
+    np.cumsum(np.bincount(sources, minlength=num_regions), out=indptr[1:])
+    return indptr, targets[order].astype(np.int32)
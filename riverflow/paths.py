@@ -0,0 +1,109 @@
+# Shortest paths across the points of a single node
+# The points are laid out on a small grid covering their bounding box so the search
+# works on integer indexes, and each point only remembers its parent so the path is
+# built once at the end
+
+import heapq
+
+import numpy as np
+
+from riverflow import instrument
+
+
+def unit_cost(points):
+    return np.ones(len(points))
+
+
+def lower_point_cost(heights, weight=1.0):
+    """Cost function which makes stepping onto higher points more expensive
+
+    Stepping onto the lowest point costs 1 and onto the highest costs 1 + weight, so
+    paths keep to the deepest part of a lake or channel.
+    """
+
+    def cost(points):
+        point_heights = np.array([heights[point] for point in points], dtype=np.float64)
+        spread = point_heights.max() - point_heights.min()
+        if not spread:
+            return np.ones(len(points))
+        return 1 + weight * (point_heights - point_heights.min()) / spread
+
+    return cost
+
+
+def grid_path(points, start, goal, cost=unit_cost, heuristic=False):
+    """Cheapest 4-connected path from start to goal moving only through points
+
+    Returns the points after start up to and including goal. cost(points) gives the
+    cost of stepping onto each point and must be positive. With heuristic set the
+    search is A* with the Manhattan distance to goal, which visits fewer points but
+    may pick a different path of equal cost. Equal cost paths are otherwise broken by
+    point order, the same as a heap of (distance, point) tuples.
+    """
+    points = list(points)
+    if start not in points:
+        points.append(start)
+    point_array = np.array(points, dtype=np.int64)
+    top, left = point_array.min(axis=0) - 1
+    width = int(point_array[:, 1].max() - left + 2)
+    height = int(point_array[:, 0].max() - top + 2)
+
+    # A one point empty border means every neighbour index is inside the grid
+    flat = (point_array[:, 0] - top) * width + (point_array[:, 1] - left)
+    step_cost = np.full(height * width, np.inf)
+    step_cost[flat] = cost(points)
+    step_cost = step_cost.tolist()
+
+    start_index = int((start[0] - top) * width + start[1] - left)
+    goal_index = int((goal[0] - top) * width + goal[1] - left)
+    if step_cost[goal_index] == float("inf"):
+        raise ValueError("goal is not one of the points")
+    offsets = (-width, -1, 1, width)
+
+    if heuristic:
+        min_cost = float(np.min(step_cost))
+        goal_row, goal_col = divmod(goal_index, width)
+
+        def estimate(index):
+            row, col = divmod(index, width)
+            return min_cost * (abs(row - goal_row) + abs(col - goal_col))
+
+    else:
+
+        def estimate(index):
+            return 0
+
+    distances = {start_index: 0}
+    parents = np.full(height * width, -1, dtype=np.int64)
+    queue = [(estimate(start_index), start_index)]
+    pushes = expansions = 0
+    while queue:
+        _, index = heapq.heappop(queue)
+        if index == goal_index:
+            break
+        distance = distances[index]
+        if distance < 0:
+            # Already settled from an earlier, cheaper queue entry
+            continue
+        distances[index] = -1
+        expansions += 1
+        for offset in offsets:
+            neighbour = index + offset
+            new_distance = distance + step_cost[neighbour]
+            if new_distance < distances.get(neighbour, float("inf")):
+                distances[neighbour] = new_distance
+                parents[neighbour] = index
+                heapq.heappush(queue, (new_distance + estimate(neighbour), neighbour))
+                pushes += 1
+    else:
+        raise ValueError("goal can't be reached from start")
+    instrument.count("path_heap_pushes", pushes)
+    instrument.count("path_expansions", expansions)
+
+    path = []
+    index = goal_index
+    while index != start_index:
+        path.append(index)
+        index = parents[index]
+    rows, cols = np.divmod(np.array(path[::-1], dtype=np.int64), width)
+    return list(zip((rows + top).tolist(), (cols + left).tolist()))
@@ -0,0 +1,193 @@
+# Shared access to the GeoTIFF rasters
+# Datasets stay open for the life of the process and decoded blocks are kept in an LRU
+# cache, so repeated reads of the same area don't go back to disk
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "blocks", "nbytes", "max_bytes"])
+
+DEFAULT_CACHE_MB = int(os.environ.get("RIVERFLOW_RASTER_CACHE_MB", 512))
+DEFAULT_BLOCK_SIZE = 512
+# preprocessing/cog.py writes the cloud optimized copy of name.tif beside it as name.cog.tif
+COG_SUFFIX = ".cog.tif"
+
+
+def _nbytes(value):
+    return value.nbytes if hasattr(value, "nbytes") else len(value)
+
+
+class BlockCache:
+    """LRU cache of decoded raster blocks limited by a byte budget
+
+    Blocks are block_size square pieces of a band, keyed by (path, band, block_row,
+    block_col). Encoded bytes such as image tiles can be cached too, they are counted
+    by their length. hits/misses/evictions count lookups since the last clear.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MB * 2**20, block_size=DEFAULT_BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._blocks = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return self._blocks[key]
+            self.misses += 1
+
+        # Decode outside the lock so other threads can keep reading cached blocks
+        block = load()
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self._nbytes += _nbytes(block)
+            while self._nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self._nbytes -= _nbytes(evicted)
+                self.evictions += 1
+        return block
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self._blocks), self._nbytes, self.max_bytes)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._nbytes > self.max_bytes and self._blocks:
+                _, evicted = self._blocks.popitem(last=False)
+                self._nbytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+
+block_cache = BlockCache()
+_local = threading.local()
+
+
+def optimized_path(path):
+    """The cloud optimized copy of path when it has been converted, otherwise path"""
+    path = Path(path)
+    cog_path = path.with_suffix(COG_SUFFIX)
+    return cog_path if cog_path.exists() else path
+
+
+def open_dataset(path):
+    """Open dataset for path, reusing the handle already open in this process and thread
+
+    rasterio handles can't be shared between threads or carried over a fork, so each
+    thread of each process keeps its own.
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.datasets = {}
+    path = str(path)
+    if path not in _local.datasets:
+        _local.datasets[path] = rio.open(path)
+    return _local.datasets[path]
+
+
+def close_datasets():
+    for dataset in getattr(_local, "datasets", {}).values():
+        dataset.close()
+    _local.datasets = {}
+
+
+def _load_block(dataset, band, block_row, block_col, block_size):
+    row_off = block_row * block_size
+    col_off = block_col * block_size
+    window = rio.windows.Window(
+        col_off=col_off,
+        row_off=row_off,
+        width=min(block_size, dataset.width - col_off),
+        height=min(block_size, dataset.height - row_off),
+    )
+    return dataset.read(band, window=window)
+
+
+def read(path, window, band=1, cache=block_cache):
+    """Read a window of one band, stitched together from cached blocks
+
+    Parts of the window outside the raster are filled with zeros.
+    """
+    dataset = open_dataset(path)
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    output = np.zeros((height, width), dtype=dataset.dtypes[band - 1])
+
+    block_size = cache.block_size
+    first_row = max(row_off, 0) // block_size
+    last_row = (min(row_off + height, dataset.height) - 1) // block_size
+    first_col = max(col_off, 0) // block_size
+    last_col = (min(col_off + width, dataset.width) - 1) // block_size
+    for block_row in range(first_row, last_row + 1):
+        for block_col in range(first_col, last_col + 1):
+            block = cache.get(
+                (str(path), band, block_row, block_col),
+                lambda: _load_block(dataset, band, block_row, block_col, block_size),
+            )
+            # Overlap of the block and the window in raster coordinates
+            top = max(row_off, block_row * block_size)
+            bottom = min(row_off + height, block_row * block_size + block.shape[0])
+            left = max(col_off, block_col * block_size)
+            right = min(col_off + width, block_col * block_size + block.shape[1])
+            output[top - row_off : bottom - row_off, left - col_off : right - col_off] = block[
+                top - block_row * block_size : bottom - block_row * block_size,
+                left - block_col * block_size : right - block_col * block_size,
+            ]
+    return output
+
+
+def read_bands(path, window, bands=(1, 2, 3), cache=block_cache):
+    """Read a window of several bands as a (height, width, len(bands)) array"""
+    return np.stack([read(path, window, band, cache) for band in bands], axis=-1)
+
+
+def read_scaled(path, window, scale, bands=1):
+    """Read a window shrunk by an integer scale, averaging the pixels
+
+    GDAL reads from the file's overviews when it has them, which is far cheaper than
+    decoding the full resolution window. Parts outside the raster are zero.
+    """
+    dataset = open_dataset(path)
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    band_list = [bands] if isinstance(bands, int) else list(bands)
+    output = np.zeros((len(band_list), height // scale, width // scale), dtype=dataset.dtypes[band_list[0] - 1])
+
+    # Only read the part of the window inside the raster, in whole output pixels
+    bottom = min(row_off + height, dataset.height)
+    right = min(col_off + width, dataset.width)
+    out_height = -(-(bottom - row_off) // scale)
+    out_width = -(-(right - col_off) // scale)
+    if out_height > 0 and out_width > 0:
+        inside = rio.windows.Window(col_off, row_off, right - col_off, bottom - row_off)
+        output[:, :out_height, :out_width] = dataset.read(
+            band_list, window=inside, out_shape=(len(band_list), out_height, out_width), resampling=Resampling.average
+        )
+    return output[0] if isinstance(bands, int) else np.moveaxis(output, 0, -1)
+
+
+def cache_info():
+    return block_cache.info()
@@ -0,0 +1,221 @@
+# Compact graph of equal height regions in a height raster
+# Nodes are integer ids, a label raster maps every point to its node and the
+# neighbours are held as CSR arrays so large windows stay small in memory
+
+from collections import namedtuple
+from collections.abc import Mapping
+
+import numpy as np
+
+from riverflow.flood import border_mask
+from riverflow.labels import adjacency_lists, label_equal_heights, region_adjacency, region_members
+
+CompactGraph = namedtuple("CompactGraph", ["nodes", "labels", "heights", "sizes", "border", "indptr", "indices"])
+
+
+class RegionGraph:
+    """Graph of regions stored in NumPy arrays
+
+    labels holds the original node id of every point (-1 outside the graph) and offset is
+    the (row, col) of labels[0, 0]. indptr/indices are the CSR neighbours of the original
+    nodes. Merging nodes keeps the original arrays and records the merge in parent, so a
+    merged node is known by the smallest id of the nodes it was made from.
+    """
+
+    def __init__(self, labels, node_heights, indptr, indices, offset=(0, 0), members=None):
+        self.labels = labels
+        self.node_heights = node_heights
+        self.indptr = indptr
+        self.indices = indices
+        self.offset = offset
+        self.parent = np.arange(len(node_heights), dtype=np.int32)
+        self.alive = np.ones(len(node_heights), dtype=bool)
+        self._order, self._starts = members or region_members(labels, len(node_heights))
+        self._members = {}
+        self._merged_neighbours = {}
+
+    @classmethod
+    def from_labels(cls, labels, heights, offset=(0, 0)):
+        num_nodes = int(labels.max()) + 1 if labels.size else 0
+        order, starts = region_members(labels, num_nodes)
+        node_heights = np.asarray(heights).ravel()[order[starts[:-1]]]
+        indptr, indices = adjacency_lists(region_adjacency(labels), num_nodes)
+        return cls(labels, node_heights, indptr, indices, offset, (order, starts))
+
+    @classmethod
+    def from_heights(cls, heights, mask=None, offset=(0, 0)):
+        labels, _ = label_equal_heights(heights, mask)
+        return cls.from_labels(labels, heights, offset)
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.alive).tolist())
+
+    @property
+    def nbytes(self):
+        arrays = (self.labels, self.node_heights, self.indptr, self.indices, self.parent, self.alive)
+        return sum(i.nbytes for i in arrays) + self._order.nbytes + self._starts.nbytes
+
+    def find(self, node):
+        root = node
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[node] != root:
+            self.parent[node], node = root, self.parent[node]
+        return int(root)
+
+    def resolve(self, nodes):
+        # Vectorised find for an array of node ids
+        nodes = self.parent[nodes]
+        while True:
+            parents = self.parent[nodes]
+            if np.array_equal(parents, nodes):
+                return nodes
+            nodes = parents
+
+    def contains_point(self, point):
+        row, col = point[0] - self.offset[0], point[1] - self.offset[1]
+        return 0 <= row < self.labels.shape[0] and 0 <= col < self.labels.shape[1] and self.labels[row, col] >= 0
+
+    def node_of(self, point):
+        return self.find(self.labels[point[0] - self.offset[0], point[1] - self.offset[1]])
+
+    def height(self, node):
+        return self.node_heights[node]
+
+    def members(self, node):
+        return self._members.get(node, [node])
+
+    def size(self, node):
+        return sum(int(self._starts[i + 1] - self._starts[i]) for i in self.members(node))
+
+    def points(self, node):
+        """(rows, cols) arrays of the points in a node"""
+        flat = np.concatenate([self._order[self._starts[i] : self._starts[i + 1]] for i in self.members(node)])
+        rows, cols = np.divmod(flat, self.labels.shape[1])
+        return rows + self.offset[0], cols + self.offset[1]
+
+    def neighbours(self, node):
+        if node in self._merged_neighbours:
+            neighbours = self._merged_neighbours[node]
+        else:
+            neighbours = self.indices[self.indptr[node] : self.indptr[node + 1]]
+        neighbours = np.unique(self.resolve(neighbours))
+        return neighbours[neighbours != node]
+
+    def merge(self, nodes):
+        """Merge nodes into one node and return its id
+
+        The merged node takes the height of its highest member, which is the lake height
+        when flooding.
+        """
+        nodes = sorted({self.find(node) for node in nodes})
+        merged = nodes[0]
+        if len(nodes) == 1:
+            return merged
+        neighbours = np.concatenate([self.neighbours(node) for node in nodes])
+        self._merged_neighbours[merged] = np.setdiff1d(neighbours, nodes)
+        self._members[merged] = [i for node in nodes for i in self.members(node)]
+        self.node_heights[merged] = max(self.node_heights[node] for node in nodes)
+        for node in nodes[1:]:
+            self.parent[node] = merged
+            self.alive[node] = False
+            self._members.pop(node, None)
+            self._merged_neighbours.pop(node, None)
+        return merged
+
+    def compacted(self):
+        """The live nodes renumbered 0..n-1 as a CompactGraph, leaving this graph unchanged
+
+        nodes holds the current id of each compact node, sizes the number of points in
+        it and border whether it touches the edge of the graph.
+        """
+        nodes = np.flatnonzero(self.alive)
+        new_ids = np.cumsum(self.alive, dtype=np.int64) - 1
+        mapping = new_ids[self.resolve(np.arange(len(self.parent)))].astype(np.int32)
+        inside = self.labels >= 0
+        labels = np.where(inside, mapping[np.maximum(self.labels, 0)], -1).astype(np.int32)
+        sizes = np.bincount(labels[inside], minlength=len(nodes))
+        border = np.zeros(len(nodes), dtype=bool)
+        border[labels[border_mask(inside)]] = True
+        indptr, indices = adjacency_lists(region_adjacency(labels), len(nodes))
+        return CompactGraph(nodes, labels, self.node_heights[nodes], sizes, border, indptr, indices)
+
+    def compact(self):
+        """Renumber the live nodes 0..n-1 and rebuild the CSR arrays without merge records
+
+        Any KeyView of the graph must be recreated afterwards.
+        """
+        compacted = self.compacted()
+        self.__init__(compacted.labels, compacted.heights, compacted.indptr, compacted.indices, self.offset)
+
+    def view(self, xy=False):
+        return KeyView(self, xy)
+
+
+class KeyView(Mapping):
+    """Adapter which presents a RegionGraph as a dict of tuple of point keys
+
+    Keys are sorted tuples of points, (row, col) points or (x, y) points when xy is set,
+    and values are sets of neighbour keys. This is the interface the older algorithms
+    were written against. The view is read only, nodes are changed with merge.
+    """
+
+    def __init__(self, graph, xy=False):
+        self.graph = graph
+        self.xy = xy
+        self._keys = {}
+
+    def key(self, node):
+        if node not in self._keys:
+            rows, cols = self.graph.points(node)
+            points = zip(cols.tolist(), rows.tolist()) if self.xy else zip(rows.tolist(), cols.tolist())
+            self._keys[node] = tuple(sorted(points))
+        return self._keys[node]
+
+    def node(self, key):
+        point = key[0][::-1] if self.xy else key[0]
+        if not self.graph.contains_point(point):
+            raise KeyError(key)
+        return self.graph.node_of(point)
+
+    def node_of(self, point):
+        """Key of the node which holds point"""
+        return self.key(self.graph.node_of(point[::-1] if self.xy else point))
+
+    def _current_node(self, key):
+        # Node id of key, if key is still a node of the graph
+        try:
+            node = self.node(key)
+        except (KeyError, IndexError, TypeError):
+            return None
+        if self.graph.size(node) != len(key):
+            return None
+        return node
+
+    def __contains__(self, key):
+        return self._current_node(key) is not None
+
+    def __getitem__(self, key):
+        node = self._current_node(key)
+        if node is None:
+            raise KeyError(key)
+        return {self.key(i) for i in self.graph.neighbours(node).tolist()}
+
+    def merge(self, keys):
+        """Merge the nodes of keys into one node and return its key"""
+        nodes = [self.node(key) for key in keys]
+        for node in nodes:
+            self._keys.pop(node, None)
+        return self.key(self.graph.merge(nodes))
+
+    def __iter__(self):
+        return (self.key(node) for node in self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} nodes)"
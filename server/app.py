@@ -4,17 +4,25 @@ from pathlib import Path
 import rasterio as rio
 from flask import send_file
 from flask import jsonify
+from flask import abort, make_response, request
 from random import randint
 import numpy as np
+import gzip
 import io
+import sys
+import zlib
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import hydrology, raster
+import tiles
 
 
 app = Flask(__name__)
 
-heights_tif_path = (
+heights_tif_path = raster.optimized_path(
     Path(__name__).absolute().parent.parent.joinpath("tasmania", "heights.tif")
 )
-colour_tif_path = (
+colour_tif_path = raster.optimized_path(
     Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour.tif")
 )
 CANVAS_WIDTH = 30978
@@ -34,23 +42,24 @@ def hello_world():
 )
 @app.route("/colour/<int:width>/<int:height>/<int:left_offset>/<int:top_offset>")
 def colour(width, height, left_offset, top_offset):
-    with rio.open(colour_tif_path) as colour_src:
-        if left_offset is None:
-            left_offset = randint(0, CANVAS_WIDTH - width - 1)
-        if top_offset is None:
-            top_offset = randint(0, CANVAS_HEIGHT - height - 1)
-        w = rio.windows.Window(left_offset, top_offset, width, height)
-
-        rgbArray = np.zeros((width, height, 3), "uint8")
-        rgbArray[..., 0] = colour_src.read(1, window=w)
-        rgbArray[..., 1] = colour_src.read(2, window=w)
-        rgbArray[..., 2] = colour_src.read(3, window=w)
-
-        file_object = io.BytesIO()
-        pil_img = Image.fromarray(rgbArray)
-        pil_img.save(file_object, "PNG")
-        file_object.seek(0)
-        return send_file(file_object, mimetype="image/png")
+    if left_offset is None:
+        left_offset = randint(0, CANVAS_WIDTH - width - 1)
+    if top_offset is None:
+        top_offset = randint(0, CANVAS_HEIGHT - height - 1)
+    w = rio.windows.Window(left_offset, top_offset, width, height)
+
+    # Large windows can be shrunk with ?scale=N, which reads from the overviews
+    scale = request.args.get("scale", 1, type=int)
+    if scale > 1:
+        rgbArray = raster.read_scaled(colour_tif_path, w, scale, (1, 2, 3)).astype("uint8")
+    else:
+        rgbArray = raster.read_bands(colour_tif_path, w).astype("uint8")
+
+    file_object = io.BytesIO()
+    pil_img = Image.fromarray(rgbArray)
+    pil_img.save(file_object, "PNG")
+    file_object.seek(0)
+    return send_file(file_object, mimetype="image/png")
 
 
 @app.route(
@@ -59,27 +68,44 @@ def colour(width, height, left_offset, top_offset):
 )
 @app.route("/height_image/<int:width>/<int:height>/<int:left_offset>/<int:top_offset>")
 def height_image(width, height, left_offset, top_offset):
-    with rio.open(heights_tif_path) as heights_src:
-        if left_offset is None:
-            left_offset = randint(0, CANVAS_WIDTH - width - 1)
-        if top_offset is None:
-            top_offset = randint(0, CANVAS_HEIGHT - height - 1)
-        w = rio.windows.Window(left_offset, top_offset, width, height)
-
-        file_object = io.BytesIO()
-        height_values = heights_src.read(1, window=w)
-        min_height = height_values.min()
-
-        # Rescale Heights
-        height_range = height_values.max() - min_height
-        height_values -= min_height
-        height_values = height_values / height_range * 255
-        height_values = height_values.astype("uint8")
-
-        pil_img = Image.fromarray(height_values)
-        pil_img.save(file_object, "PNG")
-        file_object.seek(0)
-        return send_file(file_object, mimetype="image/png")
+    if left_offset is None:
+        left_offset = randint(0, CANVAS_WIDTH - width - 1)
+    if top_offset is None:
+        top_offset = randint(0, CANVAS_HEIGHT - height - 1)
+    w = rio.windows.Window(left_offset, top_offset, width, height)
+
+    file_object = io.BytesIO()
+    scale = request.args.get("scale", 1, type=int)
+    if scale > 1:
+        height_values = raster.read_scaled(heights_tif_path, w, scale)
+    else:
+        height_values = raster.read(heights_tif_path, w)
+    min_height = height_values.min()
+
+    # Rescale Heights
+    height_range = height_values.max() - min_height
+    height_values -= min_height
+    height_values = height_values / height_range * 255
+    height_values = height_values.astype("uint8")
+
+    pil_img = Image.fromarray(height_values)
+    pil_img.save(file_object, "PNG")
+    file_object.seek(0)
+    return send_file(file_object, mimetype="image/png")
+
+
+# Windows up to this many points are sent as JSON unless another format is asked for
+JSON_MAX_POINTS = 256 * 256
+
+
+def encode_body(body):
+    # Compress with gzip or deflate when the client accepts it. Level 1 as most of the
+    # gain on height data comes at the lowest level and it keeps throughput high
+    if "gzip" in request.accept_encodings:
+        return gzip.compress(body, compresslevel=1), "gzip"
+    if "deflate" in request.accept_encodings:
+        return zlib.compress(body, 1), "deflate"
+    return body, None
 
 
 @app.route(
@@ -88,15 +114,91 @@ def height_image(width, height, left_offset, top_offset):
 )
 @app.route("/height/<int:width>/<int:height>/<int:left_offset>/<int:top_offset>")
 def height(width, height, left_offset, top_offset):
-    with rio.open(heights_tif_path) as heights_src:
-        if left_offset is None:
-            left_offset = randint(0, CANVAS_WIDTH - width - 1)
-        if top_offset is None:
-            top_offset = randint(0, CANVAS_HEIGHT - height - 1)
-        w = rio.windows.Window(left_offset, top_offset, width, height)
-        height_values = heights_src.read(1, window=w)
+    """Heights of a window as JSON, a .npy file or raw little endian int16
+
+    Choose with ?format=json|npy|raw, the default is JSON for small windows and npy
+    for larger ones. Binary responses give the shape and offset in X-Height-Shape
+    (rows,cols) and X-Height-Offset (left,top) headers.
+    """
+    if left_offset is None:
+        left_offset = randint(0, CANVAS_WIDTH - width - 1)
+    if top_offset is None:
+        top_offset = randint(0, CANVAS_HEIGHT - height - 1)
+    default_format = "json" if width * height <= JSON_MAX_POINTS else "npy"
+    response_format = request.args.get("format", default_format)
+    if response_format not in ("json", "npy", "raw"):
+        abort(400, f"Unknown format {response_format}")
+
+    w = rio.windows.Window(left_offset, top_offset, width, height)
+    height_values = raster.read(heights_tif_path, w)
+    if response_format == "json":
         return jsonify(height_values.tolist())
 
+    height_values = height_values.astype("<i2", copy=False)
+    if response_format == "npy":
+        file_object = io.BytesIO()
+        np.save(file_object, height_values)
+        body, mimetype = file_object.getvalue(), "application/x-npy"
+    else:
+        body, mimetype = height_values.tobytes(), "application/octet-stream"
+
+    body, content_encoding = encode_body(body)
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.headers["X-Height-Shape"] = "{},{}".format(*height_values.shape)
+    response.headers["X-Height-Dtype"] = "<i2"
+    response.headers["X-Height-Offset"] = f"{left_offset},{top_offset}"
+    response.vary.add("Accept-Encoding")
+    if content_encoding:
+        response.content_encoding = content_encoding
+    return response
+
+
+@app.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>")
+@app.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>.png")
+def tile(layer, z, x, y):
+    if not tiles.tile_exists(layer, z, x, y):
+        abort(404)
+
+    # Tiles only change when the source raster does, so clients can cache them
+    etag = tiles.etag(layer, z, x, y)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(tiles.tile_png(layer, z, x, y))
+        response.mimetype = "image/png"
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+
+@app.route("/downstream/<int:left_offset>/<int:top_offset>")
+def downstream(left_offset, top_offset):
+    """Catchment size and downstream path of a point, from the rasters made by
+    preprocessing/flow_rasters.py"""
+    data_path = heights_tif_path.parent
+    directions_path = data_path.joinpath(hydrology.OUTPUT_NAMES["directions"])
+    accumulation_path = data_path.joinpath(hydrology.OUTPUT_NAMES["accumulation"])
+    if not directions_path.exists() or not accumulation_path.exists():
+        abort(404, "Flow rasters haven't been computed")
+    if not (0 <= left_offset < CANVAS_WIDTH and 0 <= top_offset < CANVAS_HEIGHT):
+        abort(404)
+
+    max_length = request.args.get("max_length", 10000, type=int)
+    path = hydrology.downstream_path(directions_path, (top_offset, left_offset), max_length)
+    return jsonify(
+        {
+            "catchment_size": hydrology.catchment_size(accumulation_path, (top_offset, left_offset)),
+            "path": [[col, row] for row, col in path],
+        }
+    )
+
+
+@app.route("/raster_cache")
+def raster_cache():
+    return jsonify(raster.cache_info()._asdict())
+
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,179 @@
+"""XYZ tile pyramid for the colour and height rasters
+
+Zoom level max_zoom(layer) is full resolution and every level above halves it, so
+zoom 0 is a single tile covering the whole raster. Tiles at full resolution are read
+from the raster. Tiles above are made from their four children when those have been
+rendered since the source raster last changed, otherwise they are read scaled down
+from the raster so a request never has to render a whole subtree. Every tile is
+stored as a PNG on disk and kept in a memory LRU, so a tile is only rendered once per
+change of the source raster.
+
+Run this file to render the whole pyramid ahead of time.
+"""
+
+import io
+import math
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from PIL import Image
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import raster
+
+TILE_SIZE = 256
+MIN_HEIGHT = -86
+MAX_HEIGHT = 1610
+
+data_path = Path(__file__).absolute().parent.parent.joinpath("tasmania")
+LAYERS = {
+    "colour": raster.optimized_path(data_path.joinpath("colour.tif")),
+    "height": raster.optimized_path(data_path.joinpath("heights.tif")),
+}
+tile_path = Path(os.environ.get("RIVERFLOW_TILE_DIR", data_path.joinpath("tiles")))
+tile_cache = raster.BlockCache(
+    max_bytes=int(os.environ.get("RIVERFLOW_TILE_CACHE_MB", 128)) * 2**20
+)
+
+
+def raster_size(layer):
+    dataset = raster.open_dataset(LAYERS[layer])
+    return dataset.width, dataset.height
+
+
+def max_zoom(layer):
+    return max(0, math.ceil(math.log2(max(raster_size(layer)) / TILE_SIZE)))
+
+
+def tile_span(layer, z):
+    # Number of full resolution pixels along each side of a tile at zoom z
+    return TILE_SIZE * 2 ** (max_zoom(layer) - z)
+
+
+def tile_exists(layer, z, x, y):
+    if layer not in LAYERS or not 0 <= z <= max_zoom(layer):
+        return False
+    width, height = raster_size(layer)
+    span = tile_span(layer, z)
+    return 0 <= x < math.ceil(width / span) and 0 <= y < math.ceil(height / span)
+
+
+def source_version(layer):
+    return int(os.path.getmtime(LAYERS[layer]))
+
+
+def etag(layer, z, x, y):
+    return f"{layer}-{z}-{x}-{y}-{source_version(layer)}"
+
+
+def _scale_heights(heights):
+    # Heights use a fixed scale so neighbouring tiles match
+    scaled = (heights.astype(np.float32) - MIN_HEIGHT) / (MAX_HEIGHT - MIN_HEIGHT) * 255
+    return np.clip(scaled, 0, 255).astype("uint8")
+
+
+def _render_from_raster(layer, z, x, y):
+    span = tile_span(layer, z)
+    window = rio.windows.Window(x * span, y * span, span, span)
+    scale = span // TILE_SIZE
+    if layer == "colour":
+        if scale == 1:
+            return raster.read_bands(LAYERS[layer], window).astype("uint8")
+        return raster.read_scaled(LAYERS[layer], window, scale, (1, 2, 3)).astype(
+            "uint8"
+        )
+    if scale == 1:
+        return _scale_heights(raster.read(LAYERS[layer], window))
+    return _scale_heights(raster.read_scaled(LAYERS[layer], window, scale))
+
+
+def _children_rendered(layer, z, x, y):
+    # Stale children would have to be rendered again, and theirs below them, so only
+    # children rendered since the source last changed count
+    return all(
+        not tile_exists(layer, z + 1, 2 * x + dx, 2 * y + dy)
+        or (layer, z + 1, 2 * x + dx, 2 * y + dy, source_version(layer)) in tile_cache
+        or _tile_file_fresh(layer, z + 1, 2 * x + dx, 2 * y + dy)
+        for dx in (0, 1)
+        for dy in (0, 1)
+    )
+
+
+def _render_from_children(layer, z, x, y):
+    children = [
+        [tile_array(layer, z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1)]
+        for dy in (0, 1)
+    ]
+    joined = np.concatenate([np.concatenate(row, axis=1) for row in children], axis=0)
+    # Average each 2x2 block of pixels
+    shape = (TILE_SIZE, 2, TILE_SIZE, 2) + joined.shape[2:]
+    return joined.reshape(shape).mean(axis=(1, 3)).astype("uint8")
+
+
+def _empty_tile(layer):
+    shape = (TILE_SIZE, TILE_SIZE, 3) if layer == "colour" else (TILE_SIZE, TILE_SIZE)
+    return np.zeros(shape, dtype="uint8")
+
+
+def _tile_file(layer, z, x, y):
+    return tile_path.joinpath(layer, str(z), str(x), f"{y}.png")
+
+
+def _tile_file_fresh(layer, z, x, y):
+    # Whether the tile's PNG was written after the source raster last changed
+    path = _tile_file(layer, z, x, y)
+    return path.exists() and os.path.getmtime(path) >= source_version(layer)
+
+
+def _load_or_render(layer, z, x, y):
+    path = _tile_file(layer, z, x, y)
+    if _tile_file_fresh(layer, z, x, y):
+        return path.read_bytes()
+
+    if z < max_zoom(layer) and _children_rendered(layer, z, x, y):
+        array = _render_from_children(layer, z, x, y)
+    else:
+        array = _render_from_raster(layer, z, x, y)
+    file_object = io.BytesIO()
+    Image.fromarray(array).save(file_object, "PNG")
+    png = file_object.getvalue()
+
+    # Write then rename so a reader never sees half a file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+    temporary_path.write_bytes(png)
+    os.replace(temporary_path, path)
+    return png
+
+
+def tile_png(layer, z, x, y):
+    """PNG bytes of a tile, rendering it if it isn't cached"""
+    return tile_cache.get(
+        (layer, z, x, y, source_version(layer)),
+        lambda: _load_or_render(layer, z, x, y),
+    )
+
+
+def tile_array(layer, z, x, y):
+    if not tile_exists(layer, z, x, y):
+        return _empty_tile(layer)
+    return np.asarray(Image.open(io.BytesIO(tile_png(layer, z, x, y))))
+
+
+def build_pyramid(layer):
+    """Render every tile of a layer, starting at full resolution"""
+    for z in range(max_zoom(layer), -1, -1):
+        width, height = raster_size(layer)
+        span = tile_span(layer, z)
+        for x in range(math.ceil(width / span)):
+            for y in range(math.ceil(height / span)):
+                tile_png(layer, z, x, y)
+        print(f"Rendered {layer} zoom {z}")
+
+
+if __name__ == "__main__":
+    for layer in sys.argv[1:] or LAYERS:
+        build_pyramid(layer)
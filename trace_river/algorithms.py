@@ -1,7 +1,16 @@
-import heapq
+import sys
+from collections import defaultdict
+from itertools import chain
+from pathlib import Path
 
+import numpy as np
 from tqdm import tqdm
 
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import instrument
+from riverflow.flood import priority_flood
+from riverflow.labels import label_equal_heights, region_adjacency, region_members
+
 
 def get_adjacent_nodes(grid_size, active_segments, y, x):
     output = []
@@ -34,72 +43,193 @@ def replace_tuple_value(original, old, new):
     return list(i for i in original if i != old) + [new]
 
 
-def add_segment_to_graph(graph, heights, grid_size, added_segment, active_segments):
-    print(
-        f"Adding segment {added_segment[0]*grid_size}, {added_segment[1]*grid_size}. Size {grid_size}"
+def segment_slices(grid_size, segment):
+    return (
+        slice(segment[0] * grid_size, (segment[0] + 1) * grid_size),
+        slice(segment[1] * grid_size, (segment[1] + 1) * grid_size),
     )
-    node_merge_operations = []
-    skip_points = set()
-    non_skip_points = []
-
-    for point in get_points_in_segment(added_segment, grid_size):
-        if point not in skip_points:
-            height = heights[point]
-            visited, queue = set(), [point]
-            while queue:
-                vertex = queue.pop(0)
-                if vertex not in visited:
-                    visited.add(vertex)
-                    adjacent_nodes = get_adjacent_nodes(
-                        grid_size, active_segments, *vertex
-                    )
-                    adjacent_equal_height = {
-                        i for i in adjacent_nodes if heights[i] == height
-                    }
-                    queue.extend(adjacent_equal_height - visited - skip_points)
-
-            if visited != {point}:
-                node_merge_operations.append(visited)
-                for node in visited:
-                    skip_points.add(node)
+
+
+def label_segment(segment_heights):
+    # Equal height regions of one segment and which of them touch
+    labels, num_regions = label_equal_heights(segment_heights)
+    return labels, num_regions, region_adjacency(labels)
+
+
+def seam_points(grid_size, segment, side):
+    """(row, col) points along one side of a segment, and the points facing them across the seam"""
+    top, left = segment[0] * grid_size, segment[1] * grid_size
+    along = np.arange(grid_size)
+    if side == "top":
+        rows, cols = np.full(grid_size, top), left + along
+        return (rows, cols), (rows - 1, cols)
+    if side == "bottom":
+        rows, cols = np.full(grid_size, top + grid_size - 1), left + along
+        return (rows, cols), (rows + 1, cols)
+    if side == "left":
+        rows, cols = top + along, np.full(grid_size, left)
+        return (rows, cols), (rows, cols - 1)
+    rows, cols = top + along, np.full(grid_size, left + grid_size - 1)
+    return (rows, cols), (rows, cols + 1)
+
+
+SIDES = {"top": (-1, 0), "bottom": (1, 0), "left": (0, -1), "right": (0, 1)}
+
+
+def add_segments_to_graph(graph, heights, grid_size, added_segments, active_segments):
+    """Add the equal height nodes of several new segments to graph in one pass
+
+    The new segments must already be in active_segments and heights. Each segment is
+    labelled on its own, then the seams between the new segments and with the segments
+    already in the graph are stitched together: equal height regions either side of a
+    seam join into one node and other regions across a seam become neighbours.
+    """
+    added_segments = list(added_segments)
+    if not added_segments:
+        return graph
+    for segment in added_segments:
+        print(
+            f"Adding segment {segment[0]*grid_size}, {segment[1]*grid_size}. Size {grid_size}"
+        )
+    segment_heights = [
+        heights[segment_slices(grid_size, segment)] for segment in added_segments
+    ]
+    with instrument.timer("label_segments"):
+        labelled = [label_segment(i) for i in segment_heights]
+
+    # Regions of all the new segments are numbered together
+    offsets = np.cumsum([0] + [num_regions for _, num_regions, _ in labelled])
+    segment_index = {segment: i for i, segment in enumerate(added_segments)}
+    region_points = []
+    region_pairs = []
+    for segment, (labels, num_regions, pairs), offset in zip(
+        added_segments, labelled, offsets
+    ):
+        order, starts = region_members(labels, num_regions)
+        rows, cols = np.divmod(order, grid_size)
+        points = list(
+            zip(
+                (rows + segment[0] * grid_size).tolist(),
+                (cols + segment[1] * grid_size).tolist(),
+            )
+        )
+        region_points += [points[starts[i] : starts[i + 1]] for i in range(num_regions)]
+        region_pairs.append(pairs + offset)
+    num_regions = int(offsets[-1])
+
+    parent = list(range(num_regions))
+
+    def find(region):
+        while parent[region] != region:
+            parent[region] = parent[parent[region]]
+            region = parent[region]
+        return region
+
+    def region_of(segment, rows, cols):
+        i = segment_index[segment]
+        labels = labelled[i][0]
+        return (
+            labels[rows - segment[0] * grid_size, cols - segment[1] * grid_size]
+            + offsets[i]
+        )
+
+    # Stitch the seams. Regions touching the same existing node join into one node
+    # together with every existing node they touch
+    existing_nodes = defaultdict(set)
+    existing_neighbours = defaultdict(set)
+    for segment, block in zip(added_segments, segment_heights):
+        for side, (dr, dc) in SIDES.items():
+            other = (segment[0] + dr, segment[1] + dc)
+            if other not in active_segments:
+                continue
+            (rows, cols), (other_rows, other_cols) = seam_points(
+                grid_size, segment, side
+            )
+            other_block = heights[segment_slices(grid_size, other)]
+            same_height = (
+                block[rows - segment[0] * grid_size, cols - segment[1] * grid_size]
+                == other_block[
+                    other_rows - other[0] * grid_size, other_cols - other[1] * grid_size
+                ]
+            ).tolist()
+            regions = region_of(segment, rows, cols).tolist()
+            if other in segment_index:
+                if side in ("top", "left"):
+                    # Each seam between two new segments is stitched once
+                    continue
+                other_regions = region_of(other, other_rows, other_cols).tolist()
+                for a, b, same in zip(regions, other_regions, same_height):
+                    if same:
+                        parent[find(a)] = find(b)
+                    else:
+                        region_pairs.append(np.array([[a, b]]))
+            else:
+                other_points = zip(other_rows.tolist(), other_cols.tolist())
+                for region, point, same in zip(regions, other_points, same_height):
+                    node = graph.node_of(point)
+                    if same:
+                        existing_nodes[region].add(node)
+                    else:
+                        existing_neighbours[region].add(node)
+
+    first_region = {}
+    for region in sorted(existing_nodes):
+        for node in existing_nodes[region]:
+            if node in first_region:
+                parent[find(region)] = find(first_region[node])
             else:
-                non_skip_points.append(point)
-
-    # We have all the node merge operations
-    key_lookup = {k: key for key in graph.keys() for k in key}
-    node_merge_operations = [tuple(sorted(i)) for i in node_merge_operations]
-
-    # Clear out any existing points on the graph which include these points
-    # Update key lookup to use the new node_keys
-
-    for node_key in node_merge_operations:
-        assert (
-            node_key not in graph
-        ), "Node merging operation not required if merged key already exists"
-        for point in node_key:
-            if key_lookup.get(point) in graph:
-                del graph[key_lookup[point]]
-            key_lookup[point] = node_key
-
-    isolated_new_points = set(get_points_in_segment(added_segment, grid_size))
-    isolated_new_points -= {j for i in node_merge_operations for j in i}
-    new_nodes_to_add = node_merge_operations + [(i,) for i in isolated_new_points]
-
-    # Now go through each new node
-    # Find it's neighbours
-    # Create entries in the graph which link the neighbours
-    for node_key in new_nodes_to_add:
-        neighbours = set()
-        for point in node_key:
-            adjacent_points = get_adjacent_nodes(grid_size, active_segments, *point)
-            for adjacent_point in adjacent_points:
-                if adjacent_point not in node_key:
-                    neighbours.add(key_lookup.get(adjacent_point, (adjacent_point,)))
-        graph[node_key] = neighbours
+                first_region[node] = region
+
+    groups = defaultdict(list)
+    for region in range(num_regions):
+        groups[find(region)].append(region)
+
+    new_keys = {}
+    replaced_nodes = {}
+    for root, regions in groups.items():
+        nodes = {node for region in regions for node in existing_nodes.get(region, ())}
+        new_keys[root] = tuple(
+            sorted(
+                [point for region in regions for point in region_points[region]]
+                + [point for node in nodes for point in node]
+            )
+        )
+        for node in nodes:
+            replaced_nodes[node] = new_keys[root]
+
+    # Neighbours come from regions touching inside and across the seams, and from the
+    # existing neighbours of any existing nodes which were merged
+    neighbours = {key: set() for key in new_keys.values()}
+
+    def connect(key, neighbour_key):
+        if neighbour_key != key:
+            neighbours[key].add(neighbour_key)
+            if neighbour_key in neighbours:
+                neighbours[neighbour_key].add(key)
+
+    for a, b in np.concatenate(region_pairs).tolist():
+        connect(new_keys[find(a)], new_keys[find(b)])
+    for region, nodes in existing_neighbours.items():
+        for node in nodes:
+            connect(new_keys[find(region)], replaced_nodes.get(node, node))
+    for node, key in replaced_nodes.items():
+        for neighbour in graph[node]:
+            connect(key, replaced_nodes.get(neighbour, neighbour))
+
+    for node in replaced_nodes:
+        del graph[node]
+    graph.add_nodes(neighbours)
+    instrument.count("nodes_replaced", len(replaced_nodes))
 
     return graph
 
 
+def add_segment_to_graph(graph, heights, grid_size, added_segment, active_segments):
+    return add_segments_to_graph(
+        graph, heights, grid_size, [added_segment], active_segments
+    )
+
+
 def does_node_touch_border(active_segments, grid_size, point):
     if (point[0] // grid_size, (point[1] - 1) // grid_size) not in active_segments:
         return True
@@ -143,25 +273,28 @@ def generate_existing_points_touching_new_segment(
 
 
 def flood_added_segment(graph, heights, grid_size, added_segment, active_segments):
-    low_nodes = []
-    key_lookup = {k: key for key in graph.keys() for k in key}
+    return flood_added_segments(
+        graph, heights, grid_size, [added_segment], active_segments
+    )
 
-    nodes_which_could_be_low_points = {
-        key_lookup[adjacent_point]
-        for point in get_points_in_segment(added_segment, grid_size)
-        for adjacent_point in get_adjacent_nodes(grid_size, active_segments, *point)
-    }
 
-    existing_points_which_could_be_low = generate_existing_points_touching_new_segment(
-        grid_size, added_segment, active_segments
-    )
-    existing_nodes_which_could_be_low = [
-        key_lookup[point] for point in existing_points_which_could_be_low
-    ]
-    nodes_which_could_be_low_points.update(existing_nodes_which_could_be_low)
+def nodes_of_points(graph, points):
+    """The distinct nodes holding points
+
+    Node keys can hold thousands of points and hashing a key hashes every point, so
+    nodes are told apart by their first point instead of collecting keys in a set.
+    """
+    nodes = {}
+    for point in points:
+        key = graph.node_of(point)
+        nodes[key[0]] = key
+    return list(nodes.values())
 
-    for node_key in nodes_which_could_be_low_points:
-        adjacent_nodes = graph[node_key]
+
+def find_low_nodes(graph, heights, grid_size, active_segments, nodes):
+    # Nodes away from the border of the active area with no lower neighbour
+    low_nodes = []
+    for node_key in nodes:
         if any(
             does_node_touch_border(active_segments, grid_size, point)
             for point in node_key
@@ -169,84 +302,138 @@ def flood_added_segment(graph, heights, grid_size, added_segment, active_segment
             continue
 
         height = heights[node_key[0]]
-        for adjacent_node_key in adjacent_nodes:
+        for adjacent_node_key in graph[node_key]:
             if height > heights[adjacent_node_key[0]]:
                 break
         else:
             low_nodes.append(node_key)
+    return low_nodes
+
+
+def flood_added_segments(graph, heights, grid_size, added_segments, active_segments):
+    active_segments = set(active_segments)
+    # Points of the new segments and the points next to them in existing segments
+    nodes_which_could_be_low_points = nodes_of_points(
+        graph,
+        chain.from_iterable(
+            get_points_in_segment(added_segment, grid_size)
+            + generate_existing_points_touching_new_segment(
+                grid_size, added_segment, active_segments
+            )
+            for added_segment in added_segments
+        ),
+    )
+    low_nodes = find_low_nodes(
+        graph, heights, grid_size, active_segments, nodes_which_could_be_low_points
+    )
 
     if not low_nodes:
         return graph, heights
 
-    for low_node in low_nodes:
-        if low_node not in graph:
-            continue
-        lake_height = heights[low_node[0]]
-        for neighbour in graph[low_node]:
-            if heights[neighbour[0]] < lake_height:
-                continue
-        queue = [(lake_height, low_node)]
-        nodes_in_queue = {low_node}
-        merging_nodes = {low_node}
-
-        while True:
-            try:
-                node_height, node = heapq.heappop(queue)
-            except IndexError:
-                print("heap ran out of items but it shouldn't")
-                break
-            if node_height < lake_height:
-                break
-            lake_height = node_height
-            merging_nodes.add(node)
-            if any(
-                does_node_touch_border(active_segments, grid_size, point)
+    # Flood the new segments and the segments around them, which is as far as a lake
+    # made by covering the old border usually reaches. A low node left on the edge of
+    # the flooded area means a lake reaches further, so the area grows to take it in
+    flood_segments = segments_around(added_segments, active_segments)
+    while True:
+        edge_nodes = flood_segments_and_merge_lakes(
+            graph, heights, grid_size, flood_segments, active_segments
+        )
+        low_nodes = find_low_nodes(
+            graph, heights, grid_size, active_segments, edge_nodes
+        )
+        grown_segments = flood_segments | segments_around(
+            {
+                (point[0] // grid_size, point[1] // grid_size)
+                for node in low_nodes
                 for point in node
-            ):
-                break
-            for adjacent_node in graph[node]:
-                if adjacent_node not in nodes_in_queue:
-                    nodes_in_queue.add(adjacent_node)
-                    heapq.heappush(queue, (heights[adjacent_node[0]], adjacent_node))
-
-        # Add all equal height nodes
-        while True:
-            try:
-                node_height, node = heapq.heappop(queue)
-            except IndexError:
-                break
+            },
+            active_segments,
+        )
+        if grown_segments == flood_segments:
+            return graph, heights
+        instrument.count("flood_regrown")
+        flood_segments = grown_segments
+
+
+def segments_around(segments, active_segments):
+    # The active segments among segments and the eight segments around each of them
+    return {
+        (segment[0] + row, segment[1] + col)
+        for segment in segments
+        for row in (-1, 0, 1)
+        for col in (-1, 0, 1)
+    } & set(active_segments)
 
-            # Don't merge the outflow points to the lake
-            if node_height < lake_height:
-                continue
-            elif node_height == lake_height:
-                merging_nodes.add(node)
-                for adjacent_node in graph[node]:
-                    if adjacent_node not in nodes_in_queue:
-                        nodes_in_queue.add(adjacent_node)
-                        heapq.heappush(
-                            queue, (heights[adjacent_node[0]], adjacent_node)
-                        )
-            else:
-                break
 
-        merged_node_key = tuple(
-            sorted({node for node_key in merging_nodes for node in node_key})
+def flood_segments_and_merge_lakes(
+    graph, heights, grid_size, flood_segments, active_segments
+):
+    """Fill the depressions of flood_segments and merge each lake into one node
+
+    Water leaves through the border of the active area and into active points just
+    outside flood_segments, at the height of that point, since the rest of the active
+    area is already flooded. Every lake together with the equal height points around it
+    becomes one node. Returns the nodes holding those outside points.
+    """
+    top = max(min(segment[0] for segment in flood_segments) * grid_size - 1, 0)
+    bottom = min(
+        (max(segment[0] for segment in flood_segments) + 1) * grid_size + 1,
+        heights.shape[0],
+    )
+    left = max(min(segment[1] for segment in flood_segments) * grid_size - 1, 0)
+    right = min(
+        (max(segment[1] for segment in flood_segments) + 1) * grid_size + 1,
+        heights.shape[1],
+    )
+    inside = np.zeros((bottom - top, right - left), dtype=bool)
+    active = np.zeros(inside.shape, dtype=bool)
+    for segment in segments_around(flood_segments, active_segments):
+        row, col = segment[0] * grid_size - top, segment[1] * grid_size - left
+        window = (
+            slice(max(row, 0), row + grid_size),
+            slice(max(col, 0), col + grid_size),
         )
-        for point in merged_node_key:
-            heights[point] = lake_height
-        neighbours = {
-            neighbour
-            for merging_node in merging_nodes
-            for neighbour in graph[merging_node]
-        } - set(merging_nodes)
-
-        # merged_node_key is the new node key. It includes all the nodes in merging_nodes
-        # Get all the neighbours the new node should have
-        # Delete the old nodes
-        # Add the new node
-        for merging_node in merging_nodes:
-            del graph[merging_node]
-        graph[merged_node_key] = neighbours
-
-    return graph, heights
+        active[window] = True
+        if segment in flood_segments:
+            inside[window] = True
+    touching = inside.copy()
+    touching[1:] |= inside[:-1]
+    touching[:-1] |= inside[1:]
+    touching[:, 1:] |= inside[:, :-1]
+    touching[:, :-1] |= inside[:, 1:]
+    outlets = touching & active & ~inside
+    mask = inside | outlets
+
+    with instrument.timer("priority_flood"):
+        filled, lake_ids = priority_flood(
+            heights[top:bottom, left:right], mask, outlets
+        )
+    # Only write back to flooded segments so sparse heights don't grow into the gaps
+    for segment in flood_segments:
+        rows = slice(segment[0] * grid_size, (segment[0] + 1) * grid_size)
+        cols = slice(segment[1] * grid_size, (segment[1] + 1) * grid_size)
+        heights[rows, cols] = filled[
+            rows.start - top : rows.stop - top, cols.start - left : cols.stop - left
+        ]
+    regions, num_regions = label_equal_heights(filled, mask)
+    lake_regions = np.unique(regions[lake_ids >= 0])
+    order, starts = region_members(regions, num_regions)
+    rows, cols = np.divmod(order, mask.shape[1])
+    rows, cols = (rows + top).tolist(), (cols + left).tolist()
+
+    for region in lake_regions.tolist():
+        merging_nodes = nodes_of_points(
+            graph,
+            zip(
+                rows[starts[region] : starts[region + 1]],
+                cols[starts[region] : starts[region + 1]],
+            ),
+        )
+        graph.merge(merging_nodes)
+        instrument.count("nodes_merged", len(merging_nodes))
+    instrument.count("lakes_flooded", len(lake_regions))
+
+    outlet_rows, outlet_cols = np.nonzero(outlets)
+    return nodes_of_points(
+        graph, zip((outlet_rows + top).tolist(), (outlet_cols + left).tolist())
+    )
@@ -0,0 +1,174 @@
+"""Trace many rivers, reusing the graph between rivers in the same area
+
+python batch.py rivers.json [--workers 4] [--output traces.jsonl] [--plot] [--profile]
+
+rivers.json is a list of {"name": ..., "start": [lat, lon], "end": [lat, lon]}. Rivers
+whose segments come within REGION_MARGIN segments of each other are one region and are
+traced one after another in the same TraceSession, so segments loaded and flooded for
+one river are reused by the next. Separate regions are traced on separate processes.
+Results are streamed, one JSON line is written per river as soon as it is traced.
+With --profile the time spent in each stage of every trace is printed, and with
+--profile-folder it is also written there as <name>.json.
+"""
+
+import argparse
+import json
+import multiprocessing
+import queue
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from trace import (
+    GRID,
+    TraceSession,
+    find_centerpoint,
+    lat_lon_to_row_col,
+    path_profile,
+)
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import instrument
+
+REGION_MARGIN = 5
+
+# profile is the elevation profile, timings the recorded timers and counters of a
+# profiled trace
+RiverTrace = namedtuple(
+    "RiverTrace",
+    ["index", "name", "start", "end", "distance", "profile", "path", "timings"],
+)
+
+
+def river_bounds(river):
+    # (top, bottom, left, right) segments covered by the start and end of a river
+    rows, cols = zip(
+        *(lat_lon_to_row_col(*river[key]) for key in ("start", "end")),
+    )
+    return (
+        min(rows) // GRID,
+        max(rows) // GRID,
+        min(cols) // GRID,
+        max(cols) // GRID,
+    )
+
+
+def group_rivers(rivers, margin=REGION_MARGIN):
+    """Split rivers into regions, lists of indexes of rivers near each other"""
+    bounds = [river_bounds(river) for river in rivers]
+    parent = list(range(len(rivers)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for i, a in enumerate(bounds):
+        for j in range(i):
+            b = bounds[j]
+            if (
+                a[0] - margin <= b[1]
+                and b[0] - margin <= a[1]
+                and a[2] - margin <= b[3]
+                and b[2] - margin <= a[3]
+            ):
+                parent[find(i)] = find(j)
+
+    regions = {}
+    for index in range(len(rivers)):
+        regions.setdefault(find(index), []).append(index)
+    return list(regions.values())
+
+
+def trace_region(rivers, indexes, plot=False, profile=False):
+    """Trace the rivers of one region in order, yielding a RiverTrace for each"""
+    with TraceSession() as session:
+        for index in indexes:
+            river = rivers[index]
+            path = session.trace(
+                river["start"], river["end"], plot=plot, profile=profile
+            )
+            elevation = path_profile(path, session.heights)
+            yield RiverTrace(
+                index=index,
+                name=river.get("name", str(index)),
+                start=tuple(river["start"]),
+                end=tuple(river["end"]),
+                distance=elevation[0][-1],
+                profile=list(zip(elevation[0], [int(i) for i in elevation[1]])),
+                path=[find_centerpoint(node) for node in path],
+                timings=session.last_profile.as_dict() if profile else None,
+            )
+
+
+def _trace_region_worker(rivers, indexes, results, profile):
+    for result in trace_region(rivers, indexes, profile=profile):
+        results.put(result)
+
+
+def trace_rivers(rivers, max_workers=None, plot=False, profile=False):
+    """Trace every river, yielding a RiverTrace for each in the order they finish
+
+    Regions are traced on up to max_workers processes. With plot, or with only one
+    region or worker, everything is traced in this process.
+    """
+    regions = group_rivers(rivers)
+    if plot or max_workers == 1 or len(regions) == 1:
+        for indexes in regions:
+            yield from trace_region(rivers, indexes, plot=plot, profile=profile)
+        return
+
+    with multiprocessing.Manager() as manager:
+        results = manager.Queue()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_trace_region_worker, rivers, indexes, results, profile)
+                for indexes in regions
+            ]
+            remaining = len(rivers)
+            while remaining:
+                try:
+                    yield results.get(timeout=1)
+                    remaining -= 1
+                except queue.Empty:
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace a list of rivers")
+    parser.add_argument("rivers", help="JSON list of rivers with name, start and end")
+    parser.add_argument("--workers", type=int, default=None, help="region processes")
+    parser.add_argument("--output", default="traces.jsonl", help="JSON lines output")
+    parser.add_argument("--plot", action="store_true", help="draw each trace")
+    parser.add_argument("--profile", action="store_true", help="time each stage")
+    parser.add_argument("--profile-folder", help="write each river's timings here")
+    arguments = parser.parse_args()
+
+    with open(arguments.rivers) as f:
+        rivers = json.load(f)
+    print(f"Tracing {len(rivers)} rivers in {len(group_rivers(rivers))} regions")
+
+    profile = arguments.profile or arguments.profile_folder is not None
+    if arguments.profile_folder:
+        Path(arguments.profile_folder).mkdir(parents=True, exist_ok=True)
+
+    with open(arguments.output, "w") as output:
+        results = trace_rivers(rivers, arguments.workers, arguments.plot, profile)
+        for result in results:
+            output.write(json.dumps(result._asdict()) + "\n")
+            output.flush()
+            print(f"Traced {result.name} River distance {result.distance:.2f}km")
+            if arguments.profile:
+                print(instrument.summary(result.timings, total="trace"))
+            if arguments.profile_folder:
+                path = Path(arguments.profile_folder).joinpath(f"{result.name}.json")
+                with open(path, "w") as f:
+                    json.dump({"name": result.name, **result.timings}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
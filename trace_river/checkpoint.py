@@ -0,0 +1,182 @@
+"""Save and load everything a trace needs to carry on after a restart
+
+A checkpoint is one compressed .npz file holding the loaded heights, the graph and the
+progress of the trace. Points are stored as flat indexes, row * width + col, and nodes
+are numbered in the order the graph iterates them:
+
+    segments        active segments in the order they were added, (k, 2)
+    tiles           flooded heights of each active segment, (k, grid, grid)
+    labels          node number of every point of each active segment, (k, grid, grid)
+    indptr indices  neighbours of node i are indices[indptr[i]:indptr[i + 1]]
+    path            node numbers of the path so far
+    closest         points of the closest node to the end found so far, may be empty
+    track_steps     path positions i with a track from path[i] to path[i + 1]
+    track_indptr    and the points of those tracks, track_points[track_indptr[j]:...]
+
+Every point of an active segment belongs to exactly one node, so the labels give back
+every node key. Files are written next to the target and renamed over it, so a crash
+while writing leaves the previous checkpoint intact.
+"""
+
+import os
+from collections import namedtuple
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+
+from graph import Graph
+from sparse_heights import SparseHeights
+
+VERSION = 1
+
+# What the trace loop needs besides the session. Points are (lat, lon), step is the
+# number of loop iterations done, track_data is only filled in when plotting
+TraceProgress = namedtuple(
+    "TraceProgress",
+    ["start_point", "end_point", "step", "path", "closest_finish_node", "track_data"],
+)
+
+
+def _flat(points, width):
+    points = np.array(points, dtype=np.int64).reshape(-1, 2)
+    return (points[:, 0] * width + points[:, 1]).astype(np.uint32)
+
+
+def _points(flat, width):
+    rows, cols = np.divmod(flat.astype(np.int64), width)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def save_checkpoint(path, heights, graph, active_segments, progress):
+    """Write the session state and progress to path"""
+    grid_size, width = heights.grid_size, heights.shape[1]
+    segments = np.array(active_segments, dtype=np.int32).reshape(-1, 2)
+    assert set(heights.tiles) >= set(active_segments), "Every segment needs heights"
+    tiles = np.stack([heights.tiles[segment] for segment in active_segments])
+
+    nodes = list(graph)
+    node_numbers = {node: i for i, node in enumerate(nodes)}
+    lengths = np.fromiter((len(node) for node in nodes), np.int64, len(nodes))
+    points = np.array(list(chain.from_iterable(nodes)), dtype=np.int64).reshape(-1, 2)
+    segment_numbers = {segment: i for i, segment in enumerate(active_segments)}
+    point_segments = np.array(
+        [
+            segment_numbers[segment]
+            for segment in zip(
+                (points[:, 0] // grid_size).tolist(),
+                (points[:, 1] // grid_size).tolist(),
+            )
+        ],
+        dtype=np.int64,
+    )
+    labels = np.full(tiles.shape, -1, dtype=np.int32)
+    labels[point_segments, points[:, 0] % grid_size, points[:, 1] % grid_size] = (
+        np.repeat(np.arange(len(nodes), dtype=np.int32), lengths)
+    )
+    assert (labels >= 0).all(), "Every point of an active segment needs a node"
+
+    degrees = [len(graph[node]) for node in nodes]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.uint32)
+    np.cumsum(degrees, out=indptr[1:])
+    indices = np.fromiter(
+        (node_numbers[neighbour] for node in nodes for neighbour in graph[node]),
+        np.uint32,
+        int(indptr[-1]),
+    )
+
+    # Only tracks between consecutive path nodes are ever looked up again
+    path_nodes = progress.path
+    track_steps = [
+        i
+        for i, key in enumerate(zip(path_nodes, path_nodes[1:]))
+        if key in progress.track_data
+    ]
+    tracks = [
+        progress.track_data[path_nodes[i], path_nodes[i + 1]] for i in track_steps
+    ]
+    track_indptr = np.zeros(len(tracks) + 1, dtype=np.uint32)
+    np.cumsum([len(track) for track in tracks], out=track_indptr[1:])
+
+    arrays = {
+        "version": np.array(VERSION),
+        "grid_size": np.array(grid_size),
+        "shape": np.array(heights.shape),
+        "start_point": np.array(progress.start_point, dtype=np.float64),
+        "end_point": np.array(progress.end_point, dtype=np.float64),
+        "step": np.array(progress.step),
+        "segments": segments,
+        "tiles": tiles,
+        "labels": labels,
+        "indptr": indptr,
+        "indices": indices,
+        "path": np.array([node_numbers[node] for node in path_nodes], dtype=np.int32),
+        "closest": _flat(progress.closest_finish_node or [], width),
+        "track_steps": np.array(track_steps, dtype=np.int32),
+        "track_indptr": track_indptr,
+        "track_points": _flat(list(chain.from_iterable(tracks)), width),
+    }
+    path = Path(path)
+    temporary_path = path.with_name(path.name + ".tmp")
+    with open(temporary_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path):
+    """(heights, graph, active_segments, progress) saved by save_checkpoint"""
+    with np.load(path) as data:
+        data = {name: data[name] for name in data.files}
+    if int(data["version"]) != VERSION:
+        raise ValueError(f"{path} is a version {data['version']} checkpoint")
+    grid_size = int(data["grid_size"])
+    shape = tuple(data["shape"].tolist())
+    width = shape[1]
+
+    active_segments = [tuple(segment) for segment in data["segments"].tolist()]
+    heights = SparseHeights(shape, grid_size, dtype=data["tiles"].dtype)
+    for segment, tile in zip(active_segments, data["tiles"]):
+        heights.tiles[segment] = tile.copy()
+
+    # Flat indexes of every point of every tile, in the same order as the labels
+    along = np.arange(grid_size, dtype=np.int64)
+    tile_points = [
+        (segment[0] * grid_size + along)[:, None] * width
+        + segment[1] * grid_size
+        + along[None, :]
+        for segment in active_segments
+    ]
+    flat = np.concatenate([i.ravel() for i in tile_points])
+    labels = data["labels"].ravel()
+    # Node keys are sorted tuples of points, and flat indexes sort the same way
+    order = np.lexsort((flat, labels))
+    starts = np.searchsorted(labels[order], np.arange(len(data["indptr"])))
+    points = _points(flat[order], width)
+    nodes = [tuple(points[a:b]) for a, b in zip(starts, starts[1:])]
+
+    indptr, indices = data["indptr"].tolist(), data["indices"].tolist()
+    graph = Graph()
+    graph.add_nodes(
+        {
+            node: {nodes[j] for j in indices[indptr[i] : indptr[i + 1]]}
+            for i, node in enumerate(nodes)
+        }
+    )
+
+    path_nodes = [nodes[i] for i in data["path"].tolist()]
+    track_points = _points(data["track_points"], width)
+    track_indptr = data["track_indptr"].tolist()
+    track_data = {
+        (path_nodes[i], path_nodes[i + 1]): track_points[a:b]
+        for i, a, b in zip(data["track_steps"].tolist(), track_indptr, track_indptr[1:])
+    }
+    closest = tuple(_points(data["closest"], width)) or None
+    progress = TraceProgress(
+        start_point=tuple(data["start_point"].tolist()),
+        end_point=tuple(data["end_point"].tolist()),
+        step=int(data["step"]),
+        path=path_nodes,
+        closest_finish_node=closest,
+        track_data=track_data,
+    )
+    return heights, graph, active_segments, progress
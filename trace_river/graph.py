@@ -6,21 +6,66 @@ class Graph(UserDict):
     Keys are tuple of tuples eg ((1,2), (2,2))
     Values are sets of keys eg {((1,2), (2,2)), ((4,2), (1,4))}
     Relationships should be maintained in both directions
+    A point to key index is kept up to date on every change, use node_of to look up
+    which node a point belongs to
     """
 
+    def __init__(self, *args, **kwargs):
+        self._index = {}
+        super().__init__(*args, **kwargs)
+
+    def _add_to_index(self, key):
+        for point in key:
+            self._index[point] = key
+
     def __delitem__(self, key):
         for neighbour in self[key]:
             old_neighbour_value = self[neighbour]
             old_neighbour_value.remove(key)
         super().__delitem__(key)
+        for point in key:
+            # Comparing keys compares every point, so check for the same key object first
+            indexed = self._index.get(point)
+            if indexed is key or indexed == key:
+                del self._index[point]
 
     def __setitem__(self, key, value):
         assert key not in value
         for neighbour in value:
+            if neighbour not in self:
+                self._add_to_index(neighbour)
             old_neighbour_value = self.get(neighbour, set())
             old_neighbour_value.add(key)
             super().__setitem__(neighbour, old_neighbour_value)
         super().__setitem__(key, value)
+        self._add_to_index(key)
+
+    def add_nodes(self, nodes):
+        """Add several nodes at once from a dict of key to neighbours
+        Links between the added nodes must already go both ways, links to nodes already
+        in the graph are added to those nodes
+        """
+        for key, neighbours in nodes.items():
+            super().__setitem__(key, neighbours)
+            self._add_to_index(key)
+        for key, neighbours in nodes.items():
+            for neighbour in neighbours:
+                if neighbour not in nodes:
+                    self.data[neighbour].add(key)
+
+    def node_of(self, point):
+        return self._index[point]
+
+    def merge(self, nodes):
+        """Replace nodes with one node holding all their points and return its key"""
+        merged_key = tuple(sorted({point for node in nodes for point in node}))
+        neighbours = {neighbour for node in nodes for neighbour in self[node]} - set(
+            nodes
+        )
+        for node in nodes:
+            del self[node]
+        self[merged_key] = neighbours
+        return merged_key
 
     def __repr__(self):
         return f"{type(self).__name__}{self.data}"
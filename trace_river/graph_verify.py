@@ -19,6 +19,7 @@ def check_equal_height_nodes(graph, heights, active_segments, grid_size):
     visited = set()
     for point, node_key in tqdm(key_lookup.items(), desc="Checking node connections"):
         visited.add(point)
+        assert graph.node_of(point) == node_key, "Point index should match graph keys"
         for neighbour in get_adjacent_nodes(grid_size, active_segments, *point):
             if heights[point] == heights[neighbour]:
                 assert (
@@ -1,4 +1,8 @@
-import heapq
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow.paths import grid_path
 
 
 def get_adjacent_points(point):
@@ -26,47 +30,21 @@ def find_exit_point(node, dest_node, heights):
     return best_point
 
 
-def find_deep_path(points, entry_point, exit_point, heights):
-    distances = {point: float("infinity") for point in points}
-    distances[entry_point] = 0
+def find_deep_path(points, entry_point, exit_point, heights, cost=None):
+    """Path through the points of a node from entry_point to exit_point
 
-    point_set = set(points)
-    point_set.add(entry_point)
-    assert exit_point in point_set
-    assert any(
-        i in point_set for i in get_adjacent_points(entry_point) if i in point_set
+    The path doesn't include entry_point and finishes at exit_point. Every step costs
+    one unless a cost function from riverflow.paths is given, eg lower_point_cost(heights).
+    """
+    assert any(i in points for i in get_adjacent_points(entry_point)) or (
+        entry_point == exit_point
     )
-
-    pq = [(0, entry_point, [])]
-    while len(pq) > 0:
-        current_distance, point, path_to_point = heapq.heappop(pq)
-
-        if point == exit_point:
-            return path_to_point
-
-        # Points can get added to the priority queue multiple times. We only
-        # process a point the first time we remove it from the priority queue.
-        if current_distance > distances[point]:
-            continue
-
-        adjacent_points = [i for i in get_adjacent_points(point) if i in point_set]
-        # TODO get edge weights For now hard coded to one
-        for neighbor in adjacent_points:
-            weight = 1
-            distance = current_distance + weight
-
-            # Only consider this new path if it's better than any path we've
-            # already found.
-            if distance < distances[neighbor]:
-                distances[neighbor] = distance
-                new_path = path_to_point.copy()
-                new_path.append(neighbor)
-                heapq.heappush(pq, (distance, neighbor, new_path))
-
-    raise Exception("exit point not visited in search")
+    if cost is None:
+        return grid_path(points, entry_point, exit_point)
+    return grid_path(points, entry_point, exit_point, cost=cost, heuristic=True)
 
 
-def find_point_track(heights, path, start_point, track_data):
+def find_point_track(heights, path, start_point, track_data, cost=None):
     entry_point = start_point
     for node, dest_node in zip(path, path[1:]):
         track_key = (node, dest_node)
@@ -75,7 +53,7 @@ def find_point_track(heights, path, start_point, track_data):
             entry_point = track_data[track_key][-1]
         else:
             exit_point = find_exit_point(node, dest_node, heights)
-            track = find_deep_path(node, entry_point, exit_point, heights)
+            track = find_deep_path(node, entry_point, exit_point, heights, cost)
             assert all(
                 i in node for i in track
             ), "Track must only include points in the node"
@@ -85,12 +63,12 @@ def find_point_track(heights, path, start_point, track_data):
     return track_data
 
 
-def align_path(graph, key_lookup, path):
+def align_path(graph, path):
     already_in_path = set()
     fixed_path = []
     for node in path:
         if node not in graph:
-            new_node = key_lookup[node[0]]
+            new_node = graph.node_of(node[0])
             if new_node not in already_in_path:
                 already_in_path.add(new_node)
                 fixed_path.append(new_node)
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def node_centerpoint(node_key):
+    row = sum(point[0] for point in node_key) / len(node_key)
+    col = sum(point[1] for point in node_key) / len(node_key)
+    return row, col
+
+
+def predict_segments(path, active_segments, grid_size, lookback=20, border_margin=None):
+    """Guess which segments the trace will need next, most likely first
+
+    Segments ahead of the path along its recent direction come first, then the
+    inactive segments next to the current node's segment when the node is within
+    border_margin of that side.
+    """
+    if border_margin is None:
+        border_margin = grid_size // 4
+    current = node_centerpoint(path[-1])
+    previous = node_centerpoint(path[max(len(path) - lookback, 0)])
+    predicted = []
+
+    direction = (current[0] - previous[0], current[1] - previous[1])
+    length = (direction[0] ** 2 + direction[1] ** 2) ** 0.5
+    if length:
+        for distance in (grid_size / 2, grid_size, grid_size * 2):
+            point = (
+                current[0] + direction[0] / length * distance,
+                current[1] + direction[1] / length * distance,
+            )
+            predicted.append((int(point[0] // grid_size), int(point[1] // grid_size)))
+
+    segment = (int(current[0] // grid_size), int(current[1] // grid_size))
+    row_in_segment = current[0] - segment[0] * grid_size
+    col_in_segment = current[1] - segment[1] * grid_size
+    if row_in_segment < border_margin:
+        predicted.append((segment[0] - 1, segment[1]))
+    if row_in_segment > grid_size - border_margin:
+        predicted.append((segment[0] + 1, segment[1]))
+    if col_in_segment < border_margin:
+        predicted.append((segment[0], segment[1] - 1))
+    if col_in_segment > grid_size - border_margin:
+        predicted.append((segment[0], segment[1] + 1))
+
+    output = []
+    for segment in predicted:
+        if segment not in active_segments and segment not in output:
+            if segment[0] >= 0 and segment[1] >= 0:
+                output.append(segment)
+    return output
+
+
+class SegmentPrefetcher:
+    """Loads segments on a thread pool before the trace asks for them
+    load_segment(segment) is called on a worker thread and must be thread safe.
+    Only the newest max_pending requests are kept, older ones which haven't started
+    are cancelled.
+    """
+
+    def __init__(self, load_segment, max_workers=4, max_pending=16):
+        self.load_segment = load_segment
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self.pending = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, segments):
+        for segment in segments:
+            if segment in self.pending:
+                self.pending.move_to_end(segment)
+            else:
+                self.pending[segment] = self.executor.submit(
+                    self.load_segment, segment
+                )
+        while len(self.pending) > self.max_pending:
+            _, future = self.pending.popitem(last=False)
+            future.cancel()
+
+    def get(self, segment):
+        future = self.pending.pop(segment, None)
+        if future is None or future.cancelled():
+            self.misses += 1
+            return self.load_segment(segment)
+        self.hits += 1
+        return future.result()
+
+    def shutdown(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,114 @@
+import operator
+
+import numpy as np
+
+
+class SparseHeights:
+    """Heights for the whole tif which only holds memory for loaded segments
+    Indexing works like a 2D numpy array for single points heights[(row, col)] and for
+    slices heights[top:bottom, left:right]. Points in segments which haven't been
+    written read as zero. Writing to a point or slice allocates the segments it covers.
+    """
+
+    def __init__(self, shape, grid_size, dtype=np.int16):
+        self.shape = tuple(shape)
+        self.grid_size = grid_size
+        self.dtype = np.dtype(dtype)
+        self.tiles = {}
+
+    @property
+    def segments(self):
+        return list(self.tiles)
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def _tile(self, segment):
+        if segment not in self.tiles:
+            self.tiles[segment] = np.zeros(
+                (self.grid_size, self.grid_size), dtype=self.dtype
+            )
+        return self.tiles[segment]
+
+    def _bounds(self, index):
+        # Convert an index into (top, bottom, left, right) and whether it is a single point
+        if not isinstance(index, tuple) or len(index) != 2:
+            raise IndexError("SparseHeights needs a (row, col) index")
+        bounds = []
+        for axis, item in enumerate(index):
+            if isinstance(item, slice):
+                start, stop, step = item.indices(self.shape[axis])
+                if step != 1:
+                    raise IndexError("SparseHeights slices can't have a step")
+                bounds += [start, max(start, stop)]
+            else:
+                item = operator.index(item)
+                if not 0 <= item < self.shape[axis]:
+                    raise IndexError(f"index {item} is out of bounds for axis {axis}")
+                bounds += [item, item + 1]
+        return bounds, not any(isinstance(item, slice) for item in index)
+
+    def _overlapping_tiles(self, top, bottom, left, right):
+        # (segment, window slices, tile slices) of every segment a window covers
+        grid = self.grid_size
+        for row in range(top // grid, (bottom - 1) // grid + 1):
+            for col in range(left // grid, (right - 1) // grid + 1):
+                tile_top, tile_left = row * grid, col * grid
+                y0, y1 = max(top, tile_top), min(bottom, tile_top + grid)
+                x0, x1 = max(left, tile_left), min(right, tile_left + grid)
+                yield (
+                    (row, col),
+                    (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left)),
+                    (
+                        slice(y0 - tile_top, y1 - tile_top),
+                        slice(x0 - tile_left, x1 - tile_left),
+                    ),
+                )
+
+    def __getitem__(self, index):
+        (top, bottom, left, right), is_point = self._bounds(index)
+        if is_point:
+            segment = (top // self.grid_size, left // self.grid_size)
+            if segment not in self.tiles:
+                return self.dtype.type(0)
+            return self.tiles[segment][top % self.grid_size, left % self.grid_size]
+
+        output = np.zeros((bottom - top, right - left), dtype=self.dtype)
+        if output.size:
+            for segment, window_slices, tile_slices in self._overlapping_tiles(
+                top, bottom, left, right
+            ):
+                if segment in self.tiles:
+                    output[window_slices] = self.tiles[segment][tile_slices]
+        if not isinstance(index[0], slice):
+            return output[0]
+        if not isinstance(index[1], slice):
+            return output[:, 0]
+        return output
+
+    def __setitem__(self, index, value):
+        (top, bottom, left, right), is_point = self._bounds(index)
+        if is_point:
+            tile = self._tile((top // self.grid_size, left // self.grid_size))
+            tile[top % self.grid_size, left % self.grid_size] = value
+            return
+
+        value = np.asarray(value, dtype=self.dtype)
+        if not isinstance(index[1], slice) and value.ndim == 1:
+            value = value[:, None]
+        value = np.broadcast_to(value, (bottom - top, right - left))
+        if value.size:
+            for segment, window_slices, tile_slices in self._overlapping_tiles(
+                top, bottom, left, right
+            ):
+                self._tile(segment)[tile_slices] = value[window_slices]
+
+    def max(self):
+        return max(tile.max() for tile in self.tiles.values())
+
+    def min(self):
+        return min(tile.min() for tile in self.tiles.values())
+
+    def __repr__(self):
+        return f"{type(self).__name__}(shape={self.shape}, segments={len(self.tiles)}, nbytes={self.nbytes})"
@@ -1,3 +1,6 @@
+import argparse
+import sys
+import time
 from pathlib import Path
 
 import numpy as np
@@ -5,21 +8,29 @@ import rasterio as rio
 from matplotlib import pyplot as plt
 from pyproj import Proj
 
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from riverflow import instrument, raster
+
 from path_tracing import align_path, find_point_track
-from algorithms import add_segment_to_graph, flood_added_segment
+from algorithms import add_segments_to_graph, flood_added_segments
 from graph import Graph
+from prefetch import SegmentPrefetcher, predict_segments
+from sparse_heights import SparseHeights
+from checkpoint import TraceProgress, load_checkpoint, save_checkpoint
 from graph_verify import check_equal_height_nodes, check_flooded_nodes, do_keys_overlap
 
 proj_string = "+proj=utm +zone=55 +south +datum=WGS84 +units=m +no_defs"
 proj = Proj(proj_string)
-heights_tif_path = (
+heights_tif_path = raster.optimized_path(
     Path(__name__).absolute().parent.parent.joinpath("tasmania", "heights.tif")
 )
-colour_tif_path = (
+colour_tif_path = raster.optimized_path(
     Path(__name__).absolute().parent.parent.joinpath("tasmania", "colour.tif")
 )
 TIF_MAX_DIMENSIONS = (30978, 30978)
 GRID = 200
+PREFETCH_INTERVAL = 10
+CHECKPOINT_INTERVAL = 600
 assert heights_tif_path.exists()
 
 
@@ -38,112 +49,300 @@ def get_raster(segment):
         width=GRID,
         height=GRID,
     )
-    with rio.open(heights_tif_path) as heights:
-        height_raster = heights.read(1, window=window)
-        return height_raster
-
-
-def trace_and_expand_existing_graph(start_point, end_point):
-    start_rowcol = lat_lon_to_row_col(*start_point)
-    end_rowcol = lat_lon_to_row_col(*end_point)
-
-    next_segment = (start_rowcol[0] // GRID, start_rowcol[1] // GRID)
-    print(f"Starting with segment {next_segment}")
-    active_segments = [next_segment]
-    heights = np.zeros(TIF_MAX_DIMENSIONS, dtype=np.int16)
-    heights[
-        next_segment[0] * GRID : next_segment[0] * GRID + GRID,
-        next_segment[1] * GRID : next_segment[1] * GRID + GRID,
-    ] = get_raster(next_segment)
-
-    graph = Graph()
-    graph = add_segment_to_graph(graph, heights, GRID, next_segment, active_segments)
-    # check_equal_height_nodes(graph, heights, active_segments, GRID)
-    graph, heights = flood_added_segment(
-        graph, heights, GRID, next_segment, active_segments
-    )
-    # check_flooded_nodes(graph, heights, active_segments, GRID)
-
-    key_lookup = {k: key for key in graph.keys() for k in key}
-    path = [key_lookup[start_rowcol]]
-    assert key_lookup[start_rowcol] in graph
-    track_data = {}
+    with instrument.timer("raster_read"):
+        return raster.read(heights_tif_path, window)
+
+
+class TraceSession:
+    """Graph, heights and loaded segments shared by every river traced with it
+
+    Segments loaded and flooded for one trace are reused by the next, so tracing
+    several rivers in the same area only reads and builds each segment once. When a
+    trace is profiled the timers and counters recorded during it are kept in
+    last_profile.
+
+    With a checkpoint_path the session and the progress of the current trace are saved
+    there after adding a segment, at most every checkpoint_interval seconds, and when
+    the trace hits its step limit. from_checkpoint carries on from that file.
+    """
+
+    def __init__(self, checkpoint_path=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.heights = SparseHeights(TIF_MAX_DIMENSIONS, GRID, dtype=np.int16)
+        self.graph = Graph()
+        self.active_segments = []
+        self.prefetcher = SegmentPrefetcher(get_raster)
+        self.last_profile = None
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.perf_counter()
+        # Progress of an unfinished trace loaded from a checkpoint
+        self.progress = None
+
+    @classmethod
+    def from_checkpoint(cls, path, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """Session loaded from a checkpoint, which keeps checkpointing to the same path
+
+        Call resume to carry on with the trace which was saved.
+        """
+        session = cls(path, checkpoint_interval)
+        (
+            session.heights,
+            session.graph,
+            session.active_segments,
+            session.progress,
+        ) = load_checkpoint(path)
+        return session
+
+    def checkpoint(self, progress, force=False):
+        """Save to checkpoint_path if checkpoint_interval has passed or with force"""
+        if self.checkpoint_path is None:
+            return
+        if (
+            not force
+            and time.perf_counter() - self.last_checkpoint < self.checkpoint_interval
+        ):
+            return
+        with instrument.timer("checkpoint"):
+            save_checkpoint(
+                self.checkpoint_path,
+                self.heights,
+                self.graph,
+                self.active_segments,
+                progress,
+            )
+        self.last_checkpoint = time.perf_counter()
+        print(f"Saved checkpoint at step {progress.step} to {self.checkpoint_path}")
+
+    def add_segments(self, segments):
+        segments = [i for i in segments if i not in self.active_segments]
+        if not segments:
+            return
+        start = time.perf_counter()
+        self.prefetcher.prefetch(segments)
+        self.active_segments += segments
+        with instrument.timer("segment_wait"):
+            for segment in segments:
+                self.heights[
+                    segment[0] * GRID : segment[0] * GRID + GRID,
+                    segment[1] * GRID : segment[1] * GRID + GRID,
+                ] = self.prefetcher.get(segment)
+
+        with instrument.timer("graph_build"):
+            self.graph = add_segments_to_graph(
+                self.graph, self.heights, GRID, segments, self.active_segments
+            )
+        # check_equal_height_nodes(self.graph, self.heights, self.active_segments, GRID)
+        with instrument.timer("flood"):
+            self.graph, self.heights = flood_added_segments(
+                self.graph, self.heights, GRID, segments, self.active_segments
+            )
+        # check_flooded_nodes(self.graph, self.heights, self.active_segments, GRID)
+        instrument.count("segments_added", len(segments))
+        instrument.event(
+            "segments_added",
+            segments=len(segments),
+            active_segments=len(self.active_segments),
+            graph_nodes=len(self.graph),
+            seconds=time.perf_counter() - start,
+        )
 
-    closest_finish_node = None
-    finish_point_threshold = 50
-    plt.get_current_fig_manager().full_screen_toggle()
-    plt.ion()
-    plt.show()
-    for i in range(10000):
-        current_node = key_lookup[path[-1][0]]
-        next_nodes = graph[current_node]
-        next_segment = detect_edge_touch(
-            current_node,
-            active_segments,
-            GRID,
+    def add_segments_around(self, point):
+        # The segment holding point and the segments around it, built as one block
+        segment = (point[0] // GRID, point[1] // GRID)
+        self.add_segments(
+            [
+                (segment[0] + row, segment[1] + col)
+                for row in (-1, 0, 1)
+                for col in (-1, 0, 1)
+                if segment[0] + row >= 0 and segment[1] + col >= 0
+            ]
         )
 
-        if next_segment:
-            track_data = find_point_track(heights, path, start_rowcol, track_data)
-            show_plot(
-                heights,
-                path,
-                track_data,
-                active_segments,
+    def trace(self, start_point, end_point, plot=False, max_steps=10000, profile=False):
+        """Path of nodes downhill from start_point until it passes closest to end_point
+
+        Points are (lat, lon). With plot the track is drawn every time a segment is
+        added and shown at the end. With profile each stage of the trace is timed and
+        counted into last_profile.
+        """
+        progress = TraceProgress(start_point, end_point, 0, None, None, {})
+        return self._run(progress, plot, max_steps, profile)
+
+    def resume(self, plot=False, max_steps=10000, profile=False):
+        """Carry on with the trace loaded by from_checkpoint
+
+        max_steps counts the steps taken before the checkpoint, raise it to continue a
+        trace which stopped at its step limit.
+        """
+        if self.progress is None:
+            raise ValueError("No trace to resume, load one with from_checkpoint")
+        progress, self.progress = self.progress, None
+        return self._run(progress, plot, max_steps, profile)
+
+    def _run(self, progress, plot, max_steps, profile):
+        self.last_checkpoint = time.perf_counter()
+        if not profile:
+            return self._trace(progress, plot, max_steps)
+        instrument.enable()
+        try:
+            with instrument.timer("trace"):
+                return self._trace(progress, plot, max_steps)
+        finally:
+            self.last_profile = instrument.disable()
+
+    def _trace(self, progress, plot, max_steps):
+        start_point, end_point = progress.start_point, progress.end_point
+        start_rowcol = lat_lon_to_row_col(*start_point)
+        end_rowcol = lat_lon_to_row_col(*end_point)
+        if progress.path is None:
+            start_segment = (start_rowcol[0] // GRID, start_rowcol[1] // GRID)
+            print(f"Starting with segment {start_segment}")
+            self.add_segments_around(start_rowcol)
+            path = [self.graph.node_of(start_rowcol)]
+        else:
+            print(f"Resuming at step {progress.step} with {len(progress.path)} nodes")
+            path = progress.path
+        assert path[0] in self.graph
+        track_data = progress.track_data
+
+        closest_finish_node = progress.closest_finish_node
+        finish_point_threshold = 50
+        if plot:
+            plt.get_current_fig_manager().full_screen_toggle()
+            plt.ion()
+            plt.show()
+        for i in range(progress.step, max_steps):
+            current_node = self.graph.node_of(path[-1][0])
+            next_nodes = self.graph[current_node]
+            next_segment = detect_edge_touch(
+                current_node,
+                self.active_segments,
                 GRID,
-                start_rowcol,
-                end_rowcol,
             )
 
-            do_keys_overlap(graph)
-            print(f"Adding segment {next_segment}")
-            active_segments.append(next_segment)
-            heights[
-                next_segment[0] * GRID : next_segment[0] * GRID + GRID,
-                next_segment[1] * GRID : next_segment[1] * GRID + GRID,
-            ] = get_raster(next_segment)
-            graph = add_segment_to_graph(
-                graph, heights, GRID, next_segment, active_segments
-            )
-            # check_equal_height_nodes(graph, heights, active_segments, GRID)
-            graph, heights = flood_added_segment(
-                graph, heights, GRID, next_segment, active_segments
-            )
-            # check_flooded_nodes(graph, heights, active_segments, GRID)
-            key_lookup = {k: key for key in graph.keys() for k in key}
-            path = align_path(graph, key_lookup, path)
-            current_node = path[-1]
-            continue
-
-        selected_node = min(next_nodes, key=lambda node_key: heights[node_key[0]])
-        distance = distance_closest_point(end_rowcol, selected_node)
-        if closest_finish_node is None:
-            if distance < finish_point_threshold:
-                closest_finish_node = selected_node
-        else:
-            if distance > distance_closest_point(end_rowcol, closest_finish_node):
-                # We're getting further away so just finish without the last point
-                # TODO terminate path at closest_finish_node
-                plt.ioff()
-                track_data = find_point_track(heights, path, start_rowcol, track_data)
-                show_plot(
-                    heights,
-                    path,
-                    track_data,
-                    active_segments,
-                    GRID,
-                    start_rowcol,
-                    end_rowcol,
+            if i % PREFETCH_INTERVAL == 0:
+                self.prefetcher.prefetch(
+                    predict_segments(path, self.active_segments, GRID)
                 )
-                plt.show()
-                return path, heights
+
+            if next_segment:
+                # Start reading the segment while the track is drawn
+                self.prefetcher.prefetch([next_segment])
+                if plot:
+                    with instrument.timer("find_point_track"):
+                        track_data = find_point_track(
+                            self.heights, path, start_rowcol, track_data
+                        )
+                    with instrument.timer("show_plot"):
+                        show_plot(
+                            self.heights,
+                            path,
+                            track_data,
+                            self.active_segments,
+                            GRID,
+                            start_rowcol,
+                            end_rowcol,
+                        )
+
+                with instrument.timer("check_keys"):
+                    do_keys_overlap(self.graph)
+                print(f"Adding segment {next_segment}")
+                self.add_segments([next_segment])
+                with instrument.timer("align_path"):
+                    path = align_path(self.graph, path)
+                current_node = path[-1]
+                self.prefetcher.prefetch(
+                    predict_segments(path, self.active_segments, GRID)
+                )
+                self.checkpoint(
+                    TraceProgress(
+                        start_point,
+                        end_point,
+                        i + 1,
+                        path,
+                        closest_finish_node,
+                        track_data,
+                    )
+                )
+                continue
+
+            selected_node = min(
+                next_nodes, key=lambda node_key: self.heights[node_key[0]]
+            )
+            distance = distance_closest_point(end_rowcol, selected_node)
+            if closest_finish_node is None:
+                if distance < finish_point_threshold:
+                    closest_finish_node = selected_node
             else:
-                closest_finish_node = selected_node
+                if distance > distance_closest_point(end_rowcol, closest_finish_node):
+                    # We're getting further away so just finish without the last point
+                    # TODO terminate path at closest_finish_node
+                    if plot:
+                        plt.ioff()
+                        with instrument.timer("find_point_track"):
+                            track_data = find_point_track(
+                                self.heights, path, start_rowcol, track_data
+                            )
+                        show_plot(
+                            self.heights,
+                            path,
+                            track_data,
+                            self.active_segments,
+                            GRID,
+                            start_rowcol,
+                            end_rowcol,
+                        )
+                        plt.show()
+                    return path
+                else:
+                    closest_finish_node = selected_node
+
+            path.append(selected_node)
+            instrument.count("trace_steps")
+
+        print("Algorithm passed iteration limit")
+        self.checkpoint(
+            TraceProgress(
+                start_point,
+                end_point,
+                max(max_steps, progress.step),
+                path,
+                closest_finish_node,
+                track_data,
+            ),
+            force=True,
+        )
+        return path
+
+    def close(self):
+        self.prefetcher.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def trace_and_expand_existing_graph(
+    start_point, end_point, profile=False, checkpoint_path=None, max_steps=10000
+):
+    with TraceSession(checkpoint_path=checkpoint_path) as session:
+        path = session.trace(
+            start_point, end_point, plot=True, max_steps=max_steps, profile=profile
+        )
+    if profile:
+        print(session.last_profile.summary(total="trace"))
+    return path, session.heights
 
-        path.append(selected_node)
 
-    print("Algorithm passed iteration limit")
-    return path, heights
+def resume_trace(checkpoint_path, profile=False, max_steps=10000):
+    """Carry on with a trace from its last checkpoint, like trace_and_expand_existing_graph"""
+    with TraceSession.from_checkpoint(checkpoint_path) as session:
+        path = session.resume(plot=True, max_steps=max_steps, profile=profile)
+    if profile:
+        print(session.last_profile.summary(total="trace"))
+    return path, session.heights
 
 
 def find_centerpoint(node_key):
@@ -210,7 +409,8 @@ def measure_distance(path):
     return f"River distance {distance/100:.2f}km"
 
 
-def elevation_profile(path, heights, dist_string=None):
+def path_profile(path, heights):
+    # Distance along the path in km and height of every node
     distance = 0
     x = [0]
     y = [heights[path[0][0]]]
@@ -223,6 +423,12 @@ def elevation_profile(path, heights, dist_string=None):
         ) ** 0.5
         x.append(distance / 100)  # Distance in km
         y.append(heights[next_point[0]])
+    return x, y
+
+
+def elevation_profile(path, heights, dist_string=None):
+    x, y = path_profile(path, heights)
+    distance = x[-1] * 100
     plt.plot(x, y)
     fig_text = f"Avg gradient {(max(y)-min(y))/(distance/100):.0f}m/km"
     if dist_string:
@@ -234,10 +440,28 @@ def elevation_profile(path, heights, dist_string=None):
     plt.show()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trace a river and plot it")
+    parser.add_argument("--profile", action="store_true", help="time each stage")
+    parser.add_argument("--checkpoint", help="save progress to this file as it goes")
+    parser.add_argument("--resume", help="carry on from this checkpoint file")
+    parser.add_argument("--max-steps", type=int, default=10000)
+    arguments = parser.parse_args()
+
     start_point = (-41.55327294639188, 145.87881557530164)  # Vale putin
     end_point = (-41.62953442116648, 145.7696457139196)  # Vale takeout
     # start_point = (-42.229119247079964, 145.81054340737677)  # Franklin putin
     # end_point = (-42.285970802829496, 145.74782103623605)  # Franklin midway
-    path, heights = trace_and_expand_existing_graph(start_point, end_point)
+    if arguments.resume:
+        path, heights = resume_trace(
+            arguments.resume, arguments.profile, arguments.max_steps
+        )
+    else:
+        path, heights = trace_and_expand_existing_graph(
+            start_point,
+            end_point,
+            arguments.profile,
+            arguments.checkpoint,
+            arguments.max_steps,
+        )
     dist_string = measure_distance(path)
     elevation_profile(path, heights, dist_string)
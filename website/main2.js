@@ -1,32 +1,51 @@
-document.getElementById("loading").remove()
-
-// Initialize data structures
-var graph_neighbours = new Object();
-var graph_attributes = new Object();
-var graph_sprites = new Object();
-var graph_lines = new Object();
+// Graph arrays, see riverflow/graph_export.py. Node i has its center at centers[2i], centers[2i + 1]
+// and its neighbours are indices[indptr[i]] up to indices[indptr[i + 1]]
+var num_nodes;
+var num_links;
+var centers;
+var heights;
+var indptr;
+var indices;
+var graph_sprites = [];
+var graph_lines = [];
 
 var max_x = 0;
 var max_y = 0;
 var max_height = 0;
 var min_height = 100000;
-var num_links = 0;
-
-for (node of graph_data) {
-    max_x = (node.center[0] > max_x) ? node.center[0] : max_x;
-    max_y = (node.center[1] > max_y) ? node.center[1] : max_y;
-    max_height = (node.height > max_height) ? node.height : max_height;
-    min_height = (node.height < min_height) ? node.height : min_height;
-    graph_neighbours[node.key] = node.neighbours;
-    num_links += node.neighbours.length;
-    graph_attributes[node.key] = {
-        center: node.center,
-        height: node.height,
-        key: node.key,
-    };
+
+const HEIGHTS_32 = 1;
+const INDICES_32 = 2;
+
+function typed_array(type, buffer, offset, length) {
+    // Every section of the buffer is padded to 4 bytes
+    const array = new type(buffer, offset, length);
+    return [array, offset + Math.ceil(array.byteLength / 4) * 4];
+}
+
+function read_graph(buffer) {
+    const header = new Uint32Array(buffer, 0, 5);
+    if (new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) != "RFG1" || header[1] != 1) {
+        throw new Error("graph_data.bin is not a version 1 graph");
+    }
+    num_nodes = header[2];
+    num_links = header[3];
+    const flags = header[4];
+    let offset = header.byteLength;
+    [centers, offset] = typed_array(Float32Array, buffer, offset, 2 * num_nodes);
+    [heights, offset] = typed_array((flags & HEIGHTS_32) ? Int32Array : Int16Array, buffer, offset, num_nodes);
+    [indptr, offset] = typed_array(Uint32Array, buffer, offset, num_nodes + 1);
+    [indices, offset] = typed_array((flags & INDICES_32) ? Uint32Array : Uint16Array, buffer, offset, num_links);
+
+    for (let node = 0; node < num_nodes; node++) {
+        max_x = Math.max(max_x, centers[2 * node]);
+        max_y = Math.max(max_y, centers[2 * node + 1]);
+        max_height = Math.max(max_height, heights[node]);
+        min_height = Math.min(min_height, heights[node]);
+    }
+    max_x += 1;
+    max_y += 1;
 }
-max_x += 1;
-max_y += 1;
 
 var grid_size;
 var circle_radius;
@@ -38,12 +57,8 @@ const app = new PIXI.Application({
 });
 document.body.appendChild(app.view);
 
-let line_container = new PIXI.ParticleContainer(num_links);
-app.stage.addChild(line_container);
-let container = new PIXI.ParticleContainer(graph_data.length);
-app.stage.addChild(container);
-
-window.addEventListener('resize', draw_objects);
+let line_container;
+let container;
 
 function find_circle_centerpoint(x, y) {
     return [
@@ -53,14 +68,14 @@ function find_circle_centerpoint(x, y) {
 }
 
 function draw_circles(texture, container) {
-    for (node of Object.values(graph_attributes)) {
-        center = find_circle_centerpoint(node.center[0], node.center[1]);
+    for (let node = 0; node < num_nodes; node++) {
+        const center = find_circle_centerpoint(centers[2 * node], centers[2 * node + 1]);
         let sprite = new PIXI.Sprite(texture);
         sprite.x = center[0] - circle_radius;
         sprite.y = center[1] - circle_radius;
-        sprite.tint = height_to_colour(node.height);
+        sprite.tint = height_to_colour(heights[node]);
         container.addChild(sprite);
-        graph_sprites[node.key] = sprite;
+        graph_sprites[node] = sprite;
     }
 }
 
@@ -70,13 +85,12 @@ function get_angle(x1, x2, y1, y2) {
 
 function draw_lines(container) {
     texture = create_pixel_texture()
-    for (node of Object.values(graph_attributes)) {
-        center = find_circle_centerpoint(node.center[0], node.center[1]);
-        for (neighbour of Object.values(graph_neighbours[node.key])) {
-            neighbour_node = graph_attributes[neighbour]
-            center2 = find_circle_centerpoint(neighbour_node.center[0], neighbour_node.center[1]);
-            sprite = draw_line(center[0], center[1], center2[0], center2[1], 2, texture)
-            graph_lines[node.key + ">" + neighbour_node.key] = sprite;
+    for (let node = 0; node < num_nodes; node++) {
+        const center = find_circle_centerpoint(centers[2 * node], centers[2 * node + 1]);
+        for (let link = indptr[node]; link < indptr[node + 1]; link++) {
+            const neighbour = indices[link];
+            const center2 = find_circle_centerpoint(centers[2 * neighbour], centers[2 * neighbour + 1]);
+            graph_lines[link] = draw_line(center[0], center[1], center2[0], center2[1], 2, texture);
         }
     }
 }
@@ -104,59 +118,59 @@ function draw_objects() {
 }
 
 // Flow simulation code:
-var graph_flows = new Object();
+var graph_flows;
+var sorted_nodes;
 function start_update_colours() {
-    sorted_keys = Object.keys(graph_attributes).sort(k => graph_attributes[k].height);
-    for (key of sorted_keys) {
-        graph_flows[key] = 1;
-    }
+    // Highest first so water passed down in one pass is passed on again in the same pass
+    sorted_nodes = Array.from(heights.keys()).sort((a, b) => heights[b] - heights[a]);
+    graph_flows = new Float64Array(num_nodes).fill(1);
     loop_update_colours()
 }
 
 function loop_update_colours() {
     update_colours();
-    if (Math.max(...Object.values(graph_flows)) > 0) {
+    if (graph_flows.some(flow => flow > 0)) {
         setTimeout(loop_update_colours, 0);
     }
 }
 
 function update_colours() {
-    for (key of sorted_keys) {
+    for (const node of sorted_nodes) {
         // There has gotta be a way to do this with fewer passes!
         // Also stop recalculating height difference!
-        total_outflow_height = 0;
-        largest_height_difference = 0;
-        for (neighbour of graph_neighbours[key]) {
-            if (graph_attributes[key].height > graph_attributes[neighbour].height) {
-                height_difference = graph_attributes[key].height - graph_attributes[neighbour].height;
-                total_outflow_height += height_difference;
-                if (height_difference > largest_height_difference) {
-                    largest_height_difference = height_difference;
-                }
+        let largest_height_difference = 0;
+        for (let link = indptr[node]; link < indptr[node + 1]; link++) {
+            const height_difference = heights[node] - heights[indices[link]];
+            if (height_difference > largest_height_difference) {
+                largest_height_difference = height_difference;
             }
         }
         // Only send flow to nodes that have a significant amount of flow
         // Significant means at least 10% of the flow going to the main outflow
-        active_total_height_difference = 0;
-        for (neighbour of graph_neighbours[key]) {
-            height_difference = graph_attributes[key].height - graph_attributes[neighbour].height;
-            if (height_difference > largest_height_difference/10){
-                active_total_height_difference += graph_attributes[key].height - graph_attributes[neighbour].height;
+        let active_total_height_difference = 0;
+        for (let link = indptr[node]; link < indptr[node + 1]; link++) {
+            const height_difference = heights[node] - heights[indices[link]];
+            if (height_difference > largest_height_difference / 10) {
+                active_total_height_difference += height_difference;
             }
         }
-        for (neighbour of graph_neighbours[key]) {
-            height_difference = graph_attributes[key].height - graph_attributes[neighbour].height;
-            if (height_difference > largest_height_difference/10){
-                graph_flows[neighbour] += graph_flows[key] * height_difference / active_total_height_difference
+        for (let link = indptr[node]; link < indptr[node + 1]; link++) {
+            const height_difference = heights[node] - heights[indices[link]];
+            if (height_difference > largest_height_difference / 10) {
+                graph_flows[indices[link]] += graph_flows[node] * height_difference / active_total_height_difference;
             }
         }
-        graph_flows[key] = 0;
+        graph_flows[node] = 0;
+    }
+    let max_flow = 0;
+    for (const flow of graph_flows) {
+        max_flow = Math.max(max_flow, flow);
     }
-    max_flow = Math.log(Math.max(...Object.values(graph_flows)))
-    for (key of sorted_keys) {
-        let sprite = graph_sprites[key];
+    max_flow = Math.log(max_flow);
+    for (const node of sorted_nodes) {
+        let sprite = graph_sprites[node];
         container.removeChild(sprite);
-        sprite.tint = float_to_colour(Math.max(0, Math.log(graph_flows[key])) / max_flow);
+        sprite.tint = float_to_colour(Math.max(0, Math.log(graph_flows[node])) / max_flow);
         container.addChild(sprite);
     }
 }
@@ -196,4 +210,15 @@ function float_to_colour(value) {
     return (rgb[0] << 16) + (rgb[1] << 8) + rgb[2];
 }
 
-draw_objects();
+fetch("graph_data.bin")
+    .then(response => response.arrayBuffer())
+    .then(buffer => {
+        read_graph(buffer);
+        line_container = new PIXI.ParticleContainer(num_links);
+        app.stage.addChild(line_container);
+        container = new PIXI.ParticleContainer(num_nodes);
+        app.stage.addChild(container);
+        document.getElementById("loading").remove();
+        window.addEventListener('resize', draw_objects);
+        draw_objects();
+    });